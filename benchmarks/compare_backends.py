@@ -0,0 +1,113 @@
+"""
+Comparison of the R and pyvinecopulib copula backends of CMPI on a reference quadruple.
+
+Pseudo-observations are sampled from the reference C-vine stored in copula/copula.json, with the columns
+reversed so that the variable conditioned on all others in the reference model is the target, the first
+column. Both backends fit the C-vine of CMPI, and their families, parameters, AIC, BIC, mispricing indices
+and timings are compared with each other and with the exact conditional distribution of the reference model.
+The R backend is skipped if rpy2 or VineCopula are not available.
+
+Run from the repository root:
+    python -m benchmarks.compare_backends --n 250 --seed 0
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pyvinecopulib as pv
+
+from strategy.CMPI_strategy import CMPI
+
+REFERENCE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'copula', 'copula.json')
+
+
+def sample_reference(n: int = 250, seed: int = 0, path: str = REFERENCE_PATH) -> (pd.DataFrame, np.ndarray):
+    """
+    Samples pseudo-observations of a quadruple from the reference model.
+
+    :param n: (int) : number of observations
+    :param seed: (int) : seed of the sample
+    :param path: (str) : path of the reference pyvinecopulib model
+    :return: (tuple) :
+        U : (pd.DataFrame) : pseudo-observations, target first
+        h : (np.array) : conditional distribution of the target given the partners under the reference model
+    """
+
+    reference = pv.Vinecop.from_file(path)
+    sample = reference.sample(n, seeds=[seed])
+    # The last column of the Rosenblatt transform is conditioned on all other variables
+    h = reference.rosenblatt(sample)[:, -1]
+    U = pd.DataFrame(sample[:, ::-1], columns=['target', 'partner_1', 'partner_2', 'partner_3'])
+    return U, h
+
+
+def evaluate_backend(backend: str, U: pd.DataFrame, family: list = CMPI.DEFAULT_FAMILY) -> dict:
+    """
+    Fits the C-vine of CMPI with a backend and computes the mispricing index of every observation.
+
+    :param backend: (str) : 'r' or 'pyvinecopulib'
+    :param U: (pd.DataFrame) : pseudo-observations, target first
+    :param family: (list) : VineCopula family codes
+    :return: (dict) : fitted model, mispricing indices, fit and predict times
+    """
+
+    model = CMPI(backend=backend).cvm
+    start = time.perf_counter()
+    model.fit(U, family)
+    fit_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    h = model.predict(U).to_numpy()
+    predict_time = time.perf_counter() - start
+
+    return {'model': model, 'h': h, 'fit_time': fit_time, 'predict_time': predict_time}
+
+
+def compare_backends(n: int = 250, seed: int = 0) -> pd.DataFrame:
+    """
+    Fits both backends on a sample of the reference model and prints their models.
+
+    :param n: (int) : number of observations
+    :param seed: (int) : seed of the sample
+    :return: (pd.DataFrame) : per backend, AIC, BIC, timings and the largest absolute difference of the
+        mispricing index from the reference model and from the other backend
+    """
+
+    U, reference_h = sample_reference(n, seed)
+    results = {}
+    for backend in CMPI.BACKENDS:
+        try:
+            results[backend] = evaluate_backend(backend, U)
+        except ImportError as error:
+            print(f"Skipping the {backend} backend: {error}")
+
+    rows = []
+    for backend, result in results.items():
+        model = result['model']
+        print(f"\n{backend} backend")
+        print("family:\n{}\npar:\n{}\npar2:\n{}".format(model.family(), model.par().round(4), model.par2().round(4)))
+        row = {'backend': backend, 'aic': model.aic(), 'bic': model.bic(), 'fit_time': result['fit_time'],
+               'predict_time': result['predict_time'],
+               'max_abs_diff_reference': np.abs(result['h'] - reference_h).max()}
+        if len(results) == 2:
+            other = results['pyvinecopulib' if backend == 'r' else 'r']
+            row['max_abs_diff_other'] = np.abs(result['h'] - other['h']).max()
+            row['same_families'] = bool((model.family() == other['model'].family()).all())
+        rows.append(row)
+
+    return pd.DataFrame(rows).set_index('backend')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=250, help='number of observations of the reference quadruple')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the sample')
+    args = parser.parse_args()
+
+    print("\n" + compare_backends(args.n, args.seed).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+"""
+Performance benchmarks of partner selection and CMPI generation on synthetic price panels.
+
+Every stage is timed with its wall time, the peak RSS of the process and its worker processes, and its
+throughput, e.g. quadruples per second for the selectors. Results are compared with a stored baseline, and
+stages slower than the baseline by more than the tolerance are reported as regressions.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmarks --tickers 200 --days 260 --targets 2
+    python -m benchmarks.run_benchmarks --save-baseline
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import pandas as pd
+import numpy as np
+import psutil
+
+from benchmarks.synthetic import generate_prices
+from ps.partner_selection import PartnerSelection
+from ps.ps_utils import blocked_top_k_correlations
+from strategy.CMPI_strategy import CMPI
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+METHODS = ('traditional', 'extended', 'geometric', 'extremal')
+VARIANTS = ('serial', 'batch', 'multiprocess')
+
+
+class PeakMemoryMonitor:
+    """
+    Samples the resident set size of the process and its children in a background thread, to find the peak
+    memory of a stage including the memory of worker processes.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        """
+        :param interval: (float) : seconds between samples
+        """
+
+        self.interval = interval
+        self.peak_rss = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = self._process.memory_info().rss
+        for child in self._process.children(recursive=True):
+            with contextlib.suppress(psutil.Error):
+                rss += child.memory_info().rss
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+class StubCopulaModel:
+    """
+    Stand-in for CVineModel with negligible cost, so that benchmarks of CMPI.generate_cmpi measure the rolling
+    loop of CMPI itself and do not require R. The mispricing index is the quantile of the target.
+    """
+
+    def fit(self, U, family=None):
+        self.dimension = U.shape[1]
+
+    def refit(self, U, cvm=None, maxit=50):
+        pass
+
+    def predict(self, U):
+        return pd.Series(U.iloc[:, 0].to_numpy(), index=U.index, name=U.columns[0])
+
+
+def measure(stage: str, func, items: int = None, unit: str = None, repeat: int = 1) -> (dict, object):
+    """
+    Runs func and records its wall time, peak RSS and throughput. Printed output of func is suppressed.
+    With repeat, the wall time is the fastest of the runs, which is the least affected by other load.
+
+    :param stage: (str) : name of the stage
+    :param func: (callable) : stage to run, without arguments
+    :param items: (int) : number of items processed by the stage, e.g. quadruples
+    :param unit: (str) : name of the items
+    :param repeat: (int) : number of runs
+    :return: (tuple) : record of the measurements and the return value of the last run of func
+    """
+
+    wall_time = np.inf
+    with PeakMemoryMonitor() as monitor, contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            wall_time = min(wall_time, time.perf_counter() - start)
+
+    record = {'stage': stage, 'wall_time': wall_time, 'peak_rss_mb': monitor.peak_rss / 2 ** 20,
+              'items': items, 'unit': unit, 'items_per_sec': items / wall_time if items else None}
+    print(f"{stage:<45} {wall_time:>10.4f} s {record['peak_rss_mb']:>10.1f} MB", file=sys.stderr)
+    return record, result
+
+
+def benchmark_construction(prices: pd.DataFrame, repeat: int = 1) -> (list, PartnerSelection):
+    """
+    Times the construction of PartnerSelection, and each of its preprocessing stages on their own.
+
+    :param prices: (pd.DataFrame) : price panel
+    :param repeat: (int) : number of runs of every stage
+    :return: (tuple) : records of the stages and the constructed PartnerSelection
+    """
+
+    record, ps = measure('PartnerSelection.__init__', lambda: PartnerSelection(prices), repeat=repeat)
+    records = [record]
+
+    stages = {'_get_returns': ps._get_returns,
+              '_correlation': ps._correlation,
+              'blocked_top_k_correlations': lambda: blocked_top_k_correlations(ps.standardized_ranks, 50),
+              '_top_50_tickers': ps._top_50_tickers,
+              '_generate_all_quadruples': ps._generate_all_quadruples}
+    for name, stage in stages.items():
+        records.append(measure(f'PartnerSelection.{name}', stage, repeat=repeat)[0])
+
+    return records, ps
+
+
+def benchmark_selectors(ps: PartnerSelection, n_targets: int, num_threads: int, variants: tuple = VARIANTS,
+                        repeat: int = 1) -> list:
+    """
+    Times each of the four selectors in every requested variant. The serial variant is the original loop over
+    quadruples. The first multiprocess selector includes the start up of the worker pool.
+
+    :param ps: (PartnerSelection) : constructed partner selection
+    :param n_targets: (int) : number of target stocks to select
+    :param num_threads: (int) : number of worker processes of the multiprocess selectors
+    :param variants: (tuple) : any of 'serial', 'batch' and 'multiprocess'
+    :param repeat: (int) : number of runs of every selector
+    :return: (list) : records of the selectors
+    """
+
+    n_quadruples = n_targets * len(ps.all_quadruples.combinations)
+
+    records = []
+    for method in METHODS:
+        for variant in variants:
+            if variant == 'serial':
+                name, func = method, lambda: getattr(ps, method)(n_targets)
+            elif variant == 'batch':
+                name, func = f'{method}_batch', lambda: getattr(ps, f'{method}_batch')(n_targets)
+            else:
+                name = f'{method}_multiprocess'
+                func = lambda: getattr(ps, name)(n_targets, num_threads)
+            records.append(measure(f'PartnerSelection.{name}', func, n_quadruples, 'quadruples', repeat)[0])
+
+    ps.close()
+    return records
+
+
+def benchmark_cmpi(n_train: int, n_test: int, seed: int = 0, repeat: int = 1) -> list:
+    """
+    Times CMPI.generate_cmpi on a synthetic quadruple, with the copula model stubbed out.
+
+    :param n_train: (int) : number of days in the training window
+    :param n_test: (int) : number of trading days, i.e. rolling windows
+    :param seed: (int) : seed of the synthetic prices
+    :param repeat: (int) : number of runs
+    :return: (list) : record of CMPI.generate_cmpi
+    """
+
+    prices = generate_prices(4, n_train + n_test + 1, n_sectors=1, seed=seed)
+    returns = np.log(prices).diff().dropna()
+
+    strategy = CMPI(StubCopulaModel())
+    strategy.init_copula_model(returns[:n_train])
+    record, _ = measure('CMPI.generate_cmpi', lambda: strategy.generate_cmpi(returns[n_train:]), n_test, 'windows',
+                        repeat)
+    return [record]
+
+
+def run_benchmarks(n_tickers: int = 200, n_days: int = 260, n_targets: int = 2, num_threads: int = 4,
+                   variants: tuple = VARIANTS, n_train: int = 250, n_test: int = 250, seed: int = 0,
+                   repeat: int = 3) -> dict:
+    """
+    Runs the whole suite.
+
+    :param n_tickers: (int) : number of stocks in the synthetic universe
+    :param n_days: (int) : number of days in the synthetic universe
+    :param n_targets: (int) : number of target stocks of the selectors
+    :param num_threads: (int) : number of worker processes of the multiprocess selectors
+    :param variants: (tuple) : selector variants to time, any of 'serial', 'batch' and 'multiprocess'
+    :param n_train: (int) : number of days in the CMPI training window
+    :param n_test: (int) : number of CMPI trading days
+    :param seed: (int) : seed of the synthetic prices
+    :param repeat: (int) : number of runs of every stage
+    :return: (dict) : configuration, machine description and records of all stages
+    """
+
+    config = {'n_tickers': n_tickers, 'n_days': n_days, 'n_targets': n_targets, 'num_threads': num_threads,
+              'variants': list(variants), 'n_train': n_train, 'n_test': n_test, 'seed': seed, 'repeat': repeat}
+    machine = {'python': platform.python_version(), 'platform': platform.platform(),
+               'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+    prices = generate_prices(n_tickers, n_days, seed=seed)
+    records, ps = benchmark_construction(prices, repeat)
+    records += benchmark_selectors(ps, n_targets, num_threads, variants, repeat)
+    records += benchmark_cmpi(n_train, n_test, seed, repeat)
+
+    return {'config': config, 'machine': machine, 'results': records}
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float = 0.25,
+                          min_time: float = 0.01) -> pd.DataFrame:
+    """
+    Compares the wall times and peak RSS of a run with a baseline run of the same configuration.
+
+    :param results: (dict) : output of run_benchmarks
+    :param baseline: (dict) : output of run_benchmarks stored as baseline
+    :param tolerance: (float) : relative slowdown above which a stage is reported as a regression
+    :param min_time: (float) : stages faster than this in both runs are never regressions, as timer noise dominates
+    :return: (pd.DataFrame) : per stage, current and baseline measurements, their ratio and a regression flag
+    """
+
+    if results['config'] != baseline['config']:
+        raise Exception("Baseline was recorded with a different configuration: {}".format(baseline['config']))
+
+    current = pd.DataFrame(results['results']).set_index('stage')[['wall_time', 'peak_rss_mb']]
+    reference = pd.DataFrame(baseline['results']).set_index('stage')[['wall_time', 'peak_rss_mb']]
+    comparison = current.join(reference, rsuffix='_baseline', how='left')
+    comparison['ratio'] = comparison['wall_time'] / comparison['wall_time_baseline']
+    comparison['regression'] = (comparison['ratio'] > 1 + tolerance) & (comparison['wall_time'] >= min_time)
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, default=200, help='number of stocks in the synthetic universe')
+    parser.add_argument('--days', type=int, default=260, help='number of days in the synthetic universe')
+    parser.add_argument('--targets', type=int, default=2, help='number of target stocks of the selectors')
+    parser.add_argument('--num-threads', type=int, default=4, help='worker processes of the multiprocess selectors')
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS),
+                        help='selector variants to time')
+    parser.add_argument('--train-days', type=int, default=250, help='days in the CMPI training window')
+    parser.add_argument('--test-days', type=int, default=250, help='CMPI trading days')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic prices')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every stage, the fastest is recorded')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='path of the stored baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown reported as regression')
+    parser.add_argument('--output', help='path to write the results of this run as JSON')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.tickers, args.days, args.targets, args.num_threads, tuple(args.variants),
+                             args.train_days, args.test_days, args.seed, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(pd.DataFrame(results['results']).set_index('stage').to_string())
+        return
+
+    if not os.path.exists(args.baseline):
+        print(pd.DataFrame(results['results']).set_index('stage').to_string())
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one")
+        return
+
+    with open(args.baseline) as baseline_file:
+        comparison = compare_with_baseline(results, json.load(baseline_file), args.tolerance)
+    print(comparison.to_string())
+    if comparison['regression'].any():
+        print("Regressions in: " + ", ".join(comparison.index[comparison['regression']]))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+
+def generate_prices(n_tickers: int = 200, n_days: int = 500, n_sectors: int = 10, market_loading: float = 0.5,
+                    sector_loading: float = 0.5, volatility: float = 0.01, seed: int = 0,
+                    start: str = '2015-01-01') -> pd.DataFrame:
+    """
+    Reproducible synthetic price panel from a market and sector factor model.
+
+    Daily log returns of a stock in sector s are market_loading * M + sector_loading * S_s + e, with standard
+    normal factors and noise scaled by volatility. Stocks of the same sector are then more correlated with each
+    other than with the rest of the universe, so every target has a distinct set of most correlated partners.
+    Loadings are jittered per stock, so correlations are not tied.
+
+    :param n_tickers: (int) : number of stocks in universe
+    :param n_days: (int) : number of business days
+    :param n_sectors: (int) : number of sectors, stocks are assigned to sectors in turn
+    :param market_loading: (float) : average loading on the market factor
+    :param sector_loading: (float) : average loading on the sector factor
+    :param volatility: (float) : scale of the daily returns
+    :param seed: (int) : seed of the random generator
+    :param start: (str) : first date of the panel
+    :return: (pd.DataFrame) : prices indexed by date, one column per ticker
+    """
+
+    rng = np.random.default_rng(seed)
+
+    sectors = np.arange(n_tickers) % n_sectors
+    market = rng.standard_normal((n_days, 1))
+    sector_factors = rng.standard_normal((n_days, n_sectors))
+    noise = rng.standard_normal((n_days, n_tickers))
+
+    market_loadings = market_loading * rng.uniform(0.5, 1.5, n_tickers)
+    sector_loadings = sector_loading * rng.uniform(0.5, 1.5, n_tickers)
+    log_returns = volatility * (market * market_loadings + sector_factors[:, sectors] * sector_loadings + noise)
+
+    prices = 100 * np.exp(np.cumsum(log_returns, axis=0))
+    index = pd.bdate_range(start, periods=n_days, name='Date')
+    columns = [f'SYN{i:04d}' for i in range(n_tickers)]
+    return pd.DataFrame(prices, index=index, columns=columns)
@@ -46,6 +46,24 @@ class CVineModel:
         cvm = self.vc.RVineCopSelect(quantiles_df, familyset=family, Matrix=m)
         self.cvm = cvm
 
+    def refit(self, U, cvm=None, maxit=50):
+        """
+        Re-estimation of the parameters of a fitted C-Vine Copula Model by MLE, keeping its structure and families.
+        The optimization is warm-started from the current parameters, so it converges in a few iterations when U
+        is close to the data of the previous fit, e.g. the next rolling window.
+        U: relative rank dataframe (n by p) entre between [0,1]. First column is the target stock.
+        cvm: fitted model to start from. None (default) means the current model.
+        maxit: maximum number of iterations of the optimizer.
+        """
+        cvm = self.cvm if cvm is None else cvm
+
+        D = dict(cvm.items())
+        quantiles_df = pandas2ri.DataFrame(U)
+        result = self.vc.RVineMLE(
+            quantiles_df, cvm, start=D["par"], start2=D["par2"], maxit=maxit
+        )
+        self.cvm = result.rx2("RVM")
+
     def predict(self, U, cvm=None):
         """
         Compute h for a cvm given U
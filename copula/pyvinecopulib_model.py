@@ -0,0 +1,249 @@
+"""
+C-Vine copula model fitted in process with pyvinecopulib, with the interface of CVineModel.
+
+The structure is the fixed C-vine of CVineModel: the last column is the root of the first tree, the one before
+it the root of the second tree and so on, so that the first column, the target stock, is conditioned on all
+partners in the last tree. Families are given and reported with the codes of the R package VineCopula, and the
+family, par and par2 matrices have the layout of the RVineMatrix objects of CVineModel.
+"""
+import numpy as np
+import pandas as pd
+import pyvinecopulib as pv
+
+# VineCopula family codes of the families with a pyvinecopulib counterpart. Codes + 10, + 20 and + 30 are the
+# rotations by 180, 90 and 270 degrees, e.g. 13, 23 and 33 for the Clayton copula.
+BASE_FAMILIES = {0: pv.BicopFamily.indep, 1: pv.BicopFamily.gaussian, 2: pv.BicopFamily.student,
+                 3: pv.BicopFamily.clayton, 4: pv.BicopFamily.gumbel, 5: pv.BicopFamily.frank,
+                 6: pv.BicopFamily.joe, 7: pv.BicopFamily.bb1, 8: pv.BicopFamily.bb6, 9: pv.BicopFamily.bb7,
+                 10: pv.BicopFamily.bb8, 104: pv.BicopFamily.tawn, 204: pv.BicopFamily.tawn}
+ROTATIONS = {0: 0, 10: 180, 20: 90, 30: 270}
+# Families that are symmetric, so they are not rotated
+SYMMETRIC_FAMILIES = (0, 1, 2, 5)
+# Families with two parameters, both negated in VineCopula for rotations by 90 and 270 degrees
+TWO_PARAMETER_FAMILIES = (7, 8, 9, 10)
+
+
+def _base_code(code: int) -> int:
+    """
+    VineCopula code of the unrotated family of a family code, e.g. 3 for 23 and 104 for 124.
+    """
+
+    if code >= 100:
+        return code // 100 * 100 + 4
+    if code in SYMMETRIC_FAMILIES:
+        return code
+    return (code - 1) % 10 + 1
+
+
+def to_pv_family(code: int) -> (pv.BicopFamily, int):
+    """
+    pyvinecopulib family and rotation of a VineCopula family code.
+
+    :param code: (int) : VineCopula family code
+    :return: (tuple) : pyvinecopulib family and rotation in degrees
+    """
+
+    base = _base_code(code)
+    rotation = code - base
+    if base not in BASE_FAMILIES or rotation not in ROTATIONS or (base in SYMMETRIC_FAMILIES and rotation):
+        raise Exception("VineCopula family {} is not available in pyvinecopulib".format(code))
+    return BASE_FAMILIES[base], ROTATIONS[rotation]
+
+
+def _candidates(family: list) -> list:
+    """
+    Distinct (VineCopula code, pyvinecopulib family, rotation) candidates of a family set. Both Tawn types map to
+    the general Tawn copula of pyvinecopulib, which is kept once per rotation under the first requested code.
+    """
+
+    codes = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10] if family is None else list(family)
+    if family is None:
+        codes += [code + offset for offset in (10, 20, 30) for code in (3, 4, 6, 7, 8, 9, 10)]
+        codes += [104 + offset for offset in (0, 10, 20, 30)] + [204 + offset for offset in (0, 10, 20, 30)]
+
+    candidates, seen = [], set()
+    for code in codes:
+        pv_family, rotation = to_pv_family(code)
+        if (pv_family, rotation) not in seen:
+            seen.add((pv_family, rotation))
+            candidates.append((code, pv_family, rotation))
+    return candidates
+
+
+def _to_r_parameters(code: int, bicop: pv.Bicop) -> (float, float):
+    """
+    VineCopula par and par2 of a fitted pair copula. Tawn copulas are reported with theta as par and the
+    asymmetry parameter of their type as par2.
+    """
+
+    parameters = bicop.parameters.ravel()
+    base = _base_code(code)
+    if base in (104, 204):
+        par, par2 = parameters[2], parameters[0] if base == 104 else parameters[1]
+    else:
+        par = parameters[0] if len(parameters) > 0 else 0.
+        par2 = parameters[1] if len(parameters) > 1 else 0.
+
+    # VineCopula uses negative parameters for the rotations by 90 and 270 degrees
+    if bicop.rotation in (90, 270):
+        par = -par
+        par2 = -par2 if base in TWO_PARAMETER_FAMILIES else par2
+    return par, par2
+
+
+class PyvinecopulibCVineModel:
+    def __init__(self):
+        """
+        pyvinecopulib is required, R is not.
+
+        The fitted model is a dictionary with the entries of the RVineMatrix objects of CVineModel that are used:
+        names, family, par and par2 in the VineCopula layout, logLik, AIC and BIC, and the fitted pyvinecopulib
+        pair copulas under pair_copulas, pair_copulas[t][j] linking partner or target j with the root of tree t.
+        """
+        self.cvm = None
+
+    def _fit_pair(self, data: np.ndarray, candidates: list) -> (int, pv.Bicop):
+        """
+        Selects the pair copula with the lowest AIC among the candidates. As in VineCopula, rotations by 90 and
+        270 degrees are only considered for negative Kendall's tau, and the others only for positive tau.
+        """
+        negative = pv.utils.wdm(data[:, 0], data[:, 1], 'tau') < 0
+        best_code, best, best_aic = None, None, np.inf
+        for code, pv_family, rotation in candidates:
+            if pv_family not in (pv.BicopFamily.indep, pv.BicopFamily.gaussian, pv.BicopFamily.student,
+                                 pv.BicopFamily.frank) and (rotation in (90, 270)) != negative:
+                continue
+            bicop = pv.Bicop(pv_family, rotation)
+            bicop.fit(data)
+            aic = bicop.aic(data)
+            if aic < best_aic:
+                best_code, best, best_aic = code, bicop, aic
+        if best is None:
+            best_code, best = 0, pv.Bicop()
+        return best_code, best
+
+    def _fit(self, U, select_pair) -> dict:
+        """
+        Sequential estimation of the C-vine, tree by tree, from the h-functions of the previous tree.
+        select_pair(t, j, data) returns the VineCopula code and the fitted pair copula of an edge.
+        """
+        values = np.asarray(U, dtype=np.float64)
+        n, dimension = values.shape
+
+        family = np.zeros((dimension, dimension), dtype=int)
+        par = np.zeros((dimension, dimension))
+        par2 = np.zeros((dimension, dimension))
+        pair_copulas = []
+        loglik, npars = 0., 0.
+
+        F = values
+        for t in range(dimension - 1):
+            root = dimension - 1 - t
+            row = []
+            conditioned = np.empty((n, root))
+            for j in range(root):
+                data = np.column_stack([F[:, root], F[:, j]])
+                code, bicop = select_pair(t, j, data)
+                row.append(bicop)
+                family[root, j] = code
+                par[root, j], par2[root, j] = _to_r_parameters(code, bicop)
+                loglik += bicop.loglik(data)
+                npars += bicop.npars
+                conditioned[:, j] = bicop.hfunc1(data)
+            pair_copulas.append(row)
+            F = conditioned
+
+        return {"names": list(U.columns) if isinstance(U, pd.DataFrame) else list(range(dimension)),
+                "family": family, "par": par, "par2": par2, "pair_copulas": pair_copulas,
+                "logLik": loglik, "npars": npars, "nobs": n,
+                "AIC": -2 * loglik + 2 * npars, "BIC": -2 * loglik + np.log(n) * npars}
+
+    def fit(self, U, family=None):
+        """
+        C-Vine Copula Model fitting by sequential MLE with AIC family selection
+        U: relative rank dataframe (n by p) entre between [0,1]. First column is the target stock.
+        family: list of VineCopula family codes or None(default). None means all families available in
+        pyvinecopulib.
+        """
+        candidates = _candidates(family)
+        self.cvm = self._fit(U, lambda t, j, data: self._fit_pair(data, candidates))
+
+    def refit(self, U, cvm=None, maxit=50):
+        """
+        Re-estimation of the parameters of a fitted C-Vine Copula Model, keeping its families and rotations.
+        pyvinecopulib has no starting values for its optimizer, so the parameters are estimated sequentially
+        from scratch, which is already cheap compared to a full fit. maxit is accepted for the interface of
+        CVineModel and not used.
+        U: relative rank dataframe (n by p) entre between [0,1]. First column is the target stock.
+        cvm: fitted model to start from. None (default) means the current model.
+        """
+        cvm = self.cvm if cvm is None else cvm
+        dimension = len(cvm["names"])
+
+        def refit_pair(t, j, data):
+            bicop = pv.Bicop(cvm["pair_copulas"][t][j].family, cvm["pair_copulas"][t][j].rotation)
+            bicop.fit(data)
+            return cvm["family"][dimension - 1 - t, j], bicop
+
+        self.cvm = self._fit(U, refit_pair)
+
+    def predict(self, U, cvm=None):
+        """
+        Compute h for a cvm given U
+        h:  P( X1<x1 |x2,x3,...,xp)
+        U: relative rank dataframe (n * p). First column is the target stock. U = (x1,x2,x3,...,xp)
+        """
+        cvm = self.cvm if cvm is None else cvm
+
+        F = np.asarray(U, dtype=np.float64)
+        for row in cvm["pair_copulas"]:
+            root = F.shape[1] - 1
+            F = np.column_stack([bicop.hfunc1(np.column_stack([F[:, root], F[:, j]]))
+                                 for j, bicop in enumerate(row)])
+
+        h = F[:, 0]
+        return pd.Series(h, index=U.index, name=U.columns[0])
+
+    def summary(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        names = cvm["names"]
+        dimension = len(names)
+        rows = []
+        for t, row in enumerate(cvm["pair_copulas"]):
+            root = dimension - 1 - t
+            given = ",".join(str(names[k]) for k in range(root + 1, dimension))
+            for j, bicop in enumerate(row):
+                edge = "{},{}".format(names[root], names[j]) + ("|" + given if given else "")
+                rows.append({"tree": t + 1, "edge": edge, "family": cvm["family"][root, j],
+                             "name": bicop.family_name, "rotation": bicop.rotation,
+                             "par": cvm["par"][root, j], "par2": cvm["par2"][root, j], "tau": bicop.tau})
+        print(pd.DataFrame(rows).to_string(index=False))
+        print("logLik: {:.3f}  AIC: {:.3f}  BIC: {:.3f}".format(cvm["logLik"], cvm["AIC"], cvm["BIC"]))
+
+    def family(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return np.array(cvm["family"])
+
+    def par(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return np.array(cvm["par"])
+
+    def par2(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return np.array(cvm["par2"])
+
+    def aic(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return cvm["AIC"]
+
+    def bic(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return cvm["BIC"]
+
+    def names(self, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return list(cvm["names"])
+
+    def get_attr(self, name, cvm=None):
+        cvm = self.cvm if cvm is None else cvm
+        return np.array(cvm[name])
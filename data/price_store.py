@@ -0,0 +1,187 @@
+"""
+Columnar, memory-mapped store of daily prices.
+
+CSV files are parsed once, in parallel, into a directory with three files:
+
+- prices.f64: float64 prices of shape (n_tickers, n_days), ticker-major, so the series of a ticker is contiguous,
+- dates.npy: the sorted union of the dates of all files, as datetime64[ns],
+- tickers.json: the tickers in the order of the rows of prices.f64.
+
+Opening a store only maps the price file, so it takes milliseconds regardless of the size of the panel, and
+prices are read from disk when a slice is used.
+"""
+import json
+import os
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+PRICES_FILE = 'prices.f64'
+DATES_FILE = 'dates.npy'
+TICKERS_FILE = 'tickers.json'
+
+
+def _read_csv(path: str, index_col: str = 'Date') -> pd.DataFrame:
+    """
+    Reads a price file with a date index column, keeping its numeric columns.
+    """
+
+    prices = pd.read_csv(path, index_col=index_col, parse_dates=True)
+    prices.index = pd.DatetimeIndex(prices.index, name=index_col)
+    return prices.select_dtypes(include='number').astype(np.float64)
+
+
+class PriceStore:
+    """
+    Read-only price panel backed by a memory-mapped file.
+
+    Slices are served without copying the prices where NumPy can express them as a view of the mapped file: a
+    date range with tickers that are evenly spaced in the store, e.g. a single ticker, consecutive tickers or all
+    tickers, is a strided view. Any other selection of tickers is gathered into a new array holding only the
+    selected rows of the date range. DataFrames are built around these arrays with copy=False, which keeps them
+    views: pandas stores the columns of a float DataFrame as one (n_columns, n_rows) block, the layout of the file.
+    Views are read-only, so operations modifying prices in place need a copy, while derived data such as returns
+    are new arrays anyway.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: (str) : directory of the store, as written by PriceStore.ingest
+        """
+
+        if not os.path.exists(os.path.join(path, PRICES_FILE)):
+            raise Exception("No price store at {}".format(path))
+
+        self.path = path
+        with open(os.path.join(path, TICKERS_FILE)) as tickers_file:
+            self.tickers = json.load(tickers_file)
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(path, DATES_FILE)), name='Date')
+        self._positions = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.prices = np.memmap(os.path.join(path, PRICES_FILE), dtype=np.float64, mode='r',
+                                shape=(len(self.tickers), len(self.dates)))
+
+    @classmethod
+    def ingest(cls, paths: list, path: str, num_workers: int = 4, index_col: str = 'Date') -> 'PriceStore':
+        """
+        Parses price files in a process pool and writes them to a new store. Files can be wide panels of the
+        whole universe or files of a few tickers, such as the per-pair files, all with a date index column.
+        Non-numeric columns are ignored. Dates missing in a file are NaN. If a ticker is in several files, the
+        first file takes precedence and later files only fill its missing dates.
+
+        :param paths: (list) : paths of the CSV files
+        :param path: (str) : directory of the store, created if needed
+        :param num_workers: (int) : number of worker processes parsing the files
+        :param index_col: (str) : name of the date column
+        :return: (PriceStore) : the new store
+        """
+
+        if len(paths) == 0:
+            raise Exception("Please enter at least one price file")
+
+        if num_workers > 1 and len(paths) > 1:
+            with mp.Pool(min(num_workers, len(paths))) as pool:
+                frames = pool.starmap(_read_csv, [(file_path, index_col) for file_path in paths])
+        else:
+            frames = [_read_csv(file_path, index_col) for file_path in paths]
+
+        dates = frames[0].index
+        for frame in frames[1:]:
+            dates = dates.union(frame.index)
+        dates = dates.sort_values()
+        tickers = list(dict.fromkeys(ticker for frame in frames for ticker in frame.columns))
+        positions = {ticker: i for i, ticker in enumerate(tickers)}
+
+        os.makedirs(path, exist_ok=True)
+        prices = np.memmap(os.path.join(path, PRICES_FILE), dtype=np.float64, mode='w+',
+                           shape=(len(tickers), len(dates)))
+        prices[:] = np.nan
+        for frame in frames:
+            frame = frame[~frame.index.duplicated(keep='first')]
+            columns = frame.loc[:, ~frame.columns.duplicated(keep='first')]
+            values = columns.reindex(dates).to_numpy(dtype=np.float64).T
+            for ticker, series in zip(columns.columns, values):
+                row = prices[positions[ticker]]
+                missing = np.isnan(row)
+                row[missing] = series[missing]
+        prices.flush()
+        del prices
+
+        np.save(os.path.join(path, DATES_FILE), dates.to_numpy(dtype='datetime64[ns]'))
+        with open(os.path.join(path, TICKERS_FILE), 'w') as tickers_file:
+            json.dump(tickers, tickers_file)
+        return cls(path)
+
+    def _date_slice(self, start=None, end=None) -> slice:
+        """
+        Columns of the dates from start to end, both included as in pandas label slicing.
+        """
+
+        first = 0 if start is None else self.dates.searchsorted(pd.Timestamp(start), side='left')
+        last = len(self.dates) if end is None else self.dates.searchsorted(pd.Timestamp(end), side='right')
+        return slice(first, last)
+
+    def _ticker_rows(self, tickers: list = None):
+        """
+        Rows of the tickers, as a slice if they are evenly spaced in increasing order, else as an array.
+        """
+
+        if tickers is None:
+            return slice(0, len(self.tickers))
+
+        missing = [ticker for ticker in tickers if ticker not in self._positions]
+        if missing:
+            raise Exception("Tickers are not in the store: {}".format(', '.join(map(str, missing))))
+
+        rows = np.array([self._positions[ticker] for ticker in tickers], dtype=np.intp)
+        if len(rows) == 1:
+            return slice(rows[0], rows[0] + 1)
+        steps = np.diff(rows)
+        if steps[0] > 0 and (steps == steps[0]).all():
+            return slice(rows[0], rows[-1] + 1, steps[0])
+        return rows
+
+    def values(self, start=None, end=None, tickers: list = None) -> np.ndarray:
+        """
+        Prices of the tickers from start to end, ticker-major. A view of the mapped file if the tickers are evenly
+        spaced in the store, see the class description, and a new array otherwise.
+
+        :param start: (str/pd.Timestamp) : first date, the first date of the store by default
+        :param end: (str/pd.Timestamp) : last date, included, the last date of the store by default
+        :param tickers: (list) : tickers, all tickers of the store by default
+        :return: (np.array) : prices of shape (len(tickers), n_days)
+        """
+
+        return self.prices[self._ticker_rows(tickers), self._date_slice(start, end)]
+
+    def frame(self, start=None, end=None, tickers: list = None) -> pd.DataFrame:
+        """
+        Prices of the tickers from start to end as a DataFrame indexed by date, e.g. as input of PartnerSelection
+        or for the returns of CMPI. Built with copy=False around PriceStore.values, so it is a view whenever those
+        prices are.
+
+        :param start: (str/pd.Timestamp) : first date, the first date of the store by default
+        :param end: (str/pd.Timestamp) : last date, included, the last date of the store by default
+        :param tickers: (list) : tickers, all tickers of the store by default
+        :return: (pd.DataFrame) : prices of shape (n_days, len(tickers))
+        """
+
+        dates = self._date_slice(start, end)
+        rows = self._ticker_rows(tickers)
+        columns = self.tickers[rows] if isinstance(rows, slice) else list(tickers)
+        return pd.DataFrame(self.prices[rows, dates].T, index=self.dates[dates], columns=columns, copy=False)
+
+    def __getitem__(self, key) -> pd.DataFrame:
+        """
+        store[start:end, tickers] is store.frame(start, end, tickers), store[start:end] selects all tickers.
+        """
+
+        dates, tickers = key if isinstance(key, tuple) else (key, None)
+        if not isinstance(dates, slice) or dates.step is not None:
+            raise Exception("Please select dates with a slice of dates, e.g. store['2017-01-01':'2017-12-31']")
+        if isinstance(tickers, str):
+            tickers = [tickers]
+        return self.frame(dates.start, dates.stop, tickers)
+
+    def __len__(self) -> int:
+        return len(self.dates)
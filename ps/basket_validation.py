@@ -0,0 +1,120 @@
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.vector_ar.vecm import coint_johansen
+
+from ps.utils_multiprocess import run_chunks
+from ps.instrumentation import Instrumentation
+
+VALIDATION_COLUMNS = ['quadruple', 'target', 'start', 'end', 'trace_stat', 'trace_crit_95', 'max_eig_stat',
+                      'max_eig_crit_95', 'rank', 'max_eig_rank', 'vector']
+
+
+def get_windows(n_days: int, window: int = None, step: int = None) -> list:
+    """
+    Rolling (start, stop) windows of a number of days. The last window ends on the last day, and earlier windows
+    end every step days before it.
+
+    :param n_days: (int) : number of days
+    :param window: (int) : number of days in a window, None for a single window over all days
+    :param step: (int) : number of days between the ends of consecutive windows, window by default
+    :return: (list) : list of (start, stop) tuples, oldest first
+    """
+
+    if window is None or window >= n_days:
+        return [(0, n_days)]
+    step = window if step is None else step
+    return [(stop - window, stop) for stop in range(n_days, window - 1, -step)][::-1]
+
+
+def _johansen_rank(statistics: np.ndarray, critical_values: np.ndarray) -> int:
+    """
+    Cointegration rank of a sequence of tests of rank <= r against a larger rank: the first r not rejected.
+    """
+
+    accepted = np.flatnonzero(statistics <= critical_values)
+    return int(accepted[0]) if len(accepted) else len(statistics)
+
+
+def johansen_windows(log_prices: np.ndarray, windows: list, det_order: int = 0, k_ar_diff: int = 1) -> list:
+    """
+    Johansen trace and maximum eigenvalue tests of a basket over windows.
+
+    :param log_prices: (np.array) : log prices of the basket of shape (n, k), target first
+    :param windows: (list) : (start, stop) rows of every window
+    :param det_order: (int) : deterministic terms of coint_johansen, -1 none, 0 constant, 1 linear trend
+    :param k_ar_diff: (int) : number of lagged differences of the VECM
+    :return: (list) : per window, the test statistics, their 95% critical values, the ranks of both tests and the
+        first cointegrating vector, scaled so that the coefficient of the target is 1
+    """
+
+    results = []
+    for start, stop in windows:
+        johansen = coint_johansen(log_prices[start:stop], det_order, k_ar_diff)
+        vector = johansen.evec[:, 0]
+        if vector[0] != 0:
+            vector = vector / vector[0]
+        results.append({'trace_stat': johansen.lr1, 'trace_crit_95': johansen.cvt[:, 1],
+                        'max_eig_stat': johansen.lr2, 'max_eig_crit_95': johansen.cvm[:, 1],
+                        'rank': _johansen_rank(johansen.lr1, johansen.cvt[:, 1]),
+                        'max_eig_rank': _johansen_rank(johansen.lr2, johansen.cvm[:, 1]),
+                        'vector': vector})
+    return results
+
+
+def validate_baskets(prices: pd.DataFrame, quadruples, window: int = None, step: int = None, det_order: int = 0,
+                     k_ar_diff: int = 1, num_workers: int = 1, instrumentation: Instrumentation = None) -> pd.DataFrame:
+    """
+    Validates selected baskets with Johansen cointegration tests on their log prices over rolling windows.
+
+    Baskets are tested independently, so with num_workers they are spread over a process pool, each worker
+    receiving only the prices of its basket. Days on which a price of the basket is missing are dropped.
+
+    :param prices: (pd.DataFrame) : price series of all stocks in the baskets
+    :param quadruples: (list/pd.DataFrame) : baskets of tickers, target first, e.g. the output of
+        PartnerSelection.extremal, or a DataFrame with a 'quadruple' column as returned by resolve_selection or
+        read_selection_results
+    :param window: (int) : number of days in a window, None for a single window over all days
+    :param step: (int) : number of days between the ends of consecutive windows, window by default
+    :param det_order: (int) : deterministic terms of coint_johansen, -1 none, 0 constant, 1 linear trend
+    :param k_ar_diff: (int) : number of lagged differences of the VECM
+    :param num_workers: (int) : number of worker processes, 1 runs the tests in this process
+    :param instrumentation: (Instrumentation) : receiver of the progress of the worker processes
+    :return: (pd.DataFrame) : per basket and window, the quadruple, its target, the first and last date of the
+        window, the trace and maximum eigenvalue statistics with their 95% critical values, the cointegration
+        ranks of both tests and the first cointegrating vector
+    """
+
+    if isinstance(quadruples, pd.DataFrame):
+        quadruples = quadruples['quadruple'].tolist()
+    quadruples = [list(quadruple) for quadruple in quadruples]
+
+    missing = sorted(set(ticker for quadruple in quadruples for ticker in quadruple) - set(prices.columns))
+    if missing:
+        raise Exception("Prices are missing for tickers: {}".format(', '.join(missing)))
+
+    baskets = []
+    for quadruple in quadruples:
+        basket_prices = prices.loc[:, quadruple].dropna(how='any')
+        if (basket_prices <= 0).any().any():
+            raise Exception("Prices must be positive to take logarithms, see basket {}".format(quadruple))
+        baskets.append((basket_prices.index, np.log(basket_prices.to_numpy(dtype=np.float64)),
+                        get_windows(len(basket_prices), window, step)))
+
+    args_list = [(log_prices, windows, det_order, k_ar_diff) for _, log_prices, windows in baskets]
+    if num_workers > 1:
+        instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        with mp.Pool(num_workers) as pool:
+            results = run_chunks(pool, johansen_windows, args_list,
+                                 [len(windows) for _, _, windows in baskets], 'validate_baskets', instrumentation,
+                                 'windows')
+    else:
+        results = [johansen_windows(*args) for args in args_list]
+
+    rows = []
+    for quadruple, (dates, _, windows), basket_results in zip(quadruples, baskets, results):
+        for (start, stop), result in zip(windows, basket_results):
+            rows.append(dict(quadruple=quadruple, target=quadruple[0], start=dates[start], end=dates[stop - 1],
+                             **result))
+    return pd.DataFrame(rows, columns=VALIDATION_COLUMNS)
@@ -0,0 +1,464 @@
+import itertools
+import numpy as np
+
+from ps.ps_utils import func
+
+# Upper bound on the size of the temporary arrays allocated for a single batch of quadruples.
+DEFAULT_MAX_CHUNK_BYTES = 64 * 1024 ** 2
+# Upper bound on the size of the rows gathered for a batch of cohorts by batch_all_measures, which are read once per
+# measure, so they are kept small enough to stay in cache.
+GATHER_CHUNK_BYTES = 4 * 1024 ** 2
+
+
+def get_partner_combinations(n_partners: int = 50, n_select: int = 3) -> np.ndarray:
+    """
+    Generates all combinations of partner positions in the same order as itertools.combinations.
+
+    :param n_partners: (int) : number of candidate partners per target
+    :param n_select: (int) : number of partners in each combination
+    :return: (np.array) : combinations of shape (C(n_partners, n_select), n_select)
+    """
+
+    combinations = itertools.chain.from_iterable(itertools.combinations(range(n_partners), n_select))
+    return np.fromiter(combinations, dtype=np.intp).reshape(-1, n_select)
+
+
+def get_cohort_members(combinations: np.ndarray) -> np.ndarray:
+    """
+    Converts partner combinations into positions of a local (target + partners) block,
+    where position 0 is the target and position i + 1 is the i-th partner.
+
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :return: (np.array) : cohort members of shape (m, k + 1)
+    """
+
+    combinations = np.asarray(combinations, dtype=np.intp)
+    members = np.zeros((combinations.shape[0], combinations.shape[1] + 1), dtype=np.intp)
+    members[:, 1:] = combinations + 1
+    return members
+
+
+def get_chunk_size(bytes_per_item: int, max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> int:
+    """
+    Number of items that can be processed in one batch without exceeding the memory cap.
+
+    :param bytes_per_item: (int) : temporary memory needed for a single item
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (int) : chunk size, at least 1
+    """
+
+    return max(1, int(max_chunk_bytes // max(1, bytes_per_item)))
+
+
+def batch_sum_correlations(corr_block: np.ndarray, combinations: np.ndarray,
+                           max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> np.ndarray:
+    """
+    Batch version of ps_utils.get_sum_correlations. Scores every cohort of a target in chunks.
+    The summation order is the same as in get_sum_correlations, so the results are identical.
+
+    :param corr_block: (np.array) : correlation matrix of the target (row 0) and its partners (rows 1..)
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (np.array) : sum of pairwise correlations of each cohort, shape (m,)
+    """
+
+    members = get_cohort_members(combinations)
+    m, d = members.shape
+    scores = np.empty(m)
+    chunk_size = get_chunk_size(d * d * corr_block.itemsize, max_chunk_bytes)
+    for start in range(0, m, chunk_size):
+        chunk = members[start:start + chunk_size]
+        block = corr_block[chunk[:, :, None], chunk[:, None, :]]  # Shape : (chunk, d, d)
+        scores[start:start + chunk_size] = (block.sum(axis=1).sum(axis=1) - d) / 2
+
+    return scores
+
+
+def _batch_product_sums(columns: np.ndarray, combinations: np.ndarray, max_chunk_bytes: int) -> np.ndarray:
+    """
+    Sums over samples of the row products of the target column and the partner columns in each combination.
+
+    :param columns: (np.array) : target column (column 0) and partner columns (columns 1..), shape (n, P + 1)
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (np.array) : sums of row products, shape (m,)
+    """
+
+    n = columns.shape[0]
+    m, k = combinations.shape
+    partners = columns[:, 1:]
+    weighted_partners = partners * columns[:, :1]  # Partial products with the target, computed once per target
+    sums = np.empty(m)
+    chunk_size = get_chunk_size(2 * n * columns.itemsize, max_chunk_bytes)
+    for start in range(0, m, chunk_size):
+        chunk = combinations[start:start + chunk_size]
+        product = weighted_partners[:, chunk[:, 0]]  # Shape : (n, chunk)
+        for j in range(1, k - 1):
+            product = product * partners[:, chunk[:, j]]
+        if k > 1:
+            sums[start:start + chunk_size] = np.einsum('ij,ij->j', product, partners[:, chunk[:, k - 1]])
+        else:
+            sums[start:start + chunk_size] = product.sum(axis=0)
+
+    return sums
+
+
+def batch_multivariate_rho(u_block: np.ndarray, combinations: np.ndarray,
+                           max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> np.ndarray:
+    """
+    Batch version of ps_utils.multivariate_rho for every cohort of a target.
+
+    The partial products of the target with each partner are computed once, so the row products of rho_1 and
+    rho_2 are chunked einsum contractions over the partner columns. The pairwise sums of rho_3 are entries of the
+    Gram matrix of the (1 - u) columns.
+
+    :param u_block: (np.array) : quantiles of the target (column 0) and its partners (columns 1..), shape (n, P + 1)
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (np.array) : mean of the three estimators of multivariate rho for each cohort, shape (m,)
+    """
+
+    combinations = np.asarray(combinations, dtype=np.intp)
+    n = u_block.shape[0]
+    d = combinations.shape[1] + 1
+    h_d = (d + 1) / ((2 ** d) - d - 1)
+    one_minus_u = 1 - u_block
+
+    # Calculating the first estimator of multivariate rho
+    sum_1 = _batch_product_sums(one_minus_u, combinations, max_chunk_bytes)
+    rho_1 = h_d * (-1 + (((2 ** d) / n) * sum_1))
+
+    # Calculating the second estimator of multivariate rho
+    sum_2 = _batch_product_sums(u_block, combinations, max_chunk_bytes)
+    rho_2 = h_d * (-1 + (((2 ** d) / n) * sum_2))
+
+    # Calculating the third estimator of multivariate rho from the Gram matrix of the (1 - u) columns
+    gram = one_minus_u.T @ one_minus_u
+    members = get_cohort_members(combinations)
+    sum_3 = np.zeros(len(members))
+    for k, l in itertools.combinations(range(d), 2):
+        sum_3 += gram[members[:, k], members[:, l]]
+    dc2 = d * (d - 1) // 2
+    rho_3 = -3 + (12 / (n * dc2)) * sum_3
+
+    return (rho_1 + rho_2 + rho_3) / 3
+
+
+def batch_diagonal_measure(points_block: np.ndarray, combinations: np.ndarray,
+                           max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> np.ndarray:
+    """
+    Batch version of ps_utils.diagonal_measure for every cohort of a target.
+
+    The distance from a point x to the main diagonal of d-dimensional space is sqrt(||x||^2 - (sum x)^2 / d),
+    so only the per-sample sums and squared sums of each cohort are needed. The partial sums of the target
+    with each partner are computed once per target.
+
+    :param points_block: (np.array) : ranked returns of the target (column 0) and its partners (columns 1..),
+        shape (n, P + 1)
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (np.array) : total euclidean distance of each cohort, shape (m,)
+    """
+
+    combinations = np.asarray(combinations, dtype=np.intp)
+    n = points_block.shape[0]
+    m, k = combinations.shape
+    d = k + 1
+    # Stock-major layout, so that gathering a partner copies one contiguous row
+    partners = np.ascontiguousarray(points_block[:, 1:].T)  # Shape : (P, n)
+    squared_partners = partners ** 2
+    target_sums = partners + points_block[:, 0]
+    target_squared_sums = squared_partners + points_block[:, 0] ** 2
+
+    measures = np.empty(m)
+    chunk_size = get_chunk_size(3 * n * points_block.itemsize, max_chunk_bytes)
+    for start in range(0, m, chunk_size):
+        chunk = combinations[start:start + chunk_size]
+        sums = target_sums[chunk[:, 0]]  # Shape : (chunk, n)
+        squared_sums = target_squared_sums[chunk[:, 0]]
+        for j in range(1, k):
+            sums += partners[chunk[:, j]]
+            squared_sums += squared_partners[chunk[:, j]]
+        squared_distances = squared_sums - sums ** 2 / d
+        measures[start:start + len(chunk)] = np.sqrt(np.maximum(squared_distances, 0)).sum(axis=1)
+
+    return measures
+
+
+def get_extremal_basis(u: np.ndarray) -> np.ndarray:
+    """
+    Evaluates both equation forms of ps_utils.func for every sample and stock. The forms only depend
+    on the ranked returns, so they are computed once per formation window.
+
+    :param u: (np.array) : ranked returns of shape (n, N)
+    :return: (np.array) : basis of shape (n, N, 2), with func(u, 1) and func(u, 2) along the last axis
+    """
+
+    return np.stack([func(u, 1), func(u, 2)], axis=-1)
+
+
+def _basis_products(partners: np.ndarray, tuples: np.ndarray) -> np.ndarray:
+    """
+    Outer products of the partner bases in each tuple, in the order of itertools.product.
+
+    :param partners: (np.array) : partner bases of shape (n, P, 2)
+    :param tuples: (np.array) : partner tuples of shape (m, j)
+    :return: (np.array) : products of shape (n, m, 2^j)
+    """
+
+    n = partners.shape[0]
+    product = np.ones((n, len(tuples), 1))
+    for j in range(tuples.shape[1]):
+        product = (product[..., None] * partners[:, tuples[:, j], None, :]).reshape(n, len(tuples), -1)
+
+    return product
+
+
+def batch_extremal_measure(basis_block: np.ndarray, combinations: np.ndarray, co_variance_matrix: np.ndarray,
+                           max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> np.ndarray:
+    """
+    Batch version of ps_utils.extremal_measure for every cohort of a target.
+
+    Each cohort is split into the target with its first partner, and the remaining partners. The products
+    of the target basis with every partner basis are computed once per target, and the products of the
+    remaining partners once per distinct tuple. T_(d,n) of all cohorts then follows from matrix products
+    of the two over the samples, computed in chunks of tuples, and is finished with a batched quadratic
+    form with the (inverse) covariance matrix.
+
+    :param basis_block: (np.array) : basis of the target (index 0) and its partners (indices 1..), shape (n, P + 1, 2)
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :param co_variance_matrix: (np.array) : matrix of shape (2^(k + 1), 2^(k + 1)) from get_co_variance_matrix
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (np.array) : test statistic of each cohort, shape (m,)
+    """
+
+    combinations = np.asarray(combinations, dtype=np.intp)
+    n = basis_block.shape[0]
+    m, k = combinations.shape
+    n_partners = basis_block.shape[1] - 1
+    partners = basis_block[:, 1:, :]
+    # Products of the target forms with the forms of every partner, shape (n, P * 4)
+    target_partners = (basis_block[:, :1, :, None] * partners[:, :, None, :]).reshape(n, -1)
+
+    measures = np.empty(m)
+    if m == 0:
+        return measures
+    tuples, tuple_index = np.unique(combinations[:, 1:], axis=0, return_inverse=True)
+    tuple_index = tuple_index.reshape(-1)
+    order = np.argsort(tuple_index, kind='stable')
+    bounds = np.searchsorted(tuple_index[order], np.arange(len(tuples) + 1))
+    width = 2 ** (k - 1)  # Number of products of the remaining partners
+
+    chunk_size = get_chunk_size((n + 4 * n_partners) * width * basis_block.itemsize, max_chunk_bytes)
+    for start in range(0, len(tuples), chunk_size):
+        stop = min(start + chunk_size, len(tuples))
+        products = _basis_products(partners, tuples[start:stop]).reshape(n, -1)
+        # T_(d,n) of every (target, partner, tuple) triple in the chunk
+        t_all = (target_partners.T @ products / n).reshape(n_partners, 4, stop - start, width)
+
+        cohorts = order[bounds[start]:bounds[stop]]
+        t = t_all[combinations[cohorts, 0], :, tuple_index[cohorts] - start, :].reshape(len(cohorts), -1)
+        measures[cohorts] = n * np.einsum('ij,jk,ik->i', t, co_variance_matrix, t)
+
+    return measures
+
+
+def batch_all_measures(corr_block: np.ndarray, u_block: np.ndarray, points_block: np.ndarray,
+                       combinations: np.ndarray, co_variance_matrix: np.ndarray,
+                       max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES) -> dict:
+    """
+    Calculates the measures of all four partner selection approaches for every cohort of a target in a single
+    pass over the combinations.
+
+    Cohorts are visited in chunks of the tuples of their remaining partners, as in batch_extremal_measure. The
+    cohorts of a chunk are sliced once, and the quantile and ranked return rows of their members are gathered
+    once. All four measures are computed from these gathered blocks: the sum of correlations from the correlation
+    block, the row products and the Gram matrix of the (1 - u) columns for multivariate rho, the per-sample sums
+    and squared sums for the diagonal measure, and T_(d,n) from the extremal basis of the ranked returns.
+
+    :param corr_block: (np.array) : correlation matrix of the target (row 0) and its partners (rows 1..)
+    :param u_block: (np.array) : quantiles of the target (column 0) and its partners, shape (n, P + 1)
+    :param points_block: (np.array) : ranked returns of the target (column 0) and its partners, shape (n, P + 1)
+    :param combinations: (np.array) : partner combinations of shape (m, k)
+    :param co_variance_matrix: (np.array) : matrix of shape (2^(k + 1), 2^(k + 1)) from get_co_variance_matrix
+    :param max_chunk_bytes: (int) : memory cap for a single batch
+    :return: (dict) : measures of shape (m,) for 'traditional', 'extended', 'geometric' and 'extremal'
+    """
+
+    combinations = np.asarray(combinations, dtype=np.intp)
+    n = points_block.shape[0]
+    m, k = combinations.shape
+    d = k + 1
+    n_partners = points_block.shape[1] - 1
+    measures = {procedure: np.empty(m) for procedure in ('traditional', 'extended', 'geometric', 'extremal')}
+    if m == 0:
+        return measures
+
+    h_d = (d + 1) / ((2 ** d) - d - 1)
+    dc2 = d * (d - 1) // 2
+    # Stock-major layouts, so that gathering a cohort member copies one contiguous row
+    u_rows = np.ascontiguousarray(u_block.T)  # Shape : (P + 1, n)
+    points_rows = np.ascontiguousarray(points_block.T)
+    gram = (1 - u_block).T @ (1 - u_block)  # Pairwise sums of the third estimator of multivariate rho
+    basis = get_extremal_basis(points_block)  # Shape : (n, P + 1, 2)
+    partners = basis[:, 1:, :]
+    # Products of the target forms with the forms of every partner, shape (n, P * 4)
+    target_partners = (basis[:, :1, :, None] * partners[:, :, None, :]).reshape(n, -1)
+
+    tuples, tuple_index = np.unique(combinations[:, 1:], axis=0, return_inverse=True)
+    tuple_index = tuple_index.reshape(-1)
+    order = np.argsort(tuple_index, kind='stable')
+    bounds = np.searchsorted(tuple_index[order], np.arange(len(tuples) + 1))
+    width = 2 ** (k - 1)  # Number of products of the remaining partners
+
+    # Chunks are limited both in tuples, for the extremal products, and in cohorts, for the gathered rows
+    tuple_chunk_size = get_chunk_size((n + 4 * n_partners) * width * basis.itemsize, max_chunk_bytes)
+    cohort_chunk_size = get_chunk_size(4 * d * n * points_block.itemsize, min(max_chunk_bytes, GATHER_CHUNK_BYTES))
+    start = 0
+    while start < len(tuples):
+        stop = min(start + tuple_chunk_size, len(tuples),
+                   max(start + 1, np.searchsorted(bounds, bounds[start] + cohort_chunk_size, side='right') - 1))
+        cohorts = order[bounds[start]:bounds[stop]]
+        members = get_cohort_members(combinations[cohorts])  # Shape : (chunk, d)
+        # Member-major, so that the rows of a member across the cohorts are contiguous
+        u = u_rows[members.T]  # Shape : (d, chunk, n)
+        points = points_rows[members.T]
+
+        # Traditional approach, sum of pairwise correlations
+        block = corr_block[members[:, :, None], members[:, None, :]]
+        measures['traditional'][cohorts] = (block.sum(axis=1).sum(axis=1) - d) / 2
+
+        # Extended approach, mean of the three estimators of multivariate rho, and geometric approach, total
+        # distance to the diagonal from the per-sample sums and squared sums, accumulated member by member
+        product_1, product_2 = 1 - u[0], u[0].copy()
+        sums, squared_sums = points[0].copy(), points[0] ** 2
+        scratch = np.empty_like(sums)  # Reused for the temporaries of every member
+        sum_3 = np.zeros(len(cohorts))
+        for j in range(1, d):
+            product_1 *= np.subtract(1, u[j], out=scratch)
+            product_2 *= u[j]
+            sums += points[j]
+            squared_sums += np.square(points[j], out=scratch)
+            for i in range(j):
+                sum_3 += gram[members[:, i], members[:, j]]
+        rho_1 = h_d * (-1 + (((2 ** d) / n) * product_1.sum(axis=1)))
+        rho_2 = h_d * (-1 + (((2 ** d) / n) * product_2.sum(axis=1)))
+        rho_3 = -3 + (12 / (n * dc2)) * sum_3
+        measures['extended'][cohorts] = (rho_1 + rho_2 + rho_3) / 3
+        measures['geometric'][cohorts] = np.sqrt(np.maximum(squared_sums - sums ** 2 / d, 0)).sum(axis=1)
+
+        # Extremal approach, T_(d,n) of every (target, partner, tuple) triple in the chunk, followed by a batched
+        # quadratic form with the (inverse) covariance matrix
+        products = _basis_products(partners, tuples[start:stop]).reshape(n, -1)
+        t_all = (target_partners.T @ products / n).reshape(n_partners, 4, stop - start, width)
+        t = t_all[combinations[cohorts, 0], :, tuple_index[cohorts] - start, :].reshape(len(cohorts), -1)
+        measures['extremal'][cohorts] = n * np.einsum('ij,jk,ik->i', t, co_variance_matrix, t)
+        start = stop
+
+    return measures
+
+
+def get_selection_dtype(cohort_size: int = 4) -> np.dtype:
+    """
+    Structured dtype of the top k selection results: the position of the target in the universe, the rank of
+    the cohort for that target, the universe positions of the cohort members (target first) and the measure.
+
+    :param cohort_size: (int) : number of stocks in a cohort
+    :return: (np.dtype) : structured dtype
+    """
+
+    return np.dtype([('target', np.int32), ('rank', np.int32), ('members', np.int32, (cohort_size,)),
+                     ('score', np.float64)])
+
+
+class StreamingTopK:
+    """
+    Bounded accumulator of the k best measures and their positions, e.g. positions in the combination index.
+
+    Measures are merged in batches, keeping at most k entries, so memory does not grow with the number of
+    scored cohorts. Ties are broken by the lowest position, which keeps the first best cohort as in the serial
+    procedures. Accumulators filled by different workers are combined with merge().
+    """
+
+    BUFFER_SIZE = 4096  # Number of single measures buffered by push_one before they are merged
+
+    def __init__(self, k: int = 1, largest: bool = True):
+        """
+        :param k: (int) : number of best measures to keep
+        :param largest: (bool) : whether the highest or the lowest measures are the best
+        """
+
+        self.k = k
+        self.largest = largest
+        self.positions = np.empty(0, dtype=np.int64)
+        self.scores = np.empty(0)
+        self._buffer = []
+
+    def push(self, scores: np.ndarray, positions: np.ndarray = None, offset: int = 0):
+        """
+        Merges a batch of measures.
+
+        :param scores: (np.array) : measures
+        :param positions: (np.array) : positions of the measures, by default offset, offset + 1, ...
+        :param offset: (int) : position of the first measure if positions is not given
+        """
+
+        scores = np.asarray(scores, dtype=np.float64)
+        if positions is None:
+            positions = np.arange(offset, offset + len(scores), dtype=np.int64)
+        self._merge(scores, np.asarray(positions, dtype=np.int64))
+
+    def push_one(self, score: float, position: int):
+        """
+        Adds a single measure, merged together with the next BUFFER_SIZE measures.
+        """
+
+        self._buffer.append((score, position))
+        if len(self._buffer) >= self.BUFFER_SIZE:
+            self._flush()
+
+    def merge(self, other: 'StreamingTopK'):
+        """
+        Merges the measures kept by another accumulator.
+        """
+
+        other._flush()
+        self._merge(other.scores, other.positions)
+
+    @property
+    def threshold(self) -> float:
+        """
+        The k-th best measure, or the worst possible measure while fewer than k measures are kept.
+        """
+
+        self._flush()
+        if len(self.scores) < self.k:
+            return -np.inf if self.largest else np.inf
+        return self.scores[-1]
+
+    def result(self) -> tuple:
+        """
+        :return: (tuple) : positions and measures of the best cohorts, best first
+        """
+
+        self._flush()
+        return self.positions, self.scores
+
+    def _flush(self):
+        if self._buffer:
+            scores, positions = zip(*self._buffer)
+            self._buffer = []
+            self._merge(np.array(scores, dtype=np.float64), np.array(positions, dtype=np.int64))
+
+    def _merge(self, scores: np.ndarray, positions: np.ndarray):
+        scores = np.concatenate([self.scores, scores])
+        positions = np.concatenate([self.positions, positions])
+        keys = -scores if self.largest else scores
+        if len(keys) > self.k:
+            # Discarding everything worse than the k-th best key before sorting, keeping ties at the boundary
+            boundary = np.partition(keys, self.k - 1)[self.k - 1]
+            keep = ~(keys > boundary)
+            scores, positions, keys = scores[keep], positions[keep], keys[keep]
+        order = np.lexsort((positions, keys))[:self.k]
+        self.scores = scores[order]
+        self.positions = positions[order]
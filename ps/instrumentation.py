@@ -0,0 +1,180 @@
+import contextlib
+import logging
+import time
+
+
+class Instrumentation:
+    """
+    Pluggable reporting of timings and progress of the partner selection procedures.
+
+    Every report is an event dictionary with the name of the event under 'event', passed to the callback and
+    written to the logger if they are given. Without either, which is the default, nothing is reported. Events:
+
+    - 'stage': a preprocessing stage finished, with its 'name' and duration in 'seconds'.
+    - 'target': all quadruples of a 'target' of procedure 'name' are scored, with the latency of the target in
+      'seconds', the number of 'items' scored, 'items_per_sec', the 'completed' and 'total' units (targets, or
+      quadruples for procedures reporting chunks) and the 'eta' in seconds of the procedure.
+    - 'chunk': a worker process scored a chunk of quadruples, with its 'worker' id, 'items', 'seconds' and
+      'items_per_sec' of the chunk, the number of chunks still waiting in 'queue_depth', 'completed' and 'total'
+      items and the 'eta' in seconds.
+    - 'done': a procedure finished, with the total 'seconds', 'items' and 'items_per_sec', and the
+      'worker_items_per_sec' of every worker if the procedure ran in worker processes.
+    """
+
+    def __init__(self, callback=None, logger: logging.Logger = None, level: int = logging.INFO):
+        """
+        :param callback: (callable) : called with every event dictionary
+        :param logger: (logging.Logger) : logger the events are written to
+        :param level: (int) : logging level of the events
+        """
+
+        self.callback = callback
+        self.logger = logger
+        self.level = level
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Whether events are reported anywhere.
+        """
+
+        return self.callback is not None or self.logger is not None
+
+    def emit(self, event: str, **fields):
+        """
+        Reports an event.
+
+        :param event: (str) : name of the event
+        :param fields: (dict) : fields of the event
+        """
+
+        if not self.enabled:
+            return
+
+        fields = dict(event=event, **fields)
+        if self.callback is not None:
+            self.callback(fields)
+        if self.logger is not None:
+            self.logger.log(self.level, ' '.join(f'{key}={_format_field(value)}' for key, value in fields.items()))
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Context manager that reports the duration of a stage.
+
+        :param name: (str) : name of the stage
+        """
+
+        start = time.perf_counter()
+        yield
+        self.emit('stage', name=name, seconds=time.perf_counter() - start)
+
+    def progress(self, name: str, total: int, unit: str = 'targets') -> 'ProgressTracker':
+        """
+        Tracker of the progress of a procedure.
+
+        :param name: (str) : name of the procedure
+        :param total: (int) : total number of units, i.e. targets or quadruples
+        :param unit: (str) : 'targets' or 'quadruples'
+        :return: (ProgressTracker) : progress tracker
+        """
+
+        return ProgressTracker(self, name, total, unit)
+
+
+class ProgressTracker:
+    """
+    Progress of a single procedure, with latency and rates of targets or worker chunks and the estimated time
+    to completion, reported through an Instrumentation.
+    """
+
+    def __init__(self, instrumentation: Instrumentation, name: str, total: int, unit: str = 'targets'):
+        """
+        :param instrumentation: (Instrumentation) : receiver of the events
+        :param name: (str) : name of the procedure
+        :param total: (int) : total number of units, i.e. targets or quadruples
+        :param unit: (str) : 'targets' or 'quadruples'
+        """
+
+        self.instrumentation = instrumentation
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.completed = 0
+        self.items = 0
+        self.start = time.perf_counter()
+        self._last = self.start
+        self._worker_items = {}
+        self._worker_seconds = {}
+
+    @property
+    def eta(self) -> float:
+        """
+        Estimated seconds until all units are completed, from the average rate so far.
+        """
+
+        if self.completed == 0:
+            return float('nan')
+        return (time.perf_counter() - self.start) / self.completed * (self.total - self.completed)
+
+    def target(self, target: str, items: int, seconds: float = None):
+        """
+        Reports a completed target. Targets count towards the progress if the unit of the tracker is targets.
+
+        :param target: (str) : target stock ticker
+        :param items: (int) : number of quadruples scored for the target
+        :param seconds: (float) : latency of the target, by default the time since the previous target
+        """
+
+        now = time.perf_counter()
+        if seconds is None:
+            seconds = now - self._last
+        self._last = now
+        if self.unit == 'targets':
+            self.completed += 1
+            self.items += items
+        if self.instrumentation.enabled:
+            self.instrumentation.emit('target', name=self.name, target=target, seconds=seconds, items=items,
+                                      items_per_sec=items / seconds if seconds > 0 else float('inf'),
+                                      completed=self.completed, total=self.total, eta=self.eta)
+
+    def chunk(self, worker: int, items: int, seconds: float, queue_depth: int):
+        """
+        Reports a chunk of quadruples completed by a worker process.
+
+        :param worker: (int) : id of the worker process
+        :param items: (int) : number of quadruples in the chunk
+        :param seconds: (float) : time the worker spent on the chunk
+        :param queue_depth: (int) : number of chunks that are not completed yet
+        """
+
+        self.completed += items
+        self.items += items
+        self._worker_items[worker] = self._worker_items.get(worker, 0) + items
+        self._worker_seconds[worker] = self._worker_seconds.get(worker, 0) + seconds
+        if self.instrumentation.enabled:
+            self.instrumentation.emit('chunk', name=self.name, worker=worker, items=items, seconds=seconds,
+                                      items_per_sec=items / seconds if seconds > 0 else float('inf'),
+                                      queue_depth=queue_depth, completed=self.completed, total=self.total,
+                                      eta=self.eta)
+
+    def done(self):
+        """
+        Reports the completion of the procedure.
+        """
+
+        seconds = time.perf_counter() - self.start
+        fields = dict(name=self.name, seconds=seconds, items=self.items,
+                      items_per_sec=self.items / seconds if seconds > 0 else float('inf'))
+        if self._worker_items:
+            fields['worker_items_per_sec'] = {worker: self._worker_items[worker] / max(worker_seconds, 1e-12)
+                                              for worker, worker_seconds in self._worker_seconds.items()}
+        self.instrumentation.emit('done', **fields)
+
+
+def _format_field(value) -> str:
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    if isinstance(value, dict):
+        return '{' + ','.join(f'{key}:{_format_field(item)}' for key, item in value.items()) + '}'
+    return str(value)
@@ -0,0 +1,203 @@
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.adfvalues import mackinnonp
+
+from ps.ps_utils import standardize_columns
+from ps.utils_multiprocess import get_task_chunks, run_chunks
+from ps.instrumentation import Instrumentation
+
+PAIR_COLUMNS = ['target', 'partner', 'ssd', 'corr_distance', 'hedge_ratio', 'intercept', 'adf_stat', 'p_value']
+
+
+def normalized_prices(prices: pd.DataFrame) -> np.ndarray:
+    """
+    Prices scaled to start at 1, i.e. cumulative total return indices, as used for the distance approach.
+
+    :param prices: (pd.DataFrame) : price series without missing values
+    :return: (np.array) : normalized prices of shape (n, N)
+    """
+
+    values = prices.to_numpy(dtype=np.float64)
+    return values / values[0]
+
+
+def ssd_matrix(normalized: np.ndarray) -> np.ndarray:
+    """
+    Sums of squared differences between all pairs of normalized price series, from their Gram matrix:
+    |x_i - x_j|^2 = |x_i|^2 + |x_j|^2 - 2 x_i . x_j. Rounding can make a difference slightly negative, so the
+    result is clipped at 0.
+
+    :param normalized: (np.array) : normalized prices of shape (n, N)
+    :return: (np.array) : SSD matrix of shape (N, N), with zeros on the diagonal
+    """
+
+    gram = normalized.T @ normalized
+    norms = np.diag(gram)
+    ssd = np.maximum(norms[:, None] + norms[None, :] - 2 * gram, 0)
+    np.fill_diagonal(ssd, 0)
+    return ssd
+
+
+def correlation_distance_matrix(prices: np.ndarray) -> np.ndarray:
+    """
+    Correlation distances, 1 - Pearson correlation, between all pairs of price series, as
+    scipy.spatial.distance.correlation for a single pair.
+
+    :param prices: (np.array) : prices of shape (n, N)
+    :return: (np.array) : correlation distance matrix of shape (N, N)
+    """
+
+    standardized = standardize_columns(prices)
+    return 1 - standardized.T @ standardized
+
+
+def batch_engle_granger(y: np.ndarray, x: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    First step of the Engle-Granger test for many pairs at once, the OLS regressions y = intercept + beta * x.
+
+    :param y: (np.array) : prices of the targets, of shape (n, P)
+    :param x: (np.array) : prices of the partners, of shape (n, P)
+    :return: (tuple) :
+        hedge_ratio : (np.array) : slopes beta, of shape (P,)
+        intercept : (np.array) : intercepts, of shape (P,)
+        residuals : (np.array) : spreads y - intercept - beta * x, of shape (n, P)
+    """
+
+    x_mean, y_mean = x.mean(axis=0), y.mean(axis=0)
+    x_centred = x - x_mean
+    hedge_ratio = (x_centred * (y - y_mean)).sum(axis=0) / (x_centred ** 2).sum(axis=0)
+    intercept = y_mean - hedge_ratio * x_mean
+    return hedge_ratio, intercept, y - intercept - hedge_ratio * x
+
+
+def batch_adf(residuals: np.ndarray, lags: int = 1) -> np.ndarray:
+    """
+    Augmented Dickey-Fuller statistics of many series at once, with a fixed number of lagged differences and
+    without constant or trend, which is the second step of the Engle-Granger test on regression residuals. The
+    regressions d_e(t) = gamma * e(t-1) + sum_k phi_k * d_e(t-k) are solved together from their normal equations.
+    The result equals the statistic of statsmodels adfuller(e, maxlag=lags, regression='n', autolag=None).
+
+    :param residuals: (np.array) : series of shape (n, P)
+    :param lags: (int) : number of lagged differences
+    :return: (np.array) : t-statistics of gamma, of shape (P,)
+    """
+
+    diff = np.diff(residuals, axis=0)
+    n_obs = len(diff) - lags
+    # Regressors of shape (P, n_obs, 1 + lags): the lagged level and the lagged differences
+    design = np.stack([residuals[lags:-1]] + [diff[lags - k:len(diff) - k] for k in range(1, lags + 1)],
+                      axis=2).transpose(1, 0, 2)
+    response = diff[lags:].T[:, :, None]
+
+    xtx = design.transpose(0, 2, 1) @ design
+    xty = design.transpose(0, 2, 1) @ response
+    inverse = np.linalg.inv(xtx)
+    coefficients = inverse @ xty
+    rss = ((response - design @ coefficients) ** 2).sum(axis=(1, 2))
+    sigma2 = rss / (n_obs - design.shape[2])
+    return coefficients[:, 0, 0] / np.sqrt(sigma2 * inverse[:, 0, 0])
+
+
+def cointegration_tests(y: np.ndarray, x: np.ndarray, lags: int = 1) -> np.ndarray:
+    """
+    Engle-Granger tests of many pairs, with MacKinnon p-values of the residual-based test with a constant and
+    two variables.
+
+    :param y: (np.array) : prices of the targets, of shape (n, P)
+    :param x: (np.array) : prices of the partners, of shape (n, P)
+    :param lags: (int) : number of lagged differences of the ADF regressions
+    :return: (np.array) : hedge ratio, intercept, ADF statistic and p-value of every pair, of shape (P, 4)
+    """
+
+    hedge_ratio, intercept, residuals = batch_engle_granger(y, x)
+    adf_stat = batch_adf(residuals, lags)
+    p_value = np.array([mackinnonp(stat, regression='c', N=2) for stat in adf_stat])
+    return np.column_stack([hedge_ratio, intercept, adf_stat, p_value])
+
+
+def _cointegration_chunk(values: np.ndarray, targets: np.ndarray, partners: np.ndarray, lags: int) -> np.ndarray:
+    """
+    Cointegration tests of a chunk of pairs in a worker process.
+    """
+
+    return cointegration_tests(values[:, targets], values[:, partners], lags)
+
+
+def _chunk_args(values: np.ndarray, targets: np.ndarray, partners: np.ndarray, lags: int) -> tuple:
+    """
+    Arguments of _cointegration_chunk with only the price columns of the chunk, so that workers do not receive
+    the whole panel.
+    """
+
+    columns, ordinals = np.unique(np.concatenate([targets, partners]), return_inverse=True)
+    return values[:, columns], ordinals[:len(targets)], ordinals[len(targets):], lags
+
+
+def screen_pairs(prices: pd.DataFrame, targets: list = None, n_partners: int = 10, distance: str = 'ssd',
+                 lags: int = 1, num_workers: int = 1, chunk_size: int = 2048,
+                 instrumentation: Instrumentation = None) -> pd.DataFrame:
+    """
+    Screens all pairs of a price panel with the distance and cointegration approaches.
+
+    Sums of squared differences of the normalized prices and correlation distances are computed for all pairs
+    with matrix products. Every target is then paired with its n_partners nearest stocks by the chosen distance,
+    and only these pairs are tested for cointegration with batched Engle-Granger regressions and ADF tests,
+    optionally in chunks across a process pool. Days with missing prices, after forward filling, are dropped.
+
+    :param prices: (pd.DataFrame) : price series of all stocks in the universe
+    :param targets: (list) : target tickers, all stocks by default
+    :param n_partners: (int) : number of nearest partners tested for every target
+    :param distance: (str) : distance of the prefilter, 'ssd' or 'correlation'
+    :param lags: (int) : number of lagged differences of the ADF regressions
+    :param num_workers: (int) : number of worker processes, 1 runs the tests in this process
+    :param chunk_size: (int) : smallest number of pairs sent to a worker
+    :param instrumentation: (Instrumentation) : receiver of the progress of the worker chunks
+    :return: (pd.DataFrame) : pairs with columns target, partner, ssd, corr_distance, hedge_ratio, intercept,
+        adf_stat and p_value, ranked by p-value and then by SSD
+    """
+
+    if distance not in ('ssd', 'correlation'):
+        raise Exception("Please enter a valid distance, i.e ('ssd', 'correlation')")
+
+    prices = prices.ffill().dropna()
+    if len(prices) <= lags + 3:
+        raise Exception("Not enough days without missing prices for the cointegration tests")
+
+    tickers = list(prices.columns)
+    positions = {ticker: i for i, ticker in enumerate(tickers)}
+    target_ordinals = np.arange(len(tickers)) if targets is None else np.array([positions[t] for t in targets])
+    n_partners = min(n_partners, len(tickers) - 1)
+
+    values = prices.to_numpy(dtype=np.float64)
+    ssd = ssd_matrix(normalized_prices(prices))
+    corr_distance = correlation_distance_matrix(values)
+
+    # Prefilter: the n_partners nearest stocks of every target, excluding the target itself
+    distances = (ssd if distance == 'ssd' else corr_distance)[target_ordinals].copy()
+    distances[np.arange(len(target_ordinals)), target_ordinals] = np.inf
+    distances = np.nan_to_num(distances, nan=np.inf)
+    nearest = np.argpartition(distances, n_partners - 1, axis=1)[:, :n_partners]
+    pair_targets = np.repeat(target_ordinals, n_partners)
+    pair_partners = nearest.ravel()
+
+    if num_workers > 1:
+        instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        chunks = get_task_chunks(len(pair_targets), num_workers, chunk_size)
+        with mp.Pool(num_workers) as pool:
+            results = run_chunks(pool, _cointegration_chunk,
+                                 [_chunk_args(values, pair_targets[start:stop], pair_partners[start:stop], lags)
+                                  for start, stop in chunks],
+                                 [stop - start for start, stop in chunks], 'screen_pairs', instrumentation, 'pairs')
+        tests = np.vstack(results)
+    else:
+        tests = cointegration_tests(values[:, pair_targets], values[:, pair_partners], lags)
+
+    pairs = pd.DataFrame({'target': np.asarray(tickers, dtype=object)[pair_targets],
+                          'partner': np.asarray(tickers, dtype=object)[pair_partners],
+                          'ssd': ssd[pair_targets, pair_partners],
+                          'corr_distance': corr_distance[pair_targets, pair_partners],
+                          'hedge_ratio': tests[:, 0], 'intercept': tests[:, 1],
+                          'adf_stat': tests[:, 2], 'p_value': tests[:, 3]}, columns=PAIR_COLUMNS)
+    return pairs.sort_values(['p_value', 'ssd'], kind='stable').reset_index(drop=True)
@@ -1,13 +1,22 @@
-import itertools
+import json
+import math
+import os
+import time
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
 
-from statsmodels.distributions.empirical_distribution import ECDF
-from ps.utils_multiprocess import run_traditional_correlation_calcs, run_extended_correlation_calcs, \
-    run_diagonal_measure_calcs, run_extremal_measure_calcs
-from ps.ps_utils import get_sum_correlations, multivariate_rho, diagonal_measure, extremal_measure, get_co_variance_matrix
+from ps.utils_multiprocess import SharedMemoryExecutor, _score_target
+from ps.ps_utils import standardize_columns, blocked_top_k_correlations, read_selection_results, \
+    get_sum_correlations, multivariate_rho, diagonal_measure, extremal_measure, get_co_variance_matrix
+from ps.search_utils import branch_and_bound_sum_correlations, exhaustive_search, beam_search, greedy_swap_search
+from ps.quadruple_index import QuadrupleIndex
+from ps.instrumentation import Instrumentation
+from ps.pseudo_observations import PseudoObservationCache, pseudo_observations
+from ps.batch_utils import DEFAULT_MAX_CHUNK_BYTES, StreamingTopK, get_selection_dtype, batch_sum_correlations, \
+    batch_multivariate_rho, batch_diagonal_measure, get_extremal_basis, batch_extremal_measure, \
+    batch_all_measures
 
 
 class PartnerSelection:
@@ -19,14 +28,29 @@ class PartnerSelection:
     https://www.econstor.eu/bitstream/10419/147450/1/870932616.pdf
     """
 
-    def __init__(self, prices: pd.DataFrame):
+    def __init__(self, prices: pd.DataFrame, dense_correlation: bool = False, dtype=np.float64,
+                 block_size: int = 1024, cohort_size: int = 4, instrumentation: Instrumentation = None,
+                 pseudo_obs_cache: PseudoObservationCache = None, window_key: tuple = None):
         """
         Inputs the price series required for further calculations.
         Also includes preprocessing steps described in the paper, before starting the Partner Selection procedures.
         These steps include, finding the returns and ranked returns of the stocks, and calculating the top 50
         correlated stocks for each stock in the universe.
 
+        The top 50 correlated stocks are found from tiles of the correlation matrix, so the dense matrix is only
+        computed when it is requested, either with dense_correlation or on first access of correlation_matrix.
+
         :param prices: (pd.DataFrame): Contains price series of all stocks in universe
+        :param dense_correlation: (bool): Whether to compute the dense correlation matrix up front
+        :param dtype: (np.dtype): Float type of the correlation tiles, np.float32 gives extra throughput
+        :param block_size: (int): Number of stocks in a tile of the correlation matrix
+        :param cohort_size: (int): Number of stocks in a cohort including the target, 4 for quadruples. Exhaustive
+            enumeration is only practical up to 5 stocks, larger cohorts are found with self.search_cohorts
+        :param instrumentation: (Instrumentation): Receiver of stage timings and selection progress, silent by default
+        :param pseudo_obs_cache: (PseudoObservationCache): Memo of the sort orders of the returns, shared with
+            RollingPartnerSelection and CMPI, a new memo of this instance by default
+        :param window_key: (tuple): (start, stop) rows of the returns of prices in the return panel shared through
+            pseudo_obs_cache, (0, number of returns) by default
         """
 
         if len(prices) == 0:
@@ -35,15 +59,197 @@ class PartnerSelection:
         if not isinstance(prices, pd.DataFrame):
             raise Exception("Partner Selection Class requires a pandas DataFrame as input")
 
+        if not 2 <= cohort_size <= 51:
+            raise Exception("Cohort size must be between 2 and 51, i.e. the target and up to 50 partners")
+
         self.universe = prices  # Contains daily prices for all stocks in universe.
-        self.returns, self.ranked_returns = self._get_returns()  # Daily returns and corresponding ranked returns.
+        self.cohort_size = cohort_size  # Number of stocks in a cohort, including the target.
+        # Reports stage timings and selection progress, silent unless a callback or logger is given
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        stage = self.instrumentation.stage
+        # Sort orders of the returns, so that the ranked returns and the quantiles share a single argsort
+        self.pseudo_obs_cache = PseudoObservationCache() if pseudo_obs_cache is None else pseudo_obs_cache
+        self.window_key = window_key
+
+        with stage('_get_returns'):
+            self.returns, self.ranked_returns = self._get_returns()  # Daily returns and corresponding ranked returns.
+        self._quantiles = None  # Quantiles of the daily returns, computed on first use by the extended approach
+
+        with stage('standardize_columns'):
+            # Ranked returns standardized so that correlations are matrix products of its columns
+            self.standardized_ranks = standardize_columns(self.ranked_returns.to_numpy(), dtype)
+        # Correlation matrix containing all stocks in universe, computed on first access unless requested
+        self._correlation_matrix = None
+        if dense_correlation:
+            with stage('_correlation'):
+                self._correlation_matrix = self._correlation()
+        with stage('blocked_top_k_correlations'):
+            # For each stock in universe, positions and correlations of the top 50 most correlated stocks
+            self.top_50_ordinals, self.top_50_scores = blocked_top_k_correlations(self.standardized_ranks, 50,
+                                                                                  block_size)
+        with stage('_top_50_tickers'):
+            # For each stock in universe, tickers of top 50 most correlated stocks are stored
+            self.top_50_correlations = self._top_50_tickers()
+        with stage('_generate_all_quadruples'):
+            # Lazy index of quadruple combinations for all stocks in universe
+            self.all_quadruples = self._generate_all_quadruples()
+        # Worker pool of the multiprocess procedures, created on first use and reused until self.close()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Shuts down the worker pool of the multiprocess procedures and frees its shared memory.
+        """
+
+        if self._executor is not None:
+            self._executor.close()
+            self._executor = None
+
+    def _share_array(self, array_name: str, get_array, num_threads: int) -> tuple:
+        """
+        Places an array in the shared memory of the worker pool, creating the pool if needed.
+
+        :param array_name: (str) : name of the shared array
+        :param get_array: (callable) : computes the array, only called if it is not shared yet
+        :param num_threads: (int) : number of worker processes
+        :return: (tuple) : spec used by the workers to attach to the array
+        """
+
+        if self._executor is not None and self._executor.num_workers != num_threads:
+            self.close()
+        if self._executor is None:
+            self._executor = SharedMemoryExecutor(num_threads, self.instrumentation)
 
-        # Correlation matrix containing all stocks in universe
-        self.correlation_matrix = self._correlation()
-        # For each stock in universe, tickers of top 50 most correlated stocks are stored
-        self.top_50_correlations = self._top_50_tickers()
-        # Quadruple combinations for all stocks in universe
-        self.all_quadruples = self._generate_all_quadruples()
+        if self._executor.is_shared(array_name):
+            return self._executor.get_spec(array_name)
+        return self._executor.share(array_name, get_array())
+
+    def _multiprocess_select(self, method: str, array_name: str, get_array, n_targets: int, num_threads: int,
+                             top_k: int = None):
+        """
+        Shared driver of the multiprocess selectors. The array used by the method is placed in shared memory
+        once, and the quadruples of all targets are scored in chunks by a persistent pool of workers. Workers
+        only return the best quadruples of their chunk, which are merged per target.
+
+        :param method: (str) : one of 'traditional', 'extended', 'geometric' or 'extremal'
+        :param array_name: (str) : name of the shared array used by the method
+        :param get_array: (callable) : computes the array, only called if it is not shared yet
+        :param n_targets: (int) : number of target stocks to select
+        :param num_threads: (int) : number of worker processes
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        spec = self._share_array(array_name, get_array, num_threads)
+
+        targets = self.top_50_correlations.index[:n_targets]
+        target_ordinals = [self._get_cohort_ordinals(target) for target in targets]
+        results = self._executor.select(method, spec, target_ordinals, self.all_quadruples.n_select, top_k or 1,
+                                        list(targets))
+
+        combinations = self.all_quadruples.combinations
+        return self._collect_selection(targets, target_ordinals,
+                                       [(combinations[positions], scores) for positions, scores in results], top_k)
+
+    def _collect_selection(self, targets: pd.Index, target_ordinals: list, results: list, top_k: int = None):
+        """
+        Output of the selectors. Without top_k, the best quadruple of every target is resolved to tickers and
+        printed, as in the original procedures. With top_k, the best top_k quadruples of every target are
+        returned as a compact structured array of positions in the universe (see batch_utils.get_selection_dtype),
+        best first, which can be resolved to tickers with self.resolve_selection.
+
+        :param targets: (pd.Index) : target tickers
+        :param target_ordinals: (list) : positions of each target followed by its partners
+        :param results: (list) : combinations of partner positions and their measures for every target, best first
+        :param top_k: (int) : number of best quadruples per target
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        if top_k is None:
+            tickers = self.ranked_returns.columns
+            output_matrix = []  # Stores the final set of quadruples.
+            for ordinals, (combinations, _) in zip(target_ordinals, results):
+                best = np.asarray(combinations[0], dtype=np.intp)
+                final_quadruple = list(tickers[ordinals[np.r_[0, best + 1]]])
+                print(final_quadruple)
+                # Appending the final quadruple for each target to the output matrix
+                output_matrix.append(final_quadruple)
+            return output_matrix
+
+        selection = np.zeros(sum(len(scores) for _, scores in results),
+                             dtype=get_selection_dtype(self.all_quadruples.n_select + 1))
+        start = 0
+        for ordinals, (combinations, scores) in zip(target_ordinals, results):
+            stop = start + len(scores)
+            combinations = np.asarray(combinations, dtype=np.intp).reshape(len(scores), -1)
+            selection['target'][start:stop] = ordinals[0]
+            selection['rank'][start:stop] = np.arange(len(scores))
+            selection['members'][start:stop, 0] = ordinals[0]
+            selection['members'][start:stop, 1:] = ordinals[combinations + 1]
+            selection['score'][start:stop] = scores
+            start = stop
+
+        return selection
+
+    def resolve_selection(self, selection: np.ndarray) -> pd.DataFrame:
+        """
+        Resolves a structured array returned by the selectors with top_k to tickers.
+
+        :param selection: (np.array) : structured array of selected quadruples
+        :return: (pd.DataFrame) : target, rank, quadruple and score of every selected quadruple
+        """
+
+        tickers = np.asarray(self.ranked_returns.columns, dtype=object)
+        return pd.DataFrame({'target': tickers[selection['target']],
+                             'rank': selection['rank'],
+                             'quadruple': tickers[selection['members']].tolist(),
+                             'score': selection['score']})
+
+    @property
+    def correlation_matrix(self) -> pd.DataFrame:
+        """
+        Correlation matrix containing all stocks in universe, computed on first access.
+        """
+
+        if self._correlation_matrix is None:
+            with self.instrumentation.stage('_correlation'):
+                self._correlation_matrix = self._correlation()
+        return self._correlation_matrix
+
+    def _get_correlation_block(self, ordinals: np.ndarray) -> np.ndarray:
+        """
+        Correlation matrix of the stocks at the given positions. It is sliced from the dense correlation matrix
+        if that has been computed, and computed in float64 from the ranked returns otherwise, also when the
+        correlation tiles use np.float32, so that scores do not depend on the dtype of the tiles.
+
+        :param ordinals: (np.array) : positions of the stocks in the universe
+        :return: (np.array) : correlation matrix of shape (len(ordinals), len(ordinals))
+        """
+
+        if self._correlation_matrix is not None:
+            return self._correlation_matrix.to_numpy()[np.ix_(ordinals, ordinals)]
+        if self.standardized_ranks.dtype == np.float64:
+            columns = self.standardized_ranks[:, ordinals]
+        else:
+            columns = standardize_columns(self.ranked_returns.to_numpy()[:, ordinals])
+        return columns.T @ columns
+
+    def _get_float64_ranks(self) -> np.ndarray:
+        """
+        Standardized ranks in float64, shared with the workers that score the traditional approach.
+
+        :return: (np.array) : self.standardized_ranks, recomputed in float64 if the tiles use another dtype
+        """
+
+        if self.standardized_ranks.dtype == np.float64:
+            return self.standardized_ranks
+        return standardize_columns(self.ranked_returns.to_numpy())
 
     def _correlation(self) -> pd.DataFrame:
         """
@@ -65,107 +271,212 @@ class PartnerSelection:
 
         returns_df = self.universe.pct_change()
         returns_df = returns_df.replace([np.inf, -np.inf], np.nan).ffill().dropna()
+        if self.window_key is None:
+            self.window_key = (0, len(returns_df))
 
         # Calculating rank of daily returns for each stock. 'first' method is used to assign ranks in order they appear
-        returns_df_ranked = returns_df.rank(axis=0, method='first', pct=True)
+        returns_df_ranked = pseudo_observations(returns_df, ties='first', offset=0, cache=self.pseudo_obs_cache,
+                                                key=self.window_key)
         return returns_df, returns_df_ranked
 
     def _top_50_tickers(self) -> pd.DataFrame:
         """
-        Calculates the top 50 correlated stocks for each target stock.
+        Resolves the top 50 correlated stocks for each target stock to tickers.
 
         :return: (pd.DataFrame) : Dataframe consisting of 50 columns for each stock in the universe
         """
 
-        def tickers_list(col):
-            """
-            Returns list of tickers ordered according to correlations with target.
-            """
-            # Sort the column data in descending order and return the index of top 50 rows.
-            return col.sort_values(ascending=False)[1:51].index.to_list()
-
-        # Returns DataFrame with all stocks as indices and their respective top 50 correlated stocks as columns.
-        return self.correlation_matrix.apply(tickers_list, axis=0).T
+        tickers = self.ranked_returns.columns
+        return pd.DataFrame(np.asarray(tickers, dtype=object)[self.top_50_ordinals], index=tickers)
 
-    def _generate_all_quadruples(self) -> pd.DataFrame:
+    def _generate_all_quadruples(self) -> QuadrupleIndex:
         """
-         Method generates unique quadruples for all target stocks in universe.
+         Method generates the index of unique quadruples for all target stocks in universe.
+         Quadruples are represented lazily as combinations of positions in each target's top 50 partners.
+         With a cohort size other than 4, the index holds cohorts of that size instead of quadruples.
 
-         :return: (pd.DataFrame) : consists of all quadruples for every target stock
+         :return: (QuadrupleIndex) : index of all quadruples for every target stock
          """
 
-        return self.top_50_correlations.apply(self._generate_all_quadruples_helper, axis=1)
+        return QuadrupleIndex(self.ranked_returns.columns, self.top_50_correlations.index, self.top_50_ordinals,
+                              self.cohort_size - 1)
 
-    @staticmethod
-    def _generate_all_quadruples_helper(row: pd.Series) -> list:
+    def _get_quantiles(self) -> pd.DataFrame:
         """
-         Helper function which generates unique quadruples for each target stock.
+        Quantiles of the daily returns from the empirical distribution function of every stock.
+        Ties get the highest rank of their group, so the quantiles equal those of statsmodels ECDF. The result is
+        kept by this instance, so it is computed once for all selectors, from the sort order of the ranked returns.
 
-         :param row: (pd.Series) : list of 50 partner stocks
-         :return: (list) : quadruples
-         """
+        :return: (pd.DataFrame) : quantiles of the daily returns between (0, 1]
+        """
+
+        if self._quantiles is None:
+            self._quantiles = pseudo_observations(self.returns, ties='max', offset=0, cache=self.pseudo_obs_cache,
+                                                  key=self.window_key)
+        return self._quantiles
+
+    def _get_cohort_ordinals(self, target: str, n_partners: int = None) -> np.ndarray:
+        """
+        Positions of the target and its most correlated partners in the columns of the universe.
+
+        :param target: (str) : target stock ticker
+        :param n_partners: (int) : number of partners, by default the top 50
+        :return: (np.array) : target position followed by the partner positions, by decreasing correlation
+        """
+
+        if n_partners is None or n_partners <= self.top_50_correlations.shape[1]:
+            return self.all_quadruples.ordinals(target)[:None if n_partners is None else n_partners + 1]
+
+        # Larger candidate pools are taken directly from the correlation matrix
+        target_ordinal = self.ranked_returns.columns.get_loc(target)
+        target_correlations = self.standardized_ranks.T @ self.standardized_ranks[:, target_ordinal]
+        order = np.argsort(-np.nan_to_num(target_correlations, nan=-np.inf), kind='stable')
+        partners = order[order != target_ordinal][:n_partners]
+        return np.r_[target_ordinal, partners]
+
+    def _batch_select(self, score_func, n_targets: int, maximize: bool = True, top_k: int = None,
+                      name: str = 'batch'):
+        """
+        Shared driver of the vectorized selectors. For every target, score_func scores all quadruples at once
+        and the best quadruples are kept.
+
+        :param score_func: (callable) : maps (cohort ordinals, partner combinations) to an array of measures
+        :param n_targets: (int) : number of target stocks to select
+        :param maximize: (bool) : whether the highest or the lowest measure is selected
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :param name: (str) : name of the selector in progress reports
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
 
-        target = row.name
-        quadruples = []
-        for triple in itertools.combinations(row, 3):
-            quadruples.append([target] + list(triple))
-        return quadruples
+        combinations = self.all_quadruples.combinations
+        targets = self.top_50_correlations.index[:n_targets]
+        progress = self.instrumentation.progress(name, len(targets))
+
+        target_ordinals = []
+        results = []
+        # Iterating on the top 50 indices for each target stock.
+        for target in targets:
+            ordinals = self._get_cohort_ordinals(target)
+            top = StreamingTopK(top_k or 1, largest=maximize)
+            top.push(score_func(ordinals, combinations))
+            positions, scores = top.result()
+            target_ordinals.append(ordinals)
+            results.append((combinations[positions], scores))
+            progress.target(target, len(combinations))
+        progress.done()
+
+        return self._collect_selection(targets, target_ordinals, results, top_k)
 
     # Method 1
-    def traditional(self, n_targets=5) -> list:
+    def traditional(self, n_targets=5, top_k=None):
         """
         This method implements the first procedure described in Section 3.1.1.
         For all possible quadruples of a given stock, we calculate the sum of all pairwise correlations.
         For every target stock the quadruple with the highest sum is returned.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        output_matrix = []  # Stores the final set of quadruples.
+        targets = self.top_50_correlations.index[:n_targets]
+        combinations = self.all_quadruples.combinations
+
+        progress = self.instrumentation.progress('traditional', len(targets))
+        target_ordinals = []
+        results = []
         # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            max_sum_correlations = 0  # Variable used to extract the desired maximum value
-            final_quadruple = None  # Stores the final desired quadruple
+        for target in targets:
+            top = StreamingTopK(top_k or 1)  # Keeps the quadruples with the highest sums
 
             # Iterating on all unique quadruples generated for a target
-            for quadruple in self.all_quadruples[target]:
+            for position, quadruple in enumerate(self.all_quadruples[target]):
                 sum_correlations = get_sum_correlations(self.correlation_matrix, quadruple)
-                if sum_correlations > max_sum_correlations:
-                    max_sum_correlations = sum_correlations
-                    final_quadruple = quadruple
+                top.push_one(sum_correlations, position)
+
+            positions, scores = top.result()
+            target_ordinals.append(self.all_quadruples.ordinals(target))
+            results.append((combinations[positions], scores))
+            progress.target(target, len(combinations))
+        progress.done()
+
+        return self._collect_selection(targets, target_ordinals, results, top_k)
+
+    # Method 1
+    def traditional_batch(self, n_targets=5, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, top_k=None):
+        """
+        Vectorized implementation of self.traditional.
+        All quadruples of a target are scored with NumPy on the correlation block of the target and its
+        top 50 partners, in chunks limited by max_chunk_bytes. Blocks are computed in float64 (see
+        self._get_correlation_block), so scores match self.traditional to within about 1e-12, and only quadruples
+        whose sums tie to that precision can be ranked differently.
+
+        :param n_targets: (int) : number of target stocks to select
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        def score_func(ordinals, combinations):
+            corr_block = self._get_correlation_block(ordinals)
+            return batch_sum_correlations(corr_block, combinations, max_chunk_bytes)
+
+        return self._batch_select(score_func, n_targets, top_k=top_k, name='traditional_batch')
+
+    # Method 1
+    def traditional_branch_and_bound(self, n_targets=5, n_partners=50, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES,
+                                     top_k=None):
+        """
+        Branch-and-bound implementation of self.traditional.
+        Partners are enumerated by decreasing correlation with the target and branches whose optimistic bound
+        cannot beat the best quadruple found so far are pruned. The selected quadruple is the same as with
+        exhaustive enumeration, which makes candidate pools larger than the top 50 partners feasible.
+
+        :param n_targets: (int) : number of target stocks to select
+        :param n_partners: (int) : number of most correlated partners considered for each target
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        targets = self.top_50_correlations.index[:n_targets]
 
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
+        progress = self.instrumentation.progress('traditional_branch_and_bound', len(targets))
+        target_ordinals = []
+        results = []
+        # Iterating on the top 50 indices for each target stock.
+        for target in targets:
+            ordinals = self._get_cohort_ordinals(target, n_partners)
+            corr_block = self._get_correlation_block(ordinals)
+            combinations, scores = branch_and_bound_sum_correlations(corr_block, max_chunk_bytes, top_k or 1)
+            target_ordinals.append(ordinals)
+            results.append((combinations, scores))
+            progress.target(target, math.comb(len(ordinals) - 1, 3))
+        progress.done()
 
-        return output_matrix
+        return self._collect_selection(targets, target_ordinals, results, top_k)
 
     # Method 1
-    def traditional_multiprocess(self, n_targets=5, num_threads=8) -> list:
+    def traditional_multiprocess(self, n_targets=5, num_threads=8, top_k=None):
         """
         Multiprocess implementation of self.traditional.
+        Workers compute the correlation block of every target from the shared standardized ranks, so the dense
+        correlation matrix is never built.
         This method implements the first procedure described in Section 3.1.1.
         For all possible quadruples of a given stock, we calculate the sum of all pairwise correlations.
         For every target stock the quadruple with the highest sum is returned.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param num_threads: (int) : number of worker processes, kept alive until self.close()
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        output_matrix = []  # Stores the final set of quadruples.
-        # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            quadruples = self.all_quadruples[target]  # List of unique quadruples.
-            final_quadruple = run_traditional_correlation_calcs(self.correlation_matrix, quadruples, num_threads=num_threads)['quadruple']
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
-
-        return output_matrix
+        return self._multiprocess_select('traditional', 'standardized_ranks', self._get_float64_ranks, n_targets,
+                                         num_threads, top_k)
 
     # Method 2
-    def extended(self, n_targets=5) -> list:
+    def extended(self, n_targets=5, top_k=None):
         """
         This method implements the second procedure described in Section 3.1.1.
         It involves calculating the multivariate version of Spearman's correlation
@@ -173,35 +484,56 @@ class PartnerSelection:
         For every target stock the quadruple with the highest correlation is returned.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        u = self.returns.copy()  # Generating ranked returns from quantiles using statsmodels ECDF
-        for column in self.returns.columns:
-            ecdf = ECDF(self.returns.loc[:, column])
-            u[column] = ecdf(self.returns.loc[:, column])
+        u = self._get_quantiles()  # Generating ranked returns from quantiles of the empirical distribution function
+        targets = self.top_50_correlations.index[:n_targets]
+        combinations = self.all_quadruples.combinations
 
-        output_matrix = []  # Stores the final set of quadruples.
+        progress = self.instrumentation.progress('extended', len(targets))
+        target_ordinals = []
+        results = []
         # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            max_correlation = -np.inf  # Variable used to extract the desired maximum value
-            final_quadruple = None  # Stores the final desired quadruple
+        for target in targets:
+            top = StreamingTopK(top_k or 1)  # Keeps the quadruples with the highest correlations
 
             # Iterating on all unique quadruples generated for a target
-            for quadruple in self.all_quadruples[target]:
+            for position, quadruple in enumerate(self.all_quadruples[target]):
                 correlation = multivariate_rho(u[quadruple])
-                if correlation > max_correlation:
-                    max_correlation = correlation
-                    final_quadruple = quadruple
+                top.push_one(correlation, position)
+
+            positions, scores = top.result()
+            target_ordinals.append(self.all_quadruples.ordinals(target))
+            results.append((combinations[positions], scores))
+            progress.target(target, len(combinations))
+        progress.done()
+
+        return self._collect_selection(targets, target_ordinals, results, top_k)
+
+    # Method 2
+    def extended_batch(self, n_targets=5, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, top_k=None):
+        """
+        Vectorized implementation of self.extended.
+        The row products of each target are computed once and combined with all partner triples in chunked
+        einsum contractions. The pairwise term is read from the Gram matrix of the (1 - u) columns.
+
+        :param n_targets: (int) : number of target stocks to select
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        u_values = self._get_quantiles().to_numpy()
 
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
+        def score_func(ordinals, combinations):
+            return batch_multivariate_rho(u_values[:, ordinals], combinations, max_chunk_bytes)
 
-        return output_matrix
+        return self._batch_select(score_func, n_targets, top_k=top_k, name='extended_batch')
 
     # Method 2
-    def extended_multiprocess(self, n_targets=5, num_threads=8) -> list:
+    def extended_multiprocess(self, n_targets=5, num_threads=8, top_k=None):
         """
         Multiprocess implementation of self.extended.
         This method implements the second procedure described in Section 3.1.1.
@@ -210,56 +542,71 @@ class PartnerSelection:
         For every target stock the quadruple with the highest correlation is returned.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param num_threads: (int) : number of worker processes, kept alive until self.close()
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        u = self.returns.copy()  # Generating ranked returns from quantiles using statsmodels ECDF
-        for column in self.returns.columns:
-            ecdf = ECDF(self.returns.loc[:, column])
-            u[column] = ecdf(self.returns.loc[:, column])
-
-        output_matrix = []  # Stores the final set of quadruples.
-        # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            quadruples = self.all_quadruples[target]  # List of unique quadruples.
-            final_quadruple = run_extended_correlation_calcs(u, quadruples, num_threads=num_threads)['quadruple']
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
-
-        return output_matrix
+        return self._multiprocess_select('extended', 'quantiles', lambda: self._get_quantiles().to_numpy(), n_targets,
+                                         num_threads, top_k)
 
     # Method 3
-    def geometric(self, n_targets=5) -> list:
+    def geometric(self, n_targets=5, top_k=None):
         """
         This method implements the third procedure described in Section 3.1.1.
         It involves calculating the four dimensional diagonal measure for all possible quadruples of a given stock.
         For every target stock the quadruple with the lowest diagonal measure is returned.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        output_matrix = []  # Stores the final set of quadruples.
+        targets = self.top_50_correlations.index[:n_targets]
+        combinations = self.all_quadruples.combinations
+
+        progress = self.instrumentation.progress('geometric', len(targets))
+        target_ordinals = []
+        results = []
         # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            min_measure = np.inf  # Variable used to extract the desired minimum value
-            final_quadruple = None  # Stores the final desired quadruple
+        for target in targets:
+            top = StreamingTopK(top_k or 1, largest=False)  # Keeps the quadruples with the lowest measures
 
             # Iterating on all unique quadruples generated for a target
-            for quadruple in self.all_quadruples[target]:
+            for position, quadruple in enumerate(self.all_quadruples[target]):
                 measure = diagonal_measure(self.ranked_returns[quadruple])
-                if measure < min_measure:
-                    min_measure = measure
-                    final_quadruple = quadruple
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
+                top.push_one(measure, position)
 
-        return output_matrix
+            positions, scores = top.result()
+            target_ordinals.append(self.all_quadruples.ordinals(target))
+            results.append((combinations[positions], scores))
+            progress.target(target, len(combinations))
+        progress.done()
+
+        return self._collect_selection(targets, target_ordinals, results, top_k)
+
+    # Method 3
+    def geometric_batch(self, n_targets=5, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, top_k=None):
+        """
+        Vectorized implementation of self.geometric.
+        Candidate columns are gathered by integer position and the total distance to the hyper-diagonal is
+        evaluated for batches of quadruples from per-sample sums and squared sums.
+
+        :param n_targets: (int) : number of target stocks to select
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        ranked_returns = self.ranked_returns.to_numpy()
+
+        def score_func(ordinals, combinations):
+            return batch_diagonal_measure(ranked_returns[:, ordinals], combinations, max_chunk_bytes)
+
+        return self._batch_select(score_func, n_targets, maximize=False, top_k=top_k, name='geometric_batch')
 
     # Method 3
-    def geometric_multiprocess(self, n_targets=5, num_threads=8) -> list:
+    def geometric_multiprocess(self, n_targets=5, num_threads=8, top_k=None):
         """
         Multiprocess implementation of self.geometric.
         This method implements the third procedure described in Section 3.1.1.
@@ -267,52 +614,73 @@ class PartnerSelection:
         For every target stock the quadruple with the lowest diagonal measure is returned.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param num_threads: (int) : number of worker processes, kept alive until self.close()
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        output_matrix = []  # Stores the final set of quadruples.
-        # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            quadruples = self.all_quadruples[target]  # List of unique quadruples.
-            final_quadruple = run_diagonal_measure_calcs(self.ranked_returns, quadruples, num_threads=num_threads)['quadruple']
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
-
-        return output_matrix
+        return self._multiprocess_select('geometric', 'ranked_returns', self.ranked_returns.to_numpy, n_targets,
+                                         num_threads, top_k)
 
     # Method 4
-    def extremal(self, n_targets=5) -> list:
+    def extremal(self, n_targets=5, top_k=None):
         """
         This method implements the fourth procedure described in Section 3.1.1.
         It involves calculating a non-parametric test statistic based on Mangold (2015) to measure the
         degree of deviation from independence. Main focus of this measure is the occurrence of joint extreme events.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        co_variance_matrix = get_co_variance_matrix()
-        output_matrix = []  # Stores the final set of quadruples.
+        co_variance_matrix = get_co_variance_matrix(self.cohort_size)
+        targets = self.top_50_correlations.index[:n_targets]
+        combinations = self.all_quadruples.combinations
+
+        progress = self.instrumentation.progress('extremal', len(targets))
+        target_ordinals = []
+        results = []
         # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            max_measure = -np.inf  # Variable used to extract the desired maximum value
-            final_quadruple = None  # Stores the final desired quadruple
+        for target in targets:
+            top = StreamingTopK(top_k or 1)  # Keeps the quadruples with the highest measures
 
             # Iterating on all unique quadruples generated for a target
-            for quadruple in self.all_quadruples[target]:
+            for position, quadruple in enumerate(self.all_quadruples[target]):
                 measure = extremal_measure(self.ranked_returns[quadruple], co_variance_matrix)
-                if measure > max_measure:
-                    max_measure = measure
-                    final_quadruple = quadruple
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
+                top.push_one(measure, position)
+
+            positions, scores = top.result()
+            target_ordinals.append(self.all_quadruples.ordinals(target))
+            results.append((combinations[positions], scores))
+            progress.target(target, len(combinations))
+        progress.done()
 
-        return output_matrix
+        return self._collect_selection(targets, target_ordinals, results, top_k)
 
     # Method 4
-    def extremal_multiprocess(self, n_targets=5, num_threads=8) -> list:
+    def extremal_batch(self, n_targets=5, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, top_k=None):
+        """
+        Vectorized implementation of self.extremal.
+        Both equation forms of every stock are evaluated once, and T_(4,n) is computed for batches of
+        quadruples as tensor contractions followed by a batched quadratic form with the covariance matrix.
+
+        :param n_targets: (int) : number of target stocks to select
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
+        """
+
+        co_variance_matrix = get_co_variance_matrix(self.cohort_size)
+        basis = get_extremal_basis(self.ranked_returns.to_numpy())  # Shape : (n, N, 2)
+
+        def score_func(ordinals, combinations):
+            return batch_extremal_measure(basis[:, ordinals], combinations, co_variance_matrix, max_chunk_bytes)
+
+        return self._batch_select(score_func, n_targets, top_k=top_k, name='extremal_batch')
+
+    # Method 4
+    def extremal_multiprocess(self, n_targets=5, num_threads=8, top_k=None):
         """
         Multiprocess implementation of self.extremal.
         This method implements the fourth procedure described in Section 3.1.1.
@@ -320,21 +688,235 @@ class PartnerSelection:
         degree of deviation from independence. Main focus of this measure is the occurrence of joint extreme events.
 
         :param n_targets: (int) : number of target stocks to select
-        :return output_matrix: list: List of all selected quadruples
+        :param num_threads: (int) : number of worker processes, kept alive until self.close()
+        :param top_k: (int) : number of best quadruples per target, see self._collect_selection
+        :return output_matrix: list: List of all selected quadruples, or a structured array if top_k is given
         """
 
-        co_variance_matrix = get_co_variance_matrix()
-        output_matrix = []  # Stores the final set of quadruples.
-        # Iterating on the top 50 indices for each target stock.
-        for target in self.top_50_correlations.index[:n_targets]:
-            quadruples = self.all_quadruples[target]  # List of unique quadruples.
-            final_quadruple = run_extremal_measure_calcs(self.ranked_returns, quadruples, co_variance_matrix, num_threads=num_threads)[
-                'quadruple']
-            print(final_quadruple)
-            # Appending the final quadruple for each target to the output matrix
-            output_matrix.append(final_quadruple)
+        def get_basis():
+            return get_extremal_basis(self.ranked_returns.to_numpy())
+
+        return self._multiprocess_select('extremal', 'extremal_basis', get_basis, n_targets, num_threads, top_k)
+
+    def all_measures(self, n_targets=5, max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, top_k=None) -> pd.DataFrame:
+        """
+        Evaluates all four procedures described in Section 3.1.1 in a single pass over the quadruples.
+        Every batch of quadruples is sliced once, and the quantile and ranked return rows of its members are
+        gathered once and shared by the four measures (see batch_utils.batch_all_measures). The preprocessing of
+        the extended and extremal approaches is done once.
+
+        :param n_targets: (int) : number of target stocks to select
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target and procedure
+        :return: (pd.DataFrame) : for every target, the selected quadruple and its measure for each procedure.
+            With top_k, the top_k best quadruples of each procedure, indexed by target and rank, best first
+        """
+
+        u_values = self._get_quantiles().to_numpy()
+        ranked_returns = self.ranked_returns.to_numpy()
+        co_variance_matrix = get_co_variance_matrix(self.cohort_size)
+        combinations = self.all_quadruples.combinations
+
+        rows = []
+        index = []
+        targets = self.top_50_correlations.index[:n_targets]
+        progress = self.instrumentation.progress('all_measures', len(targets))
+        for target in targets:
+            ordinals = self._get_cohort_ordinals(target)
+            measures = batch_all_measures(self._get_correlation_block(ordinals), u_values[:, ordinals],
+                                          ranked_returns[:, ordinals], combinations, co_variance_matrix,
+                                          max_chunk_bytes)
+            target_rows = [{} for _ in range(min(top_k or 1, len(combinations)))]
+            for procedure, values in measures.items():
+                # The lowest diagonal measure is selected in the geometric approach, the highest otherwise
+                top = StreamingTopK(top_k or 1, largest=procedure != 'geometric')
+                top.push(values)
+                for row, position, score in zip(target_rows, *top.result()):
+                    row[procedure] = self.all_quadruples.resolve(target, combinations[position])
+                    row[f'{procedure}_score'] = score
+            rows.extend(target_rows)
+            index.extend((target, rank) for rank in range(len(target_rows)))
+            progress.target(target, 4 * len(combinations))
+        progress.done()
+
+        if top_k is None:
+            return pd.DataFrame(rows, index=targets)
+        return pd.DataFrame(rows, index=pd.MultiIndex.from_tuples(index, names=['target', 'rank']))
+
+    def _get_score_func(self, method: str, ordinals: np.ndarray, max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES):
+        """
+        Vectorized measure of the given procedure on the cohorts of a target, for cohorts of any size.
+
+        :param method: (str) : one of 'traditional', 'extended', 'geometric' or 'extremal'
+        :param ordinals: (np.array) : positions of the target followed by its partners
+        :param max_chunk_bytes: (int) : memory cap for a single batch of cohorts
+        :return: (callable) : maps partner combinations of shape (m, j) to m measures
+        """
+
+        if method == 'traditional':
+            corr_block = self._get_correlation_block(ordinals)
+            return lambda combinations: batch_sum_correlations(corr_block, combinations, max_chunk_bytes)
+
+        if method == 'extended':
+            u_block = self._get_quantiles().to_numpy()[:, ordinals]
+            return lambda combinations: batch_multivariate_rho(u_block, combinations, max_chunk_bytes)
+
+        if method == 'geometric':
+            points_block = self.ranked_returns.to_numpy()[:, ordinals]
+            return lambda combinations: batch_diagonal_measure(points_block, combinations, max_chunk_bytes)
+
+        if method == 'extremal':
+            basis_block = get_extremal_basis(self.ranked_returns.to_numpy()[:, ordinals])
+            return lambda combinations: batch_extremal_measure(basis_block, combinations,
+                                                               get_co_variance_matrix(combinations.shape[1] + 1),
+                                                               max_chunk_bytes)
+
+        raise Exception("Please enter a valid procedure name, i.e ('traditional', 'extended', 'geometric', "
+                        "'extremal') ")
+
+    def search_cohorts(self, method: str, n_targets=5, algorithm: str = 'beam', beam_width: int = 10,
+                       n_partners: int = 50, max_exhaustive: int = 250000,
+                       max_chunk_bytes=DEFAULT_MAX_CHUNK_BYTES, top_k=None) -> pd.DataFrame:
+        """
+        Heuristic search for the cohort of self.cohort_size stocks of every target, for any of the four procedures.
+
+        Exhaustive enumeration grows as C(n_partners, cohort_size - 1), e.g. 2.1 million cohorts per target for
+        cohorts of 6 stocks from 50 partners, so larger cohorts are built with a beam search or a greedy search
+        followed by single member swaps (see ps.search_utils). Wherever the number of cohorts is at most
+        max_exhaustive, the exhaustive optimum is computed as well, and the gap of the heuristic to it is reported.
+
+        :param method: (str) : one of 'traditional', 'extended', 'geometric' or 'extremal'
+        :param n_targets: (int) : number of target stocks to select
+        :param algorithm: (str) : 'beam' or 'greedy_swap'
+        :param beam_width: (int) : number of cohorts kept at every step of the beam search
+        :param n_partners: (int) : number of most correlated partners considered for each target
+        :param max_exhaustive: (int) : largest number of cohorts for which the exhaustive optimum is computed
+        :param max_chunk_bytes: (int) : memory cap for a single batch of cohorts
+        :param top_k: (int) : number of best cohorts per target. The beam search returns the best cohorts of its
+            last step, the greedy search the final cohort and the best cohorts of its swap neighbourhood
+        :return: (pd.DataFrame) : for every target, the selected cohort, its measure, the search time in seconds,
+            and the exhaustive optimum, the gap to it and the exhaustive search time, NaN where not computed.
+            With top_k, the top_k best cohorts indexed by target and rank, each compared with the exhaustive
+            cohort of the same rank
+        """
+
+        if algorithm not in ('beam', 'greedy_swap'):
+            raise Exception("Please enter a valid search algorithm, i.e ('beam', 'greedy_swap')")
+
+        maximize = method != 'geometric'  # The lowest diagonal measure is selected in the geometric approach
+        n_select = self.cohort_size - 1
+        compare = math.comb(n_partners, n_select) <= max_exhaustive
+        tickers = self.ranked_returns.columns
+
+        rows = []
+        index = []
+        targets = self.top_50_correlations.index[:n_targets]
+        progress = self.instrumentation.progress(f'search_cohorts_{algorithm}', len(targets))
+        for target in targets:
+            ordinals = self._get_cohort_ordinals(target, n_partners)
+            score_func = self._get_score_func(method, ordinals, max_chunk_bytes)
+
+            start = time.perf_counter()
+            if algorithm == 'beam':
+                result = beam_search(score_func, len(ordinals) - 1, n_select, beam_width, maximize, top_k)
+            else:
+                result = greedy_swap_search(score_func, len(ordinals) - 1, n_select, maximize, top_k=top_k)
+            search_time = time.perf_counter() - start
+            cohorts, scores = ([result[0]], [result[1]]) if top_k is None else result
+            target_rows = [{'cohort': list(tickers[ordinals[np.r_[0, cohort + 1]]]), 'score': score,
+                            'search_time': search_time,
+                            'exhaustive_score': np.nan, 'gap': np.nan, 'exhaustive_time': np.nan}
+                           for cohort, score in zip(cohorts, scores)]
+
+            if compare:
+                start = time.perf_counter()
+                _, optima = exhaustive_search(score_func, len(ordinals) - 1, n_select, maximize, top_k=top_k)
+                exhaustive_time = time.perf_counter() - start
+                optima = [optima] if top_k is None else optima
+                for row, optimum in zip(target_rows, optima):
+                    row['exhaustive_time'] = exhaustive_time
+                    row['exhaustive_score'] = optimum
+                    # Non-negative, 0 where the heuristic finds the cohort of the same rank
+                    row['gap'] = optimum - row['score'] if maximize else row['score'] - optimum
+            rows.extend(target_rows)
+            index.extend((target, rank) for rank in range(len(target_rows)))
+            progress.target(target, 0)
+        progress.done()
+
+        if top_k is None:
+            return pd.DataFrame(rows, index=targets)
+        return pd.DataFrame(rows, index=pd.MultiIndex.from_tuples(index, names=['target', 'rank']))
+
+    def select_universe(self, method: str, results_path: str, num_threads: int = 8, targets: list = None,
+                        top_k: int = None) -> pd.DataFrame:
+        """
+        Selects the quadruple of every target stock in the universe as an unattended batch job.
+        Targets are load balanced across the worker pool, and the winning quadruples and scores of each target
+        are appended to results_path as JSON lines, one per rank, as soon as it completes. Targets with all their
+        ranks present in the file for this method are skipped, so an interrupted run resumes from where it stopped.
+
+        :param method: (str) : one of 'traditional', 'extended', 'geometric' or 'extremal'
+        :param results_path: (str) : path of the append-only results file
+        :param num_threads: (int) : number of worker processes, kept alive until self.close()
+        :param targets: (list) : target tickers, by default all stocks in the universe
+        :param top_k: (int) : number of best quadruples per target, by default only the winning quadruple
+        :return: (pd.DataFrame) : results of all completed targets for this method, with the rank of every quadruple
+        """
+
+        arrays = {'traditional': ('standardized_ranks', self._get_float64_ranks),
+                  'extended': ('quantiles', lambda: self._get_quantiles().to_numpy()),
+                  'geometric': ('ranked_returns', self.ranked_returns.to_numpy),
+                  'extremal': ('extremal_basis', lambda: get_extremal_basis(self.ranked_returns.to_numpy()))}
+        if method not in arrays:
+            raise Exception("Please enter a valid procedure name, i.e ('traditional', 'extended', 'geometric', "
+                            "'extremal') ")
+
+        targets = list(self.top_50_correlations.index) if targets is None else list(targets)
+        combinations = self.all_quadruples.combinations
+        n_ranks = min(top_k or 1, len(combinations))
+        completed = self._read_method_results(results_path, method)
+        completed = completed.groupby('target').size()
+        completed = set(completed.index[completed >= n_ranks])
+        pending = [target for target in targets if target not in completed]
+        if not pending:
+            return self._read_method_results(results_path, method)
+
+        spec = self._share_array(*arrays[method], num_threads)
+        n_select = self.all_quadruples.n_select
+        tasks = ((target, method, spec, self._get_cohort_ordinals(target), n_select, n_ranks) for target in pending)
+
+        # Dropping a partially written last line left by an interrupted run before appending
+        if os.path.exists(results_path):
+            with open(results_path, 'rb+') as results_file:
+                content = results_file.read()
+                if content and not content.endswith(b'\n'):
+                    results_file.truncate(content.rfind(b'\n') + 1)
+
+        progress = self.instrumentation.progress(f'select_universe_{method}', len(pending))
+        with open(results_path, 'a') as results_file:
+            for target, positions, measures in self._executor.imap_unordered(_score_target, tasks):
+                records = [{'method': method, 'target': target, 'rank': rank,
+                            'quadruple': self.all_quadruples.resolve(target, combinations[position]),
+                            'score': float(measure)} for rank, (position, measure) in enumerate(zip(positions,
+                                                                                                    measures))]
+                results_file.write(''.join(json.dumps(record) + '\n' for record in records))
+                results_file.flush()
+                os.fsync(results_file.fileno())
+                progress.target(target, len(combinations))
+        progress.done()
+
+        return self._read_method_results(results_path, method)
+
+    @staticmethod
+    def _read_method_results(results_path: str, method: str) -> pd.DataFrame:
+        """
+        Results of a single method from a select_universe results file. A target rescored after an interrupted
+        run keeps its latest record of every rank.
+        """
 
-        return output_matrix
+        results = read_selection_results(results_path)
+        results = results[results['method'] == method]
+        return results.drop_duplicates(['target', 'rank'], keep='last').reset_index(drop=True)
 
     def plot_correlation(self):
         """
@@ -403,12 +985,9 @@ class PartnerSelection:
 
         # Preprocessing steps for some approaches
         if procedure == 'extremal':
-            co_variance_matrix = get_co_variance_matrix()
+            co_variance_matrix = get_co_variance_matrix(self.cohort_size)
         if procedure == 'extended':
-            u = self.returns.copy()  # Generating ranked returns from quantiles using statsmodels ECDF
-            for column in self.returns.columns:
-                ecdf = ECDF(self.returns.loc[:, column])
-                u[column] = ecdf(self.returns.loc[:, column])
+            u = self._get_quantiles()  # Generating ranked returns from quantiles of the empirical distribution function
         if procedure == 'geometric':
             final_measure = np.inf
 
@@ -1,8 +1,16 @@
+import functools
 import itertools
+import json
+import os
+import tempfile
+import zipfile
 import numpy as np
 import pandas as pd
 import scipy
 
+# Location of the on-disk cache for the covariance matrices of the extremal measure.
+CO_VARIANCE_CACHE_DIR = os.environ.get('STATARB_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'statarb'))
+
 
 def get_sector_data(quadruple, constituents):
     """
@@ -14,6 +22,80 @@ def get_sector_data(quadruple, constituents):
         return None
 
 
+def read_selection_results(path: str) -> pd.DataFrame:
+    """
+    Reads the append-only results file written by PartnerSelection.select_universe.
+    A partially written last line, left by an interrupted run, is ignored.
+
+    :param path: (str) : path of the results file
+    :return: (pd.DataFrame) : one row per selected quadruple with method, target, rank, quadruple and score.
+        Records written without a rank are the winning quadruple of their target, rank 0
+    """
+
+    records = []
+    if os.path.exists(path):
+        with open(path) as results_file:
+            for line in results_file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                record.setdefault('rank', 0)
+                records.append(record)
+
+    return pd.DataFrame(records, columns=['method', 'target', 'rank', 'quadruple', 'score'])
+
+
+def standardize_columns(values: np.ndarray, dtype=np.float64) -> np.ndarray:
+    """
+    Centres every column and scales it to unit norm, so that the Pearson correlation matrix of the columns
+    is the matrix product of the result with itself. Constant columns become NaN, as in pandas.
+
+    :param values: (np.array) : data of shape (n, N)
+    :param dtype: (np.dtype) : float type of the result, e.g. np.float32 for extra throughput
+    :return: (np.array) : standardized data of shape (n, N)
+    """
+
+    values = np.asarray(values, dtype=dtype)
+    centred = values - values.mean(axis=0)
+    norms = np.sqrt((centred ** 2).sum(axis=0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return centred / np.where(norms > 0, norms, np.nan).astype(dtype)
+
+
+def blocked_top_k_correlations(standardized: np.ndarray, k: int = 50, block_size: int = 1024) -> tuple:
+    """
+    Finds the k most correlated partners of every stock without holding the dense correlation matrix.
+    Correlations are computed in tiles of block_size stocks with a matrix product, and only the top k
+    partners of each stock are kept using argpartition.
+
+    :param standardized: (np.array) : standardized data of shape (n, N) from standardize_columns
+    :param k: (int) : number of partners per stock, at most N - 1
+    :param block_size: (int) : number of stocks in a tile, which has shape (block_size, N)
+    :return: (tuple) :
+        ordinals : (np.array) : partner positions of shape (N, k), by decreasing correlation
+        scores : (np.array) : corresponding correlations of shape (N, k)
+    """
+
+    n_stocks = standardized.shape[1]
+    k = min(k, n_stocks - 1)
+    ordinals = np.empty((n_stocks, k), dtype=np.intp)
+    scores = np.empty((n_stocks, k), dtype=standardized.dtype)
+    for start in range(0, n_stocks, block_size):
+        stop = min(start + block_size, n_stocks)
+        tile = standardized[:, start:stop].T @ standardized  # Shape : (block, N)
+        tile[np.isnan(tile)] = -np.inf  # Stocks without variation are ranked last
+        tile[np.arange(stop - start), np.arange(start, stop)] = -np.inf  # A stock is not its own partner
+
+        top = np.argpartition(-tile, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(tile, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        ordinals[start:stop] = np.take_along_axis(top, order, axis=1)
+        scores[start:stop] = np.take_along_axis(top_scores, order, axis=1)
+
+    return ordinals, scores
+
+
 def get_sum_correlations(corr_matrix, quadruple: list) -> float:
     """
     Helper function for traditional approach to partner selection.
@@ -92,56 +174,125 @@ def diagonal_measure(points) -> float:
 def extremal_measure(u, co_variance_matrix):
     """
     Helper function to calculate chi-squared test statistic based on p-dimensional Nelsen copulas.
-    Specifically, proposition 3.3 from Mangold (2015) is implemented for 4 dimensions.
-    :param u: (pd.DataFrame) : ranked returns of stocks in quadruple.
-    :param co_variance_matrix: (np.array) : Covariance matrix
+    Specifically, proposition 3.3 from Mangold (2015) is implemented for d dimensions.
+    :param u: (pd.DataFrame) : ranked returns of stocks in cohort.
+    :param co_variance_matrix: (np.array) : Covariance matrix of shape (2^d, 2^d)
     :return: test statistic
     """
     u = u.to_numpy()
     n = u.shape[0]
 
-    # Calculating array T_(4,n) from proposition 3.3
-    t = t_calc(u).mean(axis=1).reshape(-1, 1)  # Shape : (16, 1), Taking the mean w.r.t n
+    # Calculating array T_(d,n) from proposition 3.3
+    t = t_calc(u).mean(axis=1).reshape(-1, 1)  # Shape : (2^d, 1), Taking the mean w.r.t n
     # Calculating the final test statistic
     t_test_statistic = n * np.matmul(t.T, np.matmul(co_variance_matrix, t))
     return t_test_statistic[0, 0]
 
 
-def get_co_variance_matrix():
+def get_univariate_integrals() -> np.ndarray:
     """
-    Calculates 16x16 dimensional covariance matrix. Since the matrix is symmetric, only the integrals
-    in the upper triangle are calculated. The remaining values are filled from the transpose.
+    Calculates the exact integrals over [0, 1] of the products of the two equation forms returned by func.
+    The integrands, given by variance_integral_func, are polynomials of degree 4, so Gauss-Legendre quadrature
+    with 3 nodes is exact.
+
+    :return: (np.array) : 2x2 matrix with element (i, j) equal to the integral of func(t, i + 1) * func(t, j + 1)
     """
-    co_variance_matrix = np.zeros((16, 16))
-    for i, l1 in enumerate(itertools.product([1, 2], [1, 2], [1, 2], [1, 2])):
-        for j, l2 in enumerate(itertools.product([1, 2], [1, 2], [1, 2], [1, 2])):
-            if j < i:
-                # Integrals in lower triangle are skipped.
-                continue
+    nodes, weights = np.polynomial.legendre.leggauss(3)
+    nodes, weights = (nodes + 1) / 2, weights / 2  # From [-1, 1] to [0, 1]
+
+    integrals = np.zeros((2, 2))
+    for i, j in itertools.product(range(2), range(2)):
+        integrals[i, j] = weights @ variance_integral_func(nodes, (i + 1,), (j + 1,))
+    return integrals
 
-            # Numerical Integration of 4 dimensions
-            co_variance_matrix[i, j] = scipy.integrate.nquad(variance_integral_func, [(0, 1)] * 4, args=(l1, l2))[0]
 
-    inds = np.tri(16, k=-1, dtype=bool)  # Storing the indices of elements in lower triangle.
-    co_variance_matrix[inds] = co_variance_matrix.T[inds]
-    return np.linalg.inv(co_variance_matrix)
+@functools.lru_cache(maxsize=None)
+def _inverse_co_variance_matrix(dimension: int, cache_dir: str) -> np.ndarray:
+    """
+    Generates the inverse covariance matrix for a given dimension, reading it from the on-disk cache if present.
+    Cache files store the univariate integrals the matrix was computed from, and files that fail to load, were
+    computed from other integrals, have another shape or non-finite values are recomputed and replaced.
+    The memoized array is read-only, so callers cannot corrupt it in place.
+    """
+    shape = (2 ** dimension, 2 ** dimension)
+    integrals = get_univariate_integrals()
+    path = os.path.join(cache_dir, f'extremal_co_variance_{dimension}.npz') if cache_dir else None
+    inverse_co_variance_matrix = None
+    if path is not None and os.path.exists(path):
+        try:
+            with np.load(path) as cache_file:
+                if np.array_equal(cache_file['integrals'], integrals):
+                    inverse_co_variance_matrix = cache_file['inverse']
+        except (ValueError, OSError, EOFError, KeyError, zipfile.BadZipFile):
+            pass  # A damaged cache file is recomputed and replaced
+        if inverse_co_variance_matrix is not None and (inverse_co_variance_matrix.shape != shape or
+                                                       not np.isfinite(inverse_co_variance_matrix).all()):
+            inverse_co_variance_matrix = None
+
+    if inverse_co_variance_matrix is None:
+        # The integrand is a product of univariate polynomials, so the covariance matrix is the Kronecker power
+        # of the matrix of univariate integrals, and its inverse the Kronecker power of the inverse.
+        inverse_integrals = np.linalg.inv(integrals)
+        inverse_co_variance_matrix = np.ones((1, 1))
+        for _ in range(dimension):
+            inverse_co_variance_matrix = np.kron(inverse_co_variance_matrix, inverse_integrals)
+
+        if path is not None:
+            _save_cache_file(path, inverse=inverse_co_variance_matrix, integrals=integrals)
+
+    inverse_co_variance_matrix.setflags(write=False)
+    return inverse_co_variance_matrix
+
+
+def _save_cache_file(path: str, **arrays):
+    """
+    Writes arrays to the on-disk cache atomically. The arrays are saved to a temporary file in the same
+    directory and renamed into place, so concurrent writers, e.g. worker processes, never leave a partial file.
+    """
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                np.savez(temp_file, **arrays)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        pass  # The cache is an optimisation only
+
+
+def get_co_variance_matrix(dimension: int = 4, cache_dir: str = CO_VARIANCE_CACHE_DIR) -> np.ndarray:
+    """
+    Calculates the inverse of the (2^d)x(2^d) dimensional covariance matrix of the extremal measure.
+    Every element is a d-dimensional integral of a product of univariate polynomials, so it is computed
+    exactly as a product of one-dimensional integrals. Results are memoized in-process and stored in
+    cache_dir, keyed by the dimension and validated against the univariate integrals on load.
+
+    :param dimension: (int) : number of stocks in a cohort
+    :param cache_dir: (str) : directory of the on-disk cache, or None to disable it
+    :return: (np.array) : inverse covariance matrix of shape (2^d, 2^d)
+    """
+    return _inverse_co_variance_matrix(dimension, cache_dir).copy()
 
 
 def t_calc(u):
     """
-    Calculates T_(4,n) as seen in proposition 3.3. Each of the 16 rows in the array are appended to output and
+    Calculates T_(d,n) as seen in proposition 3.3. Each of the 2^d rows in the array are appended to output and
     returned as numpy array.
-    :param u:
-    :return: (np.array) of Shape (16, n)
+    :param u: (np.array) : ranked returns of shape (n, d)
+    :return: (np.array) of Shape (2^d, n)
     """
     output = []
-    for l in itertools.product([1, 2], [1, 2], [1, 2], [1, 2]):
-        # Equation form for each one of u1,u2,u3,u4 after partial differentials are calculated and multiplied
+    for l in itertools.product([1, 2], repeat=u.shape[1]):
+        # Equation form for each one of u1,...,ud after partial differentials are calculated and multiplied
         # together.
-        res = func(u[:, 0], l[0]) * func(u[:, 1], l[1]) * func(u[:, 2], l[2]) * func(u[:, 3], l[3])
+        res = np.prod([func(u[:, i], value) for i, value in enumerate(l)], axis=0)
         output.append(res)
 
-    return np.array(output)  # Shape (16, n)
+    return np.array(output)  # Shape (2^d, n)
 
 
 def func(t, value):
@@ -158,9 +309,11 @@ def func(t, value):
         return t * (2 - 3 * t)
 
 
-def variance_integral_func(u1, u2, u3, u4, l1, l2):
+def variance_integral_func(*args):
     """
     Calculates Integrand for covariance matrix calculation.
+    Arguments are the variables u1, ..., ud followed by the equation forms l1 and l2 of every variable, e.g.
+    (u1, u2, u3, u4, l1, l2) for quadruples.
     """
-    return func(u1, l1[0]) * func(u2, l1[1]) * func(u3, l1[2]) * func(u4, l1[3]) * \
-           func(u1, l2[0]) * func(u2, l2[1]) * func(u3, l2[2]) * func(u4, l2[3])
+    *u, l1, l2 = args
+    return np.prod([func(t, value1) * func(t, value2) for t, value1, value2 in zip(u, l1, l2)], axis=0)
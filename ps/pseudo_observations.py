@@ -0,0 +1,206 @@
+import collections
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Tie handling of the ranks:
+# 'first' ranks ties in the order they appear, as DataFrame.rank(method='first'),
+# 'max' gives ties the highest rank of their group, so rank / n is the empirical distribution function (ECDF),
+# 'average' gives ties the mean rank of their group, as pyvinecopulib.to_pseudo_obs.
+TIES_METHODS = ('first', 'max', 'average')
+
+
+def rank_columns(values: np.ndarray, ties: str = 'average') -> np.ndarray:
+    """
+    Ranks of every column of an array, starting at 1, from a single stable argsort per column.
+    NaNs are not ranked and stay NaN, so a column with m values has ranks 1..m.
+
+    :param values: (np.array) : data of shape (n, N)
+    :param ties: (str) : one of 'first', 'max' or 'average', see TIES_METHODS
+    :return: (np.array) : float ranks of shape (n, N)
+    """
+
+    if ties not in TIES_METHODS:
+        raise Exception("Please enter a valid tie handling method, i.e ('first', 'max', 'average')")
+
+    values = np.asarray(values, dtype=np.float64)
+    if values.ndim == 1:
+        return rank_columns(values[:, None], ties)[:, 0]
+
+    order = np.argsort(values, axis=0, kind='stable')  # NaNs are sorted last
+    return _ranks_from_order(values, order, ties)
+
+
+def _ranks_from_order(values: np.ndarray, order: np.ndarray, ties: str) -> np.ndarray:
+    """
+    Ranks of every column of values from its stable sort order, see rank_columns.
+    """
+
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    positions = np.broadcast_to(np.arange(1, len(values) + 1, dtype=np.float64)[:, None], values.shape)
+
+    if ties == 'first':
+        sorted_ranks = positions.copy()
+    else:
+        # Rows of the sorted values where a group of equal values starts and ends
+        starts = np.ones(values.shape, dtype=bool)
+        starts[1:] = sorted_values[1:] != sorted_values[:-1]
+        ends = np.ones(values.shape, dtype=bool)
+        ends[:-1] = starts[1:]
+
+        last = np.where(ends, positions, np.inf)
+        last = np.minimum.accumulate(last[::-1], axis=0)[::-1]  # Position of the last value in the group
+        if ties == 'max':
+            sorted_ranks = last
+        else:
+            first = np.maximum.accumulate(np.where(starts, positions, 0), axis=0)
+            sorted_ranks = (first + last) / 2
+
+    sorted_ranks[np.isnan(sorted_values)] = np.nan
+    ranks = np.empty(values.shape)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=0)
+    return ranks
+
+
+def _is_stable_order(values: np.ndarray, order: np.ndarray) -> bool:
+    """
+    Whether order is the stable argsort of every column of values, NaNs last, i.e. the sorted values are
+    non-decreasing and equal values keep the order of their rows.
+    """
+
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    nan = np.isnan(sorted_values)
+    ahead = (sorted_values[1:] > sorted_values[:-1]) | (nan[1:] & ~nan[:-1])
+    tied = (sorted_values[1:] == sorted_values[:-1]) | (nan[1:] & nan[:-1])
+    return bool((ahead | (tied & (order[1:] > order[:-1]))).all())
+
+
+class PseudoObservationCache:
+    """
+    Memo of the sort orders of data windows, bounded by their total size, from which pseudo-observations with
+    any tie handling are derived.
+
+    Ranking is dominated by the argsort of every column, and all tie handling methods follow from the sort order
+    in linear time, so a single argsort of a window serves the ranked returns and quantiles of the selectors as
+    well as the pseudo-observations of CMPI. Windows are identified by a key given by the caller, the (start, stop)
+    rows of a window of the return panel shared by PartnerSelection, RollingPartnerSelection and CMPI, and an
+    entry covers the columns it was computed for, so the quadruple of CMPI is served from the entry of the whole
+    universe. Data is never hashed: a cached order is only used if it is the stable sort order of the data it is
+    applied to, which is checked in linear time. Entries are then shared by strictly increasing transforms of the
+    same data, e.g. simple and log returns, and a key reused for other data is recomputed instead of giving wrong
+    ranks. The least recently used orders are dropped once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2):
+        """
+        :param max_bytes: (int) : total size of the cached orders in bytes, larger orders are not cached
+        """
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, values: np.ndarray, columns=None) -> np.ndarray:
+        """
+        Stable sort order of every column of a data window, computed on the first request for its key.
+
+        :param key: (hashable) : identifier of the data window, e.g. (start, stop) rows of the return panel
+        :param values: (np.array) : data of shape (n, N)
+        :param columns: (list) : labels of the N columns, e.g. tickers, None if the columns are not labelled
+        :return: (np.array) : read-only positions of shape (n, N) sorting every column, NaNs last
+        """
+
+        columns = None if columns is None or not pd.Index(columns).is_unique else pd.Index(columns)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None and len(entry[1]) == len(values):
+            cached_columns, order = entry
+            if columns is None or cached_columns is None:
+                positions = slice(None) if columns is None and cached_columns is None and \
+                    order.shape == values.shape else None
+            else:
+                positions = cached_columns.get_indexer(columns)
+                positions = positions if (positions >= 0).all() else None
+            if positions is not None:
+                order = order[:, positions]
+                if _is_stable_order(values, order):
+                    with self._lock:
+                        self.hits += 1
+                    return order
+
+        order = np.argsort(values, axis=0, kind='stable')
+        self.put(key, order, columns)
+        with self._lock:
+            self.misses += 1
+        return order
+
+    def put(self, key, order: np.ndarray, columns=None):
+        """
+        Stores the sort order of a data window, e.g. one derived from ranks that are updated incrementally.
+
+        :param key: (hashable) : identifier of the data window, e.g. (start, stop) rows of the return panel
+        :param order: (np.array) : positions of shape (n, N) sorting every column in a stable way, NaNs last
+        :param columns: (list) : labels of the N columns, None if the columns are not labelled
+        """
+
+        columns = None if columns is None or not pd.Index(columns).is_unique else pd.Index(columns)
+        order.setflags(write=False)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1].nbytes
+            if order.nbytes <= self.max_bytes:
+                self._entries[key] = (columns, order)
+                self.nbytes += order.nbytes
+                while self.nbytes > self.max_bytes:
+                    self.nbytes -= self._entries.popitem(last=False)[1][1].nbytes
+
+    def clear(self):
+        """
+        Drops all cached orders, e.g. to free their memory.
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+def pseudo_observations(data, ties: str = 'average', offset: int = 1, cache: PseudoObservationCache = None,
+                        key=None):
+    """
+    Pseudo-observations, i.e. column-wise ranks scaled to (0, 1], of a data window.
+
+    The defaults match pyvinecopulib.to_pseudo_obs, average ranks divided by n + 1. With ties='first' and
+    offset=0 they match DataFrame.rank(method='first', pct=True), and with ties='max' and offset=0 they are the
+    empirical distribution function of every column evaluated at its own values, as statsmodels ECDF.
+
+    :param data: (pd.DataFrame/np.array) : data window of shape (n, N)
+    :param ties: (str) : one of 'first', 'max' or 'average', see TIES_METHODS
+    :param offset: (int) : ranks are divided by the number of values plus offset
+    :param cache: (PseudoObservationCache) : memo of the sort orders, only used together with key. The columns
+        of a DataFrame are matched with the columns of the cached window by label
+    :param key: (hashable) : identifier of the data window in cache
+    :return: (pd.DataFrame/np.array) : pseudo-observations, a DataFrame with the index and columns of data if
+        data is a DataFrame
+    """
+
+    if ties not in TIES_METHODS:
+        raise Exception("Please enter a valid tie handling method, i.e ('first', 'max', 'average')")
+
+    is_frame = isinstance(data, pd.DataFrame)
+    values = data.to_numpy(dtype=np.float64) if is_frame else np.asarray(data, dtype=np.float64)
+    if cache is not None and key is not None and values.ndim == 2:
+        ranks = _ranks_from_order(values, cache.get(key, values, data.columns if is_frame else None), ties)
+    else:
+        ranks = rank_columns(values, ties)
+    pseudo_obs = ranks / ((~np.isnan(values)).sum(axis=0) + offset)
+
+    if is_frame:
+        return pd.DataFrame(pseudo_obs, index=data.index, columns=data.columns)
+    return pseudo_obs
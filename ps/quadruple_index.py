@@ -0,0 +1,88 @@
+import functools
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from ps.batch_utils import get_partner_combinations
+
+
+@functools.lru_cache(maxsize=None)
+def get_combination_index(n_partners: int = 50, n_select: int = 3) -> np.ndarray:
+    """
+    Read-only int16 array of all combinations of partner positions, shared by all targets.
+
+    :param n_partners: (int) : number of candidate partners per target
+    :param n_select: (int) : number of partners in each combination
+    :return: (np.array) : combinations of shape (C(n_partners, n_select), n_select)
+    """
+
+    combinations = get_partner_combinations(n_partners, n_select).astype(np.int16)
+    combinations.setflags(write=False)
+    return combinations
+
+
+class QuadrupleIndex(Mapping):
+    """
+    Lazy, compact representation of the quadruples of every target stock.
+
+    A quadruple is the target and a combination of positions in the target's ordered partner array. The
+    combinations are stored once as an int16 array shared across all targets, so memory is proportional to
+    the size of the universe. Tickers are only resolved on request, e.g. for the selected quadruple.
+    Indexing by a target ticker returns the list of its quadruples, as the former all_quadruples Series did.
+    """
+
+    def __init__(self, tickers: pd.Index, targets: pd.Index, partner_ordinals: np.ndarray, n_select: int = 3):
+        """
+        :param tickers: (pd.Index) : tickers of the universe, in the order of the ordinals
+        :param targets: (pd.Index) : target tickers, one per row of partner_ordinals
+        :param partner_ordinals: (np.array) : positions of the partners of every target, shape (n_targets, P)
+        :param n_select: (int) : number of partners in each combination
+        """
+
+        self.tickers = tickers
+        self.targets = targets
+        self.partner_ordinals = partner_ordinals
+        self.n_select = n_select
+
+    @property
+    def combinations(self) -> np.ndarray:
+        """
+        Shared combinations of partner positions, shape (C(P, n_select), n_select).
+        """
+
+        return get_combination_index(self.partner_ordinals.shape[1], self.n_select)
+
+    def ordinals(self, target: str) -> np.ndarray:
+        """
+        Positions of the target followed by the positions of its partners.
+
+        :param target: (str) : target stock ticker
+        :return: (np.array) : array of shape (P + 1,)
+        """
+
+        return np.r_[self.tickers.get_loc(target), self.partner_ordinals[self.targets.get_loc(target)]]
+
+    def resolve(self, target: str, combination: np.ndarray) -> list:
+        """
+        Resolves a combination of partner positions of a target to the tickers of the quadruple.
+
+        :param target: (str) : target stock ticker
+        :param combination: (np.array) : partner positions
+        :return: (list) : tickers of the quadruple, starting with the target
+        """
+
+        ordinals = self.ordinals(target)
+        return list(self.tickers[ordinals[np.r_[0, np.asarray(combination, dtype=np.intp) + 1]]])
+
+    def __getitem__(self, target: str) -> list:
+        ordinals = self.ordinals(target)
+        combinations = self.combinations.astype(np.intp)
+        members = np.column_stack([np.zeros(len(combinations), dtype=np.intp), combinations + 1])
+        return np.asarray(self.tickers, dtype=object)[ordinals[members]].tolist()
+
+    def __iter__(self):
+        return iter(self.targets)
+
+    def __len__(self) -> int:
+        return len(self.targets)
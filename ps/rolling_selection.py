@@ -0,0 +1,178 @@
+import numpy as np
+import pandas as pd
+
+from ps.ps_utils import get_co_variance_matrix
+from ps.quadruple_index import get_combination_index
+from ps.pseudo_observations import PseudoObservationCache, pseudo_observations
+from ps.batch_utils import DEFAULT_MAX_CHUNK_BYTES, StreamingTopK, batch_sum_correlations, batch_multivariate_rho, \
+    batch_diagonal_measure, get_extremal_basis, batch_extremal_measure
+
+
+class RollingPartnerSelection:
+    """
+    Walk-forward implementation of the Partner Selection procedures of the PartnerSelection class.
+
+    Formation windows of consecutive formation dates overlap almost entirely, so instead of rebuilding a
+    PartnerSelection for every window, the daily returns are calculated once for the whole price panel and
+    the ranks of the returns in the window are updated incrementally as rows enter and leave the window.
+    Ranks are assigned in order of appearance, as in PartnerSelection._get_returns, so in every window the
+    ranks of a stock are a permutation of 1..window with known mean and variance, and the correlation matrix
+    follows from a single matrix product of the centred ranks.
+    """
+
+    def __init__(self, prices: pd.DataFrame, window: int = 250, step: int = 21, n_partners: int = 50,
+                 pseudo_obs_cache: PseudoObservationCache = None):
+        """
+        :param prices: (pd.DataFrame) : contains price series of all stocks in universe
+        :param window: (int) : number of daily returns in a formation window
+        :param step: (int) : number of days between consecutive formation dates
+        :param n_partners: (int) : number of most correlated partners considered for each target
+        :param pseudo_obs_cache: (PseudoObservationCache) : memo receiving the sort order of every formation window,
+            keyed by its (start, stop) rows of self.returns, e.g. to be shared with CMPI
+        """
+
+        if len(prices) == 0:
+            raise Exception("Input does not contain any data")
+
+        if not isinstance(prices, pd.DataFrame):
+            raise Exception("Rolling Partner Selection Class requires a pandas DataFrame as input")
+
+        self.universe = prices
+        self.window = window
+        self.step = step
+        self.n_partners = n_partners
+        self.pseudo_obs_cache = pseudo_obs_cache
+
+        returns = prices.pct_change()
+        self.returns = returns.replace([np.inf, -np.inf], np.nan).ffill().dropna()  # Daily returns of whole panel
+
+        if len(self.returns) < window:
+            raise Exception("Price series are shorter than the formation window")
+        if prices.shape[1] <= n_partners:
+            raise Exception("Universe must contain more stocks than the number of partners")
+
+    def formation_dates(self) -> pd.Index:
+        """
+        Dates at the end of every formation window.
+
+        :return: (pd.Index) : formation dates
+        """
+
+        return self.returns.index[self.window - 1::self.step]
+
+    def windows(self):
+        """
+        Walks forward through the formation windows, updating the ranks incrementally.
+        Yields the formation date, the (start, stop) rows of the window in self.returns, the ranks of the returns
+        in the window, the returns, the correlation matrix and the positions of the top partners of every stock by
+        decreasing correlation. Ranks and returns are in chronological order. With self.pseudo_obs_cache, the sort
+        order of every window, which follows from its ranks without sorting, is stored under its rows.
+
+        :return: (generator) : tuples of (date, rows, ranks, returns, correlation matrix, partner positions)
+        """
+
+        values = self.returns.to_numpy()
+        window = self.window
+        buffer = values[:window].copy()
+        # Ranks in order of appearance, i.e. 'first' ranks
+        ranks = np.argsort(np.argsort(buffer, axis=0, kind='stable'), axis=0, kind='stable') + 1
+        oldest = 0  # Row of the buffer holding the oldest return
+
+        mean = (window + 1) / 2
+        scale = 1 / np.sqrt(window * (window ** 2 - 1) / 12)  # Ranks are a permutation of 1..window
+
+        for end in range(window - 1, len(values), self.step):
+            # Rolling forward to the window ending at row 'end', one row at a time
+            for row in range(end - self.step + 1 if end >= window else end + 1, end + 1):
+                # The leaving row is the earliest, so ties with it ranked after it
+                ranks -= buffer >= buffer[oldest]
+                buffer[oldest] = values[row]
+                ranks += buffer > buffer[oldest]
+                ranks[oldest] = (buffer <= buffer[oldest]).sum(axis=0)
+                oldest = (oldest + 1) % window
+
+            # Rows of the circular buffer in chronological order, starting with the oldest
+            chronological_ranks = np.roll(ranks, -oldest, axis=0)
+            rows = (end - window + 1, end + 1)
+            if self.pseudo_obs_cache is not None:
+                # 'first' ranks are the positions of the rows in the stable sort order
+                order = np.empty(ranks.shape, dtype=np.intp)
+                np.put_along_axis(order, chronological_ranks - 1,
+                                  np.broadcast_to(np.arange(window)[:, None], ranks.shape), axis=0)
+                self.pseudo_obs_cache.put(rows, order, self.returns.columns)
+
+            centred = (ranks - mean) * scale
+            correlation = centred.T @ centred
+            yield (self.returns.index[end], rows, chronological_ranks / window, values[rows[0]:rows[1]],
+                   correlation, self._top_partners(correlation))
+
+    def _top_partners(self, correlation: np.ndarray) -> np.ndarray:
+        """
+        Positions of the most correlated partners of every stock, by decreasing correlation.
+
+        :param correlation: (np.array) : correlation matrix
+        :return: (np.array) : partner positions of shape (N, n_partners)
+        """
+
+        scores = correlation.copy()
+        np.fill_diagonal(scores, -np.inf)
+        top = np.argpartition(-scores, self.n_partners - 1, axis=1)[:, :self.n_partners]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+        return np.take_along_axis(top, order, axis=1)
+
+    def run(self, method: str = 'extremal', targets: list = None,
+            max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES, top_k: int = None) -> pd.DataFrame:
+        """
+        Selects the quadruples of the targets at every formation date in one walk-forward pass.
+
+        :param method: (str) : one of 'traditional', 'extended', 'geometric' or 'extremal'
+        :param targets: (list) : target tickers, by default all stocks in the universe
+        :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+        :param top_k: (int) : number of best quadruples per target and formation date
+        :return: (pd.DataFrame) : formation date, target, selected quadruple and its measure. With top_k, the
+            top_k best quadruples of every target and date, best first, with their rank as in
+            PartnerSelection.resolve_selection
+        """
+
+        if method not in ('traditional', 'extended', 'geometric', 'extremal'):
+            raise Exception("Please enter a valid procedure name, i.e ('traditional', 'extended', 'geometric', "
+                            "'extremal') ")
+
+        tickers = self.returns.columns
+        targets = tickers if targets is None else pd.Index(targets)
+        target_ordinals = tickers.get_indexer(targets)
+        combinations = get_combination_index(self.n_partners, 3)
+        co_variance_matrix = get_co_variance_matrix(4) if method == 'extremal' else None
+
+        records = []
+        for date, rows, ranked, returns, correlation, partners in self.windows():
+            if method == 'extended':
+                # Quantiles from the empirical distribution function, i.e. the share of returns below or equal,
+                # from the sort order of the window if it is cached
+                u = pseudo_observations(pd.DataFrame(returns, columns=tickers, copy=False), ties='max', offset=0,
+                                        cache=self.pseudo_obs_cache, key=rows).to_numpy()
+            elif method == 'extremal':
+                basis = get_extremal_basis(ranked)
+
+            for target, target_ordinal in zip(targets, target_ordinals):
+                ordinals = np.r_[target_ordinal, partners[target_ordinal]]
+                if method == 'traditional':
+                    measures = batch_sum_correlations(correlation[np.ix_(ordinals, ordinals)], combinations,
+                                                      max_chunk_bytes)
+                elif method == 'extended':
+                    measures = batch_multivariate_rho(u[:, ordinals], combinations, max_chunk_bytes)
+                elif method == 'geometric':
+                    measures = batch_diagonal_measure(ranked[:, ordinals], combinations, max_chunk_bytes)
+                else:
+                    measures = batch_extremal_measure(basis[:, ordinals], combinations, co_variance_matrix,
+                                                      max_chunk_bytes)
+
+                # The lowest diagonal measure is selected in the geometric approach, the highest otherwise
+                top = StreamingTopK(top_k or 1, largest=method != 'geometric')
+                top.push(measures)
+                for rank, (position, score) in enumerate(zip(*top.result())):
+                    quadruple = list(tickers[ordinals[np.r_[0, combinations[position].astype(np.intp) + 1]]])
+                    records.append((date, target, rank, quadruple, score))
+
+        results = pd.DataFrame(records, columns=['date', 'target', 'rank', 'quadruple', 'score'])
+        return results.drop(columns='rank') if top_k is None else results
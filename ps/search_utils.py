@@ -0,0 +1,238 @@
+import itertools
+
+import numpy as np
+
+from ps.batch_utils import DEFAULT_MAX_CHUNK_BYTES, StreamingTopK, batch_sum_correlations
+
+# Slack on the bounds, so that rounding differences never prune a branch holding a tied optimum.
+BOUND_TOLERANCE = 1e-9
+
+
+def _top_two_sums(values: np.ndarray) -> float:
+    """
+    Sum of the two largest values, or -inf if there are fewer than two values.
+    """
+    if len(values) < 2:
+        return -np.inf
+    top_two = np.partition(values, len(values) - 2)[-2:]
+    return top_two[0] + top_two[1]
+
+
+def branch_and_bound_sum_correlations(corr_block: np.ndarray, max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+                                      top_k: int = 1) -> (np.ndarray, np.ndarray):
+    """
+    Exact search for the quadruples with the highest sums of pairwise correlations.
+
+    Partners are enumerated in the order of corr_block, which should be by decreasing correlation with the
+    target. For the first partner at position i, the best completion is bounded by the two highest target
+    correlations, the two highest correlations with partner i and the highest correlation between two
+    partners after position i. Branches whose bound cannot beat the k-th best quadruple found so far are
+    pruned. The remaining completions are screened together and the candidates that can beat it are scored
+    with batch_sum_correlations, so the result is identical to exhaustive enumeration, including ties.
+
+    :param corr_block: (np.array) : correlation matrix of the target (row 0) and its partners (rows 1..)
+    :param max_chunk_bytes: (int) : memory cap for a single batch of quadruples
+    :param top_k: (int) : number of best quadruples to return
+    :return: (tuple) :
+        combinations : (np.array) : positions of the 3 selected partners of each quadruple, shape (top_k, 3)
+        scores : (np.array) : sums of pairwise correlations of the selected quadruples, best first
+    """
+
+    target_corr = corr_block[0, 1:]
+    partner_corr = corr_block[1:, 1:]
+    n_partners = len(target_corr)
+    if n_partners < 3:
+        raise Exception("At least 3 partners are required to form a quadruple")
+
+    # Highest correlation between two partners at positions after i, for every i
+    upper = np.triu(partner_corr, k=1)
+    upper[np.tril_indices(n_partners)] = -np.inf
+    pair_max = np.maximum.accumulate(upper.max(axis=1)[::-1])[::-1]
+
+    # Quadruples are keyed by a number that increases in the order of exhaustive enumeration, to break ties
+    top = StreamingTopK(top_k)
+    for i in range(n_partners - 2):
+        rest = np.arange(i + 1, n_partners)
+        bound = target_corr[i] + _top_two_sums(target_corr[rest]) + _top_two_sums(partner_corr[i, rest]) + \
+            pair_max[i + 1]
+        if bound < top.threshold - BOUND_TOLERANCE:
+            continue
+
+        # Approximate scores of all completions (j, k) of partner i, with j < k
+        base = target_corr[i] + target_corr[rest] + partner_corr[i, rest]
+        scores = base[:, None] + base[None, :] - target_corr[i] + partner_corr[np.ix_(rest, rest)]
+        candidates = np.argwhere(np.triu(scores >= top.threshold - BOUND_TOLERANCE, k=1))
+        if len(candidates) == 0:
+            continue
+
+        combinations = np.column_stack([np.full(len(candidates), i), rest[candidates]])
+        keys = (combinations[:, 0] * n_partners + combinations[:, 1]) * n_partners + combinations[:, 2]
+        top.push(batch_sum_correlations(corr_block, combinations, max_chunk_bytes), keys)
+
+    keys, scores = top.result()
+    combinations = np.column_stack([keys // (n_partners * n_partners), keys // n_partners % n_partners,
+                                    keys % n_partners])
+    return combinations, scores
+
+
+def _best_cohorts(scores: np.ndarray, cohorts: np.ndarray, width: int, maximize: bool) -> (np.ndarray, np.ndarray):
+    """
+    The width best cohorts, ties broken by the lexicographic order of the cohorts.
+    """
+
+    keys = -scores if maximize else scores
+    order = np.lexsort(tuple(cohorts.T[::-1]) + (keys,))[:width]
+    return cohorts[order], scores[order]
+
+
+def exhaustive_search(score_func, n_partners: int, n_select: int, maximize: bool = True,
+                      max_cohorts: int = 100000, top_k: int = None):
+    """
+    Scores all combinations of n_select partners, in batches of at most max_cohorts combinations.
+
+    :param score_func: (callable) : maps an array of partner positions of shape (m, j) to m measures, for any j
+    :param n_partners: (int) : number of candidate partners
+    :param n_select: (int) : number of partners in each cohort
+    :param maximize: (bool) : whether the highest or the lowest measure is the best
+    :param max_cohorts: (int) : number of combinations scored at once
+    :param top_k: (int) : number of best cohorts to return, None for the best cohort only
+    :return: (tuple) :
+        cohort : (np.array) : positions of the selected partners, of shape (top_k, n_select) with top_k
+        score : (float/np.array) : measure of the selected cohort, or of the top_k cohorts, best first
+    """
+
+    combinations = itertools.combinations(range(n_partners), n_select)
+    cohorts, scores = np.empty((0, n_select), dtype=np.intp), np.empty(0)
+    while True:
+        batch = np.fromiter(itertools.chain.from_iterable(itertools.islice(combinations, max_cohorts)),
+                            dtype=np.intp).reshape(-1, n_select)
+        if len(batch) == 0:
+            break
+
+        # Ties are broken by the lexicographic order of the cohorts, as in beam_search
+        cohorts, scores = _best_cohorts(np.concatenate([scores, score_func(batch)]), np.vstack([cohorts, batch]),
+                                        top_k or 1, maximize)
+
+    if top_k is None:
+        return (cohorts[0], scores[0]) if len(scores) else (None, None)
+    return cohorts, scores
+
+
+def beam_search(score_func, n_partners: int, n_select: int, beam_width: int = 10,
+                maximize: bool = True, top_k: int = None):
+    """
+    Beam search for the cohort of n_select partners with the best measure.
+
+    Cohorts are grown one partner at a time. At every step, each of the beam_width best cohorts found so far
+    is extended by every partner that is not a member yet, and the extended cohorts are scored with the same
+    measure in one dimension higher. Only the beam_width best extended cohorts are kept. A beam width of 1 is
+    the greedy search.
+
+    :param score_func: (callable) : maps an array of partner positions of shape (m, j) to m measures, for any j
+    :param n_partners: (int) : number of candidate partners
+    :param n_select: (int) : number of partners in each cohort
+    :param beam_width: (int) : number of cohorts kept at every step
+    :param maximize: (bool) : whether the highest or the lowest measure is the best
+    :param top_k: (int) : number of best cohorts of the last step to return, None for the best cohort only
+    :return: (tuple) :
+        cohort : (np.array) : positions of the selected partners, of shape (top_k, n_select) with top_k
+        score : (float/np.array) : measure of the selected cohort, or of the top_k cohorts, best first
+    """
+
+    if n_select > n_partners:
+        raise Exception("Cohorts can not contain more stocks than the number of partners")
+
+    beam = np.empty((1, 0), dtype=np.intp)
+    scores = None
+    for step in range(n_select):
+        # Every cohort in the beam extended by every partner outside of it, as sorted unique combinations
+        extended = np.column_stack([np.repeat(beam, n_partners, axis=0), np.tile(np.arange(n_partners), len(beam))])
+        extended.sort(axis=1)
+        distinct = (np.diff(extended, axis=1) != 0).all(axis=1)
+        extended = np.unique(extended[distinct], axis=0)
+
+        # The last step keeps at least top_k cohorts
+        width = beam_width if step < n_select - 1 or top_k is None else max(beam_width, top_k)
+        beam, scores = _best_cohorts(score_func(extended), extended, width, maximize)
+
+    if top_k is None:
+        return beam[0], scores[0]
+    return beam[:top_k], scores[:top_k]
+
+
+def _swap_neighbourhood(cohort: np.ndarray, n_partners: int) -> np.ndarray:
+    """
+    All cohorts obtained by swapping a single member of the cohort for a partner outside of it, sorted.
+    """
+
+    outside = np.setdiff1d(np.arange(n_partners), cohort)
+    n_select = len(cohort)
+    swaps = np.repeat(cohort[None, :], n_select * len(outside), axis=0)
+    swaps[np.arange(len(swaps)), np.repeat(np.arange(n_select), len(outside))] = np.tile(outside, n_select)
+    swaps.sort(axis=1)
+    return swaps
+
+
+def swap_search(score_func, n_partners: int, cohort: np.ndarray, maximize: bool = True,
+                max_iterations: int = 100, top_k: int = None):
+    """
+    Local search that improves a cohort by swapping a single member for a partner outside the cohort.
+
+    All swaps of the cohort are scored at once, and the best one is made while it improves the measure.
+    With top_k, the final cohort is returned with the best cohorts of its swap neighbourhood.
+
+    :param score_func: (callable) : maps an array of partner positions of shape (m, j) to m measures, for any j
+    :param n_partners: (int) : number of candidate partners
+    :param cohort: (np.array) : positions of the partners of the initial cohort
+    :param maximize: (bool) : whether the highest or the lowest measure is the best
+    :param max_iterations: (int) : maximum number of swaps
+    :param top_k: (int) : number of best cohorts to return, None for the final cohort only
+    :return: (tuple) :
+        cohort : (np.array) : positions of the selected partners, of shape (top_k, n_select) with top_k
+        score : (float/np.array) : measure of the selected cohort, or of the top_k cohorts, best first
+    """
+
+    cohort = np.sort(np.asarray(cohort, dtype=np.intp))
+    score = score_func(cohort[None, :])[0]
+    swaps, swap_scores = None, None  # Neighbourhood of the final cohort, once it is scored
+
+    for _ in range(max_iterations):
+        swaps = _swap_neighbourhood(cohort, n_partners)
+        if len(swaps) == 0:
+            swap_scores = np.empty(0)
+            break
+
+        swap_scores = score_func(swaps)
+        best, best_score = _best_cohorts(swap_scores, swaps, 1, maximize)
+        if not (best_score[0] > score if maximize else best_score[0] < score):
+            break
+        cohort, score = best[0], best_score[0]
+        swaps, swap_scores = None, None
+
+    if top_k is None:
+        return cohort, score
+
+    if swaps is None:
+        swaps = _swap_neighbourhood(cohort, n_partners)
+        swap_scores = score_func(swaps) if len(swaps) else np.empty(0)
+    return _best_cohorts(np.r_[score, swap_scores], np.vstack([cohort[None, :], swaps]), top_k, maximize)
+
+
+def greedy_swap_search(score_func, n_partners: int, n_select: int, maximize: bool = True,
+                       max_iterations: int = 100, top_k: int = None):
+    """
+    Greedy search for the cohort of n_select partners with the best measure, followed by a swap search.
+
+    :param score_func: (callable) : maps an array of partner positions of shape (m, j) to m measures, for any j
+    :param n_partners: (int) : number of candidate partners
+    :param n_select: (int) : number of partners in each cohort
+    :param maximize: (bool) : whether the highest or the lowest measure is the best
+    :param max_iterations: (int) : maximum number of swaps
+    :param top_k: (int) : number of best cohorts to return, see swap_search
+    :return: (tuple) :
+        cohort : (np.array) : positions of the selected partners, of shape (top_k, n_select) with top_k
+        score : (float/np.array) : measure of the selected cohort, or of the top_k cohorts, best first
+    """
+
+    cohort, _ = beam_search(score_func, n_partners, n_select, 1, maximize)
+    return swap_search(score_func, n_partners, cohort, maximize, max_iterations, top_k)
@@ -1,9 +1,86 @@
+import os
+import time
+import logging
+import weakref
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
 from itertools import repeat
+from multiprocessing import shared_memory
 
-from ps.ps_utils import get_sum_correlations, multivariate_rho, diagonal_measure, extremal_measure
+from ps.ps_utils import get_sum_correlations, multivariate_rho, extremal_measure, get_co_variance_matrix
+from ps.batch_utils import StreamingTopK, batch_sum_correlations, batch_multivariate_rho, batch_diagonal_measure, \
+    batch_extremal_measure
+from ps.quadruple_index import get_combination_index
+from ps.instrumentation import Instrumentation
+
+logger = logging.getLogger(__name__)
+
+# Views on the shared arrays attached by the current worker process, keyed by shared memory block name.
+_ATTACHED_ARRAYS = {}
+
+
+def get_task_chunks(n_items: int, num_workers: int, min_chunk_size: int = 256, chunks_per_worker: int = 4) -> list:
+    """
+    Splits a range of items into balanced (start, stop) chunks. Each worker gets a few chunks for load
+    balancing, chunks are not smaller than min_chunk_size unless there are fewer items, and there is
+    always at least one chunk, also when there are fewer items than workers.
+
+    :param n_items: (int) Number of items
+    :param num_workers: (int) Number of workers
+    :param min_chunk_size: (int) Smallest number of items worth sending to a worker
+    :param chunks_per_worker: (int) Number of chunks per worker
+    :return: (list) List of (start, stop) tuples
+    """
+
+    n_chunks = max(1, min(num_workers * chunks_per_worker, -(-n_items // max(1, min_chunk_size))))
+    bounds = np.linspace(0, n_items, n_chunks + 1).astype(int).tolist()
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start or n_items == 0]
+
+
+def _timed_call(task: tuple) -> tuple:
+    """
+    Runs a task in a worker process and measures it.
+    :param task: (tuple) Index of the task, function and its arguments
+    :return: (tuple) Index of the task, id of the worker process, seconds spent and the result of the function
+    """
+    index, func, args = task
+    start = time.perf_counter()
+    result = func(*args)
+    return index, os.getpid(), time.perf_counter() - start, result
+
+
+def run_chunks(pool, func, args_list: list, chunk_sizes: list, name: str, instrumentation: Instrumentation,
+               unit: str = 'quadruples') -> list:
+    """
+    Runs func on every argument tuple in the pool, reporting the progress of every completed chunk.
+    :param pool: (mp.Pool) Worker pool
+    :param func: (callable) Module level function
+    :param args_list: (list) Argument tuples
+    :param chunk_sizes: (list) Number of items of every task
+    :param name: (str) Name of the procedure
+    :param instrumentation: (Instrumentation) Receiver of the progress events
+    :param unit: (str) Name of the items in progress reports
+    :return: (list) Results in task order
+    """
+    progress = instrumentation.progress(name, sum(chunk_sizes), unit)
+    results = [None] * len(args_list)
+    pending = len(args_list)
+    for index, worker, seconds, result in pool.imap_unordered(_timed_call, [(i, func, args) for i, args in
+                                                                            enumerate(args_list)]):
+        results[index] = result
+        pending -= 1
+        progress.chunk(worker, chunk_sizes[index], seconds, pending)
+    progress.done()
+
+    return results
+
+
+def _get_instrumentation(verbose: bool) -> Instrumentation:
+    """
+    Instrumentation of the run_*_calcs functions, which log their progress to the module logger if verbose.
+    """
+    return Instrumentation(logger=logger) if verbose else Instrumentation()
 
 
 def _traditional_correlation_loop(corr_matrix: pd.DataFrame, molecule: list) -> pd.DataFrame:
@@ -27,15 +104,16 @@ def run_traditional_correlation_calcs(corr_matrix: pd.DataFrame, quadruples: lis
     :param corr_matrix: (pd.DataFrame) Correlation Matrix
     :param quadruples: (list)  list of quadruples
     :param num_threads: (int) Number of cores to use
-    :param verbose: (bool) Flag to report progress on asynch jobs
+    :param verbose: (bool) Flag to report progress on asynch jobs to the logger of this module
     :return: (pd.DataFrame) Quadruple with highest sum of correlations
     """
 
-    chunk_size = len(quadruples) // num_threads
-    quadruple_chunks = [quadruples[i:i + chunk_size] for i in range(0, len(quadruples), chunk_size)]
+    quadruple_chunks = [quadruples[start:stop] for start, stop in get_task_chunks(len(quadruples), num_threads, 1, 1)]
+    chunk_sizes = [len(chunk) for chunk in quadruple_chunks]
 
     with mp.Pool(num_threads) as p:
-        results_list = p.starmap(_traditional_correlation_loop, zip(repeat(corr_matrix), quadruple_chunks))
+        results_list = run_chunks(p, _traditional_correlation_loop, list(zip(repeat(corr_matrix), quadruple_chunks)),
+                                  chunk_sizes, 'traditional', _get_instrumentation(verbose))
 
     results = pd.concat(results_list)
 
@@ -63,14 +141,15 @@ def run_extended_correlation_calcs(u: pd.DataFrame, quadruples: list, num_thread
     :param u: (pd.DataFrame) ranked returns
     :param quadruples: (list)  list of quadruples
     :param num_threads: (int) Number of cores to use
-    :param verbose: (bool) Flag to report progress on asynch jobs
+    :param verbose: (bool) Flag to report progress on asynch jobs to the logger of this module
     :return: (pd.DataFrame) Quadruple with highest multivariate correlation
     """
-    chunk_size = len(quadruples) // num_threads
-    quadruple_chunks = [quadruples[i:i + chunk_size] for i in range(0, len(quadruples), chunk_size)]
+    quadruple_chunks = [quadruples[start:stop] for start, stop in get_task_chunks(len(quadruples), num_threads, 1, 1)]
+    chunk_sizes = [len(chunk) for chunk in quadruple_chunks]
 
     with mp.Pool(num_threads) as p:
-        results_list = p.starmap(_extended_correlation_loop, zip(repeat(u), quadruple_chunks))
+        results_list = run_chunks(p, _extended_correlation_loop, list(zip(repeat(u), quadruple_chunks)),
+                                  chunk_sizes, 'extended', _get_instrumentation(verbose))
 
     results = pd.concat(results_list)
 
@@ -84,11 +163,17 @@ def _diagonal_measure_loop(ranked_returns: pd.DataFrame, molecule: list) -> pd.D
     :param molecule: (list) Indices of quadruples
     :return: (pd.DataFrame) total euclidean distance for each quadruple
     """
-    results = []
-    for quadruple in molecule:
-        results.append((quadruple, diagonal_measure(ranked_returns[quadruple])))
+    if len(molecule) == 0:
+        return pd.DataFrame([], columns=['quadruple', 'result'])
 
-    return pd.DataFrame(results, columns=['quadruple', 'result'])
+    # All quadruples of a molecule share the target, so the measures are computed in one vectorized batch
+    target = molecule[0][0]
+    partners = pd.Index(sorted({ticker for quadruple in molecule for ticker in quadruple[1:]}))
+    combinations = np.array([partners.get_indexer(quadruple[1:]) for quadruple in molecule])
+    points_block = ranked_returns[[target] + list(partners)].to_numpy()
+    results = batch_diagonal_measure(points_block, combinations)
+
+    return pd.DataFrame({'quadruple': list(molecule), 'result': results})
 
 
 def run_diagonal_measure_calcs(ranked_returns: pd.DataFrame, quadruples: list, num_threads: int = 8,
@@ -98,15 +183,16 @@ def run_diagonal_measure_calcs(ranked_returns: pd.DataFrame, quadruples: list, n
     :param ranked_returns: (pd.DataFrame) ranked returns
     :param quadruples: (list)  list of quadruples
     :param num_threads: (int) Number of cores to use
-    :param verbose: (bool) Flag to report progress on asynch jobs
+    :param verbose: (bool) Flag to report progress on asynch jobs to the logger of this module
     :return: (pd.DataFrame) Quadruple with smallest diagonal measure
     """
 
-    chunk_size = len(quadruples) // num_threads
-    quadruple_chunks = [quadruples[i:i + chunk_size] for i in range(0, len(quadruples), chunk_size)]
+    quadruple_chunks = [quadruples[start:stop] for start, stop in get_task_chunks(len(quadruples), num_threads, 1, 1)]
+    chunk_sizes = [len(chunk) for chunk in quadruple_chunks]
 
     with mp.Pool(num_threads) as p:
-        results_list = p.starmap(_diagonal_measure_loop, zip(repeat(ranked_returns), quadruple_chunks))
+        results_list = run_chunks(p, _diagonal_measure_loop, list(zip(repeat(ranked_returns), quadruple_chunks)),
+                                  chunk_sizes, 'geometric', _get_instrumentation(verbose))
 
     results = pd.concat(results_list)
 
@@ -136,16 +222,219 @@ def run_extremal_measure_calcs(ranked_returns: pd.DataFrame, quadruples: list, c
     :param ranked_returns: (pd.DataFrame) ranked returns
     :param quadruples: (list)  list of quadruples
     :param num_threads: (int) Number of cores to use
-    :param verbose: (bool) Flag to report progress on asynch jobs
+    :param verbose: (bool) Flag to report progress on asynch jobs to the logger of this module
     :return: (pd.DataFrame) Quadruple with biggest extremal measure
     """
 
-    chunk_size = len(quadruples) // num_threads
-    quadruple_chunks = [quadruples[i:i + chunk_size] for i in range(0, len(quadruples), chunk_size)]
+    quadruple_chunks = [quadruples[start:stop] for start, stop in get_task_chunks(len(quadruples), num_threads, 1, 1)]
+    chunk_sizes = [len(chunk) for chunk in quadruple_chunks]
 
     with mp.Pool(num_threads) as p:
-        results_list = p.starmap(_extremal_measure_loop, zip(repeat(ranked_returns), repeat(co_variance_matrix), quadruple_chunks))
+        results_list = run_chunks(p, _extremal_measure_loop, list(zip(repeat(ranked_returns), repeat(co_variance_matrix), quadruple_chunks)),
+                                  chunk_sizes, 'extremal', _get_instrumentation(verbose))
 
     results = pd.concat(results_list)
 
     return results.iloc[results['result'].argmax()]
+
+
+
+def _attach_shared_array(spec: tuple) -> np.ndarray:
+    """
+    Returns a view on an array in shared memory, attaching the block on first use in this process.
+    :param spec: (tuple) Name of the shared memory block, shape and dtype of the array
+    :return: (np.array) Array backed by the shared memory block
+    """
+    name, shape, dtype = spec
+    if name not in _ATTACHED_ARRAYS:
+        block = shared_memory.SharedMemory(name=name)
+        _ATTACHED_ARRAYS[name] = (block, np.ndarray(shape, dtype=dtype, buffer=block.buf))
+
+    return _ATTACHED_ARRAYS[name][1]
+
+
+def _score_chunk(method: str, spec: tuple, ordinals: np.ndarray, start: int, stop: int, n_select: int,
+                 top_k: int = 1) -> tuple:
+    """
+    Scores a chunk of the quadruples of a target with the vectorized engine of the given method.
+    :param method: (str) One of 'traditional', 'extended', 'geometric' or 'extremal'
+    :param spec: (tuple) Shared array used by the method, the standardized ranks for the traditional method
+    :param ordinals: (np.array) Positions of the target and its partners
+    :param start: (int) First combination of the chunk
+    :param stop: (int) End of the chunk
+    :param n_select: (int) Number of partners in each combination
+    :param top_k: (int) Number of best combinations to return
+    :return: (tuple) Positions of the best combinations in the combination index and their measures, best first
+    """
+    array = _attach_shared_array(spec)
+    combinations = get_combination_index(len(ordinals) - 1, n_select)[start:stop]
+
+    if method == 'traditional':
+        # The correlation block of the cohort is computed from the shared standardized ranks
+        columns = array[:, ordinals].astype(np.float64)
+        measures = batch_sum_correlations(columns.T @ columns, combinations)
+    elif method == 'extended':
+        measures = batch_multivariate_rho(array[:, ordinals], combinations)
+    elif method == 'geometric':
+        measures = batch_diagonal_measure(array[:, ordinals], combinations)
+    else:
+        co_variance_matrix = get_co_variance_matrix(n_select + 1)
+        measures = batch_extremal_measure(array[:, ordinals], combinations, co_variance_matrix)
+
+    top = StreamingTopK(top_k, largest=method != 'geometric')
+    top.push(measures, offset=start)
+    return top.result()
+
+
+def _score_target(task: tuple) -> tuple:
+    """
+    Scores all quadruples of a single target, used to load balance whole targets across workers.
+    :param task: (tuple) Key of the target, followed by the arguments of _score_chunk
+    :return: (tuple) Key of the target, positions of the best combinations and their measures
+    """
+    key, method, spec, ordinals, n_select, top_k = task
+    n_combinations = len(get_combination_index(len(ordinals) - 1, n_select))
+    positions, measures = _score_chunk(method, spec, ordinals, 0, n_combinations, n_select, top_k)
+    return key, positions, measures
+
+
+def _release_shared_resources(pool_holder: list, blocks: dict):
+    """
+    Terminates the worker pool and frees the shared memory blocks of an executor.
+    """
+    for pool in pool_holder:
+        pool.terminate()
+    pool_holder.clear()
+    for block, _ in blocks.values():
+        block.close()
+        block.unlink()
+    blocks.clear()
+
+
+class SharedMemoryExecutor:
+    """
+    Long-lived worker pool for the multiprocess partner selection procedures.
+
+    Arrays are copied into shared memory once with share() and workers attach to them on first use, so
+    nothing but the small task descriptions is pickled per task. The same workers are reused across all
+    targets and procedures until close() is called.
+    """
+
+    def __init__(self, num_workers: int = 8, instrumentation: Instrumentation = None):
+        """
+        :param num_workers: (int) Number of worker processes
+        :param instrumentation: (Instrumentation) Receiver of the progress of select(), silent by default
+        """
+        self.num_workers = num_workers
+        self.instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        self._pool_holder = []  # Worker pool, created on first use
+        self._blocks = {}  # Shared memory block and array spec for every shared array name
+        self._finalizer = weakref.finalize(self, _release_shared_resources, self._pool_holder, self._blocks)
+
+    def share(self, name: str, array: np.ndarray) -> tuple:
+        """
+        Copies an array into shared memory, unless an array with this name is already shared.
+        :param name: (str) Name of the array
+        :param array: (np.array) Array to share
+        :return: (tuple) Spec to pass to workers, used to attach to the array
+        """
+        if name not in self._blocks:
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self._blocks[name] = (block, (block.name, array.shape, array.dtype.str))
+
+        return self._blocks[name][1]
+
+    def is_shared(self, name: str) -> bool:
+        """
+        Whether an array with this name is already shared.
+        """
+        return name in self._blocks
+
+    def get_spec(self, name: str) -> tuple:
+        """
+        Spec of an already shared array.
+        """
+        return self._blocks[name][1]
+
+    def starmap(self, func, tasks: list) -> list:
+        """
+        Runs func on every task in the worker pool and returns the results in task order.
+        :param func: (callable) Module level function
+        :param tasks: (list) List of argument tuples
+        :return: (list) Results
+        """
+        if not self._pool_holder:
+            self._pool_holder.append(mp.Pool(self.num_workers))
+
+        return self._pool_holder[0].starmap(func, tasks)
+
+    def imap_unordered(self, func, tasks):
+        """
+        Runs func on every task in the worker pool and yields the results as they complete.
+        :param func: (callable) Module level function of a single argument
+        :param tasks: (iterable) Tasks
+        :return: (iterator) Results in completion order
+        """
+        if not self._pool_holder:
+            self._pool_holder.append(mp.Pool(self.num_workers))
+
+        return self._pool_holder[0].imap_unordered(func, tasks)
+
+    def select(self, method: str, spec: tuple, target_ordinals: list, n_select: int = 3, top_k: int = 1,
+               targets: list = None) -> list:
+        """
+        Scores all quadruples of every target in the worker pool and returns the best combinations per target.
+        Chunks of all targets are submitted at once, so workers stay busy across targets. Each worker returns
+        only the top_k combinations of its chunk, which are merged per target as chunks complete.
+        :param method: (str) One of 'traditional', 'extended', 'geometric' or 'extremal'
+        :param spec: (tuple) Spec of the shared array used by the method
+        :param target_ordinals: (list) Positions of each target followed by its partners
+        :param n_select: (int) Number of partners in each combination
+        :param top_k: (int) Number of best combinations per target
+        :param targets: (list) Names of the targets in progress reports, by default their index
+        :return: (list) Tuple of the positions of the best combinations and their measures, for every target
+        """
+        targets = range(len(target_ordinals)) if targets is None else targets
+        tasks = []
+        owners = []
+        for i, ordinals in enumerate(target_ordinals):
+            n_combinations = len(get_combination_index(len(ordinals) - 1, n_select))
+            for start, stop in get_task_chunks(n_combinations, self.num_workers):
+                tasks.append((len(tasks), _score_chunk, (method, spec, ordinals, start, stop, n_select, top_k)))
+                owners.append(i)
+
+        tops = [StreamingTopK(top_k, largest=method != 'geometric') for _ in target_ordinals]
+        remaining_chunks = np.bincount(owners, minlength=len(target_ordinals))
+        target_items = np.zeros(len(target_ordinals), dtype=np.int64)
+        progress = self.instrumentation.progress(method, sum(task[2][4] - task[2][3] for task in tasks), 'quadruples')
+
+        pending = len(tasks)
+        # Ties are broken by position in StreamingTopK, so the completion order does not change the results
+        for index, worker, seconds, (positions, measures) in self.imap_unordered(_timed_call, tasks):
+            owner = owners[index]
+            _, _, (_, _, _, start, stop, _, _) = tasks[index]
+            tops[owner].push(measures, positions)
+            pending -= 1
+            progress.chunk(worker, stop - start, seconds, pending)
+
+            remaining_chunks[owner] -= 1
+            target_items[owner] += stop - start
+            if remaining_chunks[owner] == 0:
+                progress.target(targets[owner], int(target_items[owner]), time.perf_counter() - progress.start)
+        progress.done()
+
+        return [top.result() for top in tops]
+
+    def close(self):
+        """
+        Terminates the workers and frees the shared memory.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -2,8 +2,8 @@
 Rules:
 
 """
-from copula.c_vine_model import CVineModel
-from pyvinecopulib import to_pseudo_obs
+from ps.pseudo_observations import PseudoObservationCache, pseudo_observations
+from strategy.utils_multiprocess import run_cmpi_calcs
 import pandas as pd
 import matplotlib.pyplot as plt
 
@@ -11,44 +11,109 @@ import matplotlib.pyplot as plt
 class CMPI:
     DEFAULT_FAMILY = [1, 2, 3, 4, 5, 6, 7, 9, 10, 13, 16, 20, 23, 24, 26, 27, 29, 30, 33, 34, 36, 39, 40, 
                     104, 114, 124, 134, 204, 214, 224, 234]
-    def __init__(self) -> None:
-        self.cvm = CVineModel()
+    BACKENDS = ('r', 'pyvinecopulib')
+
+    def __init__(self, cvm=None, backend: str = 'r', pseudo_obs_cache: PseudoObservationCache = None) -> None:
+        """
+        cvm: copula model with the fit/predict interface of CVineModel. None (default) means a new model of the
+        backend, imported here so that only the dependencies of the backend in use are needed.
+        backend: 'r' (default) for CVineModel, which runs VineCopula in R, or 'pyvinecopulib' for
+        PyvinecopulibCVineModel, which fits the same C-vine in process.
+        pseudo_obs_cache: memo of the sort orders of the return windows, e.g. shared with PartnerSelection and
+        RollingPartnerSelection, a new memo of this instance by default.
+        """
+        if backend not in CMPI.BACKENDS:
+            raise Exception("Please enter a valid copula backend, i.e ('r', 'pyvinecopulib')")
+        if cvm is None and backend == 'r':
+            from copula.c_vine_model import CVineModel
+            cvm = CVineModel()
+        elif cvm is None:
+            from copula.pyvinecopulib_model import PyvinecopulibCVineModel
+            cvm = PyvinecopulibCVineModel()
+        self.cvm = cvm
         self.family_set = None
         self.training_returns = None
+        self.window_start = None
+        # Sort orders of the return windows, keyed by their (start, stop) rows of the return panel
+        self.pseudo_obs_cache = PseudoObservationCache() if pseudo_obs_cache is None else pseudo_obs_cache
 
-    def pseudo_obs(self, data: pd.DataFrame):
+    def pseudo_obs(self, data: pd.DataFrame, key: tuple = None):
         """
         Calculate quantiles from stock returns (ECDF)
+        Average ranks of ties divided by n + 1, as pyvinecopulib.to_pseudo_obs.
+        key: (start, stop) rows of the window in the return panel, whose sort order is memoized in
+        self.pseudo_obs_cache.
         """
-        columns = list(data)
-        quantiles = to_pseudo_obs(data)
-        return pd.DataFrame(quantiles, columns=columns) 
+        quantiles = pseudo_observations(data, cache=self.pseudo_obs_cache, key=key)
+        return quantiles.reset_index(drop=True)
 
-    def init_copula_model(self, training_returns: pd.DataFrame, family_set: list = None):
+    def init_copula_model(self, training_returns: pd.DataFrame, family_set: list = None, window_start: int = None):
+        """
+        training_returns: returns of the quadruple in the formation period.
+        window_start: row of the first training return in the return panel shared through self.pseudo_obs_cache,
+        e.g. the start of a formation window of RollingPartnerSelection, whose sort order is then reused. The
+        testing returns of generate_cmpi must follow the training returns in the panel. None (default) keys the
+        windows by their rows in the training and testing returns of this instance.
+        """
         self.training_returns = training_returns
+        self.window_start = window_start
         # Get quantiles data
-        quantiles = self.pseudo_obs(training_returns)
+        start = 0 if window_start is None else window_start
+        quantiles = self.pseudo_obs(training_returns, key=(start, start + len(training_returns)))
         # Fit copula
         self.cvm.fit(quantiles, CMPI.DEFAULT_FAMILY)
         #TODO: Implement goodness-of-fit checks here
 
-    def calculate_bollinger_bands(self, series: pd.Series, window_size: int, num_std: int):
+    @staticmethod
+    def calculate_bollinger_bands(series: pd.Series, window_size: int, num_std: int):
         rolling = series.rolling(window_size)
         bband = rolling.mean() + rolling.std(ddof=0) * num_std
         return bband
 
-    def generate_cmpi(self, testing_returns: pd.DataFrame) -> pd.Series:
+    def generate_cmpi(self, testing_returns: pd.DataFrame, refit_every: int = 1, maxit: int = 50,
+                      num_workers: int = 1, model_factory=None) -> pd.Series:
+        """
+        Cumulative mispricing index over the testing period, from a copula fitted on the rolling window of
+        the previous days.
+
+        :param testing_returns: (pd.DataFrame) : returns of the quadruple in the trading period
+        :param refit_every: (int) : number of days between full fits with structure and family selection. On the
+            days between, only the parameters are re-estimated, keeping the families of the last full fit and
+            starting from the previous parameters. 1 (default) means a full fit every day
+        :param maxit: (int) : maximum number of iterations of the parameter re-estimation
+        :param num_workers: (int) : number of worker processes fitting contiguous blocks of windows, 1 (default)
+            means the windows are fitted sequentially in this process
+        :param model_factory: (callable) : module level callable without arguments creating the copula model of
+            a worker process, the class of the copula model by default
+        :return: (pd.Series) : cumulative mispricing index, starting at 0
+        """
+        if refit_every < 1:
+            raise Exception("Please enter a refit cadence of at least 1 day")
+
         trading_periods = testing_returns.shape[0]
         copula_fit_length = self.training_returns.shape[0]
         
         all_returns = pd.concat([self.training_returns, testing_returns], ignore_index=True)
 
+        if num_workers > 1:
+            model_factory = type(self.cvm) if model_factory is None else model_factory
+            return run_cmpi_calcs(model_factory, all_returns, copula_fit_length, self.family_set, refit_every,
+                                  maxit, num_workers)
+
         cmpi_list = [0]
         start = 0
         stop = copula_fit_length
+        offset = 0 if self.window_start is None else self.window_start
         while stop < trading_periods + copula_fit_length:
-            quantiles = self.pseudo_obs(all_returns[start:stop])
-            self.cvm.fit(quantiles, self.family_set)
+            # Windows are looked up by their rows in the return panel. Without one, only the first window, the
+            # training window itself, is memoized, as the other windows are used once
+            key = (offset + start, offset + stop) if self.window_start is not None or stop <= copula_fit_length \
+                else None
+            quantiles = self.pseudo_obs(all_returns[start:stop], key)
+            if start % refit_every == 0:
+                self.cvm.fit(quantiles, self.family_set)
+            else:
+                self.cvm.refit(quantiles, maxit=maxit)
             # get misspricing index
             mpi = self.cvm.predict(quantiles[-1:])
             # de-mean misspricing index and cummulatively sum to get CMPI
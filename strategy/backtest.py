@@ -0,0 +1,140 @@
+"""
+Vectorized backtest of band crossing strategies on the CMPI, or any other signal, over a grid of band windows
+and widths for many baskets at once.
+"""
+import numpy as np
+import pandas as pd
+
+from strategy.portfolio import basket_label, get_returns
+
+TRADING_DAYS = 252
+
+
+def band_positions(signal: np.ndarray, upper: np.ndarray, lower: np.ndarray, mean: np.ndarray) -> np.ndarray:
+    """
+    Positions from band crossings, for many signals and bands at once. Column by column, the result is that of
+    strategy.portfolio.trading_signals: without a position, a signal below the lower band opens a short
+    position (-1) and a signal above the upper band a long position (1). A long position is closed when the
+    signal falls to the mean and a short position when it rises to the mean, without a new position on the same
+    day. Comparisons with NaN bands are false, so no position is opened before the bands are defined.
+
+    :param signal: (np.array) : signals of shape (n_days, n_columns)
+    :param upper: (np.array) : upper bands of the same shape
+    :param lower: (np.array) : lower bands of the same shape
+    :param mean: (np.array) : means of the same shape
+    :return: (np.array) : position at the end of every day, of the same shape
+    """
+
+    signal, upper, lower, mean = np.broadcast_arrays(signal, upper, lower, mean)
+    positions = np.zeros(signal.shape)
+    current = np.zeros(signal.shape[1:])
+    for i in range(len(signal)):
+        flat = current == 0
+        enter_short = flat & (signal[i] < lower[i])
+        enter_long = flat & ~enter_short & (signal[i] > upper[i])
+        close = ((current == 1) & (signal[i] <= mean[i])) | ((current == -1) & (signal[i] >= mean[i]))
+        current = np.where(enter_short, -1., np.where(enter_long, 1., np.where(close, 0., current)))
+        positions[i] = current
+
+    return positions
+
+
+def band_statistics(signal: pd.DataFrame, window: int = None) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Mean and standard deviation of the Bollinger bands of every signal, as in CMPI.calculate_bollinger_bands.
+
+    :param signal: (pd.DataFrame) : signals, e.g. the CMPI of every basket
+    :param window: (int) : number of days of the rolling statistics, None for expanding statistics over all days
+        up to each day, so that the bands never use later values of the signal
+    :return: (tuple) : mean and population standard deviation, of the shape of signal
+    """
+
+    rolling = signal.expanding() if window is None else signal.rolling(window)
+    return rolling.mean(), rolling.std(ddof=0)
+
+
+def spread_returns(prices: pd.DataFrame, quadruples: list) -> pd.DataFrame:
+    """
+    Daily returns of the spread of every basket, half the return of the target less the mean return of its
+    partners, i.e. the return of a long position of 0.5 in the target and 0.5 spread over the partners.
+
+    :param prices: (pd.DataFrame) : price series of all stocks in the baskets
+    :param quadruples: (list) : baskets of tickers, target first
+    :return: (pd.DataFrame) : spread returns of every basket, with the labels of strategy.portfolio.basket_label
+    """
+
+    returns = get_returns(prices)
+    return pd.DataFrame({basket_label(quadruple): 0.5 * (returns[quadruple[0]] -
+                                                         returns[list(quadruple[1:])].mean(axis=1))
+                         for quadruple in quadruples})
+
+
+def _max_drawdown(cumulative: np.ndarray) -> np.ndarray:
+    """
+    Largest fall of every column of a cumulative P&L from its running maximum, starting from 0.
+    """
+
+    peak = np.maximum.accumulate(np.vstack([np.zeros(cumulative.shape[1]), cumulative]), axis=0)[1:]
+    return (peak - cumulative).max(axis=0) if len(cumulative) else np.zeros(cumulative.shape[1])
+
+
+def backtest_grid(signal: pd.DataFrame, returns: pd.DataFrame, windows: list = (30,), num_stds: list = (2.5,),
+                  cost: float = 0.0, return_pnl: bool = False):
+    """
+    Backtests the band crossing strategy of every basket for every combination of band window and width.
+
+    The rolling mean and standard deviation are computed once per window and shared by all widths, and the
+    positions of all baskets and parameters are generated together by band_positions. A position set at the
+    close of a day earns the spread return of the next day, with a short spread for a long position, as a high
+    CMPI means the target is overpriced relative to its partners:
+
+        pnl = -position_lag * spread_return - cost * |position - position_lag|
+
+    :param signal: (pd.DataFrame) : signals of the baskets, e.g. the 'cmpi' field of CMPIPortfolio.run
+    :param returns: (pd.DataFrame) : spread returns of the same baskets, e.g. from spread_returns
+    :param windows: (list) : band windows in days, None for expanding bands, which are labelled NaN in the index of
+        the results
+    :param num_stds: (list) : band widths in standard deviations
+    :param cost: (float) : transaction cost per unit of position traded
+    :param return_pnl: (bool) : whether to return the daily P&L of every combination as well
+    :return: (pd.DataFrame/tuple) : statistics indexed by (basket, window, num_std): total_pnl, sharpe
+        (annualized), num_trades, time_in_market and max_drawdown. With return_pnl, also the daily P&L with
+        columns (basket, window, num_std)
+    """
+
+    missing = [basket for basket in signal.columns if basket not in returns.columns]
+    if missing:
+        raise Exception("Returns are missing for baskets: {}".format(', '.join(map(str, missing))))
+
+    windows, num_stds = list(windows), np.asarray(num_stds, dtype=np.float64)
+    baskets = list(signal.columns)
+    n_days = len(signal)
+
+    # Bands of shape (n_days, n_baskets, n_windows, n_stds)
+    means, stds = zip(*(band_statistics(signal, window) for window in windows))
+    mean = np.stack([frame.to_numpy(dtype=float) for frame in means], axis=2)[:, :, :, None]
+    std = np.stack([frame.to_numpy(dtype=float) for frame in stds], axis=2)[:, :, :, None]
+    values = signal.to_numpy(dtype=float)[:, :, None, None]
+
+    shape = (n_days, len(baskets), len(windows), len(num_stds))
+    positions = band_positions(*(np.broadcast_to(array, shape).reshape(n_days, -1) for array in
+                                 (values, mean + num_stds * std, mean - num_stds * std, mean)))
+
+    spread = returns[baskets].reindex(signal.index).to_numpy(dtype=float)
+    spread = np.repeat(np.nan_to_num(spread), len(windows) * len(num_stds), axis=1)
+    lagged = np.vstack([np.zeros((1, positions.shape[1])), positions[:-1]])
+    pnl = -lagged * spread - cost * np.abs(positions - lagged)
+
+    std_pnl = pnl.std(axis=0)
+    statistics = pd.DataFrame({
+        'total_pnl': pnl.sum(axis=0),
+        'sharpe': np.divide(pnl.mean(axis=0), std_pnl, out=np.zeros_like(std_pnl), where=std_pnl > 0) *
+        np.sqrt(TRADING_DAYS),
+        'num_trades': ((positions != 0) & (lagged != positions)).sum(axis=0),
+        'time_in_market': (positions != 0).mean(axis=0) if n_days else np.zeros(positions.shape[1]),
+        'max_drawdown': _max_drawdown(np.cumsum(pnl, axis=0))},
+        index=pd.MultiIndex.from_product([baskets, windows, num_stds], names=['basket', 'window', 'num_std']))
+
+    if return_pnl:
+        return statistics, pd.DataFrame(pnl, index=signal.index, columns=statistics.index)
+    return statistics
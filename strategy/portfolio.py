@@ -0,0 +1,145 @@
+"""
+CMPI strategy for a portfolio of baskets, e.g. all quadruples selected by PartnerSelection.
+"""
+import numpy as np
+import pandas as pd
+
+from strategy.CMPI_strategy import CMPI
+from strategy.utils_multiprocess import basket_cmpi, run_portfolio_calcs
+
+FIELDS = ('cmpi', 'mean', 'upper', 'lower', 'position')
+
+
+def get_returns(prices: pd.DataFrame) -> pd.DataFrame:
+    """
+    Daily returns of a price panel, with infinite returns of zero prices forward filled.
+
+    :param prices: (pd.DataFrame) : price series
+    :return: (pd.DataFrame) : daily returns
+    """
+
+    return prices.pct_change().replace([np.inf, -np.inf], np.nan).ffill().dropna()
+
+
+def trading_signals(signal: np.ndarray, upper: np.ndarray, lower: np.ndarray, mean: np.ndarray) -> np.ndarray:
+    """
+    Positions from the crossings of the bands of a signal. Without a position, a signal below the lower band
+    opens a short position (-1) and a signal above the upper band a long position (1). A long position is closed
+    when the signal falls to the mean, a short position when it rises to the mean.
+
+    :param signal: (np.array) : signal, e.g. the CMPI
+    :param upper: (np.array) : upper band
+    :param lower: (np.array) : lower band
+    :param mean: (np.array) : mean of the signal
+    :return: (np.array) : position at the end of every day
+    """
+
+    position = np.zeros(len(signal))
+    curr_position = 0
+    for i in range(len(signal)):
+        if curr_position == 0:
+            if signal[i] < lower[i]:
+                curr_position = -1
+            elif signal[i] > upper[i]:
+                curr_position = 1
+        else:
+            if (signal[i] <= mean[i]) and curr_position == 1:
+                curr_position = 0
+            elif (signal[i] >= mean[i]) and curr_position == -1:
+                curr_position = 0
+        position[i] = curr_position
+
+    return position
+
+
+def basket_label(quadruple: list) -> str:
+    """
+    Label of a basket in the results, its tickers separated by commas.
+    """
+
+    return ','.join(quadruple)
+
+
+class CMPIPortfolio:
+    """
+    Runs the CMPI strategy for every basket of a portfolio. The copula of each basket is fitted on the returns
+    of the training period, the CMPI is generated over the trading period, and positions follow from the
+    crossings of its Bollinger bands. Baskets are independent, so they are scheduled across worker processes.
+    """
+
+    def __init__(self, prices: pd.DataFrame, quadruples: list, backend: str = 'r', family_set: list = None):
+        """
+        :param prices: (pd.DataFrame) : price series of all stocks in the baskets
+        :param quadruples: (list) : baskets of tickers, target first, e.g. the output of PartnerSelection.extremal
+        :param backend: (str) : copula backend of CMPI, 'r' or 'pyvinecopulib'
+        :param family_set: (list) : copula families of the rolling fits, None means all families
+        """
+
+        if backend not in CMPI.BACKENDS:
+            raise Exception("Please enter a valid copula backend, i.e ('r', 'pyvinecopulib')")
+
+        missing = sorted(set(ticker for quadruple in quadruples for ticker in quadruple) - set(prices.columns))
+        if missing:
+            raise Exception("Prices are missing for tickers: {}".format(', '.join(missing)))
+
+        self.prices = prices
+        self.quadruples = [list(quadruple) for quadruple in quadruples]
+        self.backend = backend
+        self.family_set = family_set
+
+    def _basket_returns(self, quadruple: list, training_period: tuple, testing_period: tuple) -> tuple:
+        """
+        Training and testing returns of a basket, without the days on which a price of the basket is missing.
+        """
+
+        returns = get_returns(self.prices.loc[:, quadruple].dropna(how='any'))
+        return returns[training_period[0]:training_period[1]], returns[testing_period[0]:testing_period[1]]
+
+    def run(self, training_period: tuple, testing_period: tuple, window: int = 30, num_std: float = 2.5,
+            refit_every: int = 1, maxit: int = 50, num_workers: int = 4) -> pd.DataFrame:
+        """
+        Generates the CMPI, bands and positions of every basket.
+
+        The CMPI of a basket is dated by the last day of the window its latest mispricing index was computed on,
+        and its first value, 0, by the day before the first window ends. Series of all baskets are aligned on the
+        union of their dates, so a basket with missing prices has NaNs on the dates it does not cover.
+
+        :param training_period: (tuple) : first and last date of the training period
+        :param testing_period: (tuple) : first and last date of the trading period
+        :param window: (int) : number of days of the Bollinger bands
+        :param num_std: (float) : width of the Bollinger bands in standard deviations
+        :param refit_every: (int) : number of days between full copula fits, see CMPI.generate_cmpi
+        :param maxit: (int) : maximum number of iterations of the parameter re-estimation
+        :param num_workers: (int) : number of worker processes, 1 runs the baskets sequentially in this process
+        :return: (pd.DataFrame) : columns with a level for the field ('cmpi', 'mean', 'upper', 'lower',
+            'position') and a level for the basket, indexed by date
+        """
+
+        baskets = [self._basket_returns(quadruple, training_period, testing_period) for quadruple in self.quadruples]
+        for quadruple, (training_returns, testing_returns) in zip(self.quadruples, baskets):
+            if len(training_returns) < 2 or len(testing_returns) == 0:
+                raise Exception("Not enough returns in the training or trading period for {}".format(quadruple))
+
+        if num_workers > 1:
+            cmpis = run_portfolio_calcs(self.backend, baskets, self.family_set, refit_every, maxit, num_workers)
+        else:
+            cvm = CMPI(backend=self.backend).cvm
+            cmpis = [basket_cmpi(cvm, training_returns, testing_returns, self.family_set, refit_every, maxit)
+                     for training_returns, testing_returns in baskets]
+
+        columns = {field: {} for field in FIELDS}
+        for quadruple, (training_returns, testing_returns), cmpi in zip(self.quadruples, baskets, cmpis):
+            all_dates = training_returns.index.append(testing_returns.index)
+            window_length = len(training_returns)
+            cmpi.index = all_dates[window_length - 2:window_length - 1 + len(testing_returns)]
+
+            label = basket_label(quadruple)
+            columns['cmpi'][label] = cmpi
+            columns['mean'][label] = CMPI.calculate_bollinger_bands(cmpi, window, 0)
+            columns['upper'][label] = CMPI.calculate_bollinger_bands(cmpi, window, num_std)
+            columns['lower'][label] = CMPI.calculate_bollinger_bands(cmpi, window, -num_std)
+            columns['position'][label] = pd.Series(
+                trading_signals(cmpi.values, columns['upper'][label].values, columns['lower'][label].values,
+                                columns['mean'][label].values), index=cmpi.index)
+
+        return pd.concat({field: pd.DataFrame(series) for field, series in columns.items()}, axis=1)
@@ -0,0 +1,204 @@
+import os
+import time
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from ps.instrumentation import Instrumentation
+from ps.pseudo_observations import pseudo_observations
+
+# Copula model of the current worker process, created once by _init_worker.
+_WORKER_MODEL = None
+
+
+def get_window_blocks(n_windows: int, num_workers: int, refit_every: int = 1, blocks_per_worker: int = 2) -> list:
+    """
+    Splits the rolling windows into contiguous (start, stop) blocks. Blocks start at multiples of refit_every,
+    so every block starts with a full fit and the refit policy within a block is the same as in a sequential run.
+
+    :param n_windows: (int) Number of rolling windows
+    :param num_workers: (int) Number of workers
+    :param refit_every: (int) Number of windows between full fits
+    :param blocks_per_worker: (int) Number of blocks per worker, for load balancing
+    :return: (list) List of (start, stop) tuples
+    """
+
+    n_cycles = -(-n_windows // refit_every)
+    n_blocks = max(1, min(num_workers * blocks_per_worker, n_cycles))
+    bounds = np.linspace(0, n_cycles, n_blocks + 1).astype(int) * refit_every
+    bounds[-1] = n_windows
+    return [(start, stop) for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()) if stop > start]
+
+
+def _init_worker(model_factory):
+    """
+    Creates the copula model of a worker process. For CVineModel this starts the embedded R and loads
+    VineCopula, once per worker.
+    """
+    global _WORKER_MODEL
+    _WORKER_MODEL = model_factory()
+
+
+def window_mpis(cvm, returns: pd.DataFrame, window: int, start: int, stop: int, family_set: list = None,
+                refit_every: int = 1, maxit: int = 50) -> np.ndarray:
+    """
+    Mispricing index of the last day of every rolling window in [start, stop). Window i holds the rows
+    i to i + window of returns. A window at a multiple of refit_every, and the first window, get a full fit, the
+    others only a re-estimation of the parameters.
+
+    :param cvm: (CVineModel) Copula model
+    :param returns: (pd.DataFrame) Returns of the quadruple, rows start to stop + window - 1 of all windows
+    :param window: (int) Number of days in a window
+    :param start: (int) Index of the first window
+    :param stop: (int) Index after the last window
+    :param family_set: (list) Copula families of the full fits, None means all families
+    :param refit_every: (int) Number of windows between full fits
+    :param maxit: (int) Maximum number of iterations of the parameter re-estimation
+    :return: (np.array) Mispricing index of every window
+    """
+    columns = list(returns)
+    values = returns.to_numpy(dtype=float)
+    mpis = np.empty(stop - start)
+    for i in range(start, stop):
+        data = values[i - start:i - start + window]
+        quantiles = pd.DataFrame(pseudo_observations(data), columns=columns)
+        if i == start or i % refit_every == 0:
+            cvm.fit(quantiles, family_set)
+        else:
+            cvm.refit(quantiles, maxit=maxit)
+        mpis[i - start] = cvm.predict(quantiles[-1:]).values[0]
+    return mpis
+
+
+def _window_block(task: tuple) -> tuple:
+    """
+    Fits a block of windows with the model of the worker process.
+    :param task: (tuple) Index of the block and the arguments of window_mpis without the model
+    :return: (tuple) Index of the block, id of the worker process, seconds spent and the mispricing indices
+    """
+    index, args = task
+    start = time.perf_counter()
+    mpis = window_mpis(_WORKER_MODEL, *args)
+    return index, os.getpid(), time.perf_counter() - start, mpis
+
+
+def run_cmpi_calcs(model_factory, all_returns: pd.DataFrame, window: int, family_set: list = None,
+                   refit_every: int = 1, maxit: int = 50, num_workers: int = 4,
+                   instrumentation: Instrumentation = None) -> pd.Series:
+    """
+    Cumulative mispricing index of all rolling windows of all_returns, with the windows fitted in a process
+    pool. Workers are started with the spawn method, as an embedded R can not be shared with forked processes,
+    and each worker creates its own copula model once. Scripts using it need an if __name__ == '__main__' guard.
+
+    :param model_factory: (callable) Module level callable without arguments that returns a copula model,
+        e.g. the CVineModel class
+    :param all_returns: (pd.DataFrame) Returns of the quadruple, the first window followed by the trading period
+    :param window: (int) Number of days in a window
+    :param family_set: (list) Copula families of the full fits, None means all families
+    :param refit_every: (int) Number of windows between full fits
+    :param maxit: (int) Maximum number of iterations of the parameter re-estimation
+    :param num_workers: (int) Number of worker processes
+    :param instrumentation: (Instrumentation) Receiver of the progress events
+    :return: (pd.Series) Cumulative mispricing index, starting at 0, which is its only value without trading days
+    """
+    instrumentation = Instrumentation() if instrumentation is None else instrumentation
+    n_windows = max(0, len(all_returns) - window)
+    blocks = get_window_blocks(n_windows, num_workers, refit_every)
+    tasks = [(index, (all_returns.iloc[start:stop + window - 1], window, start, stop, family_set, refit_every,
+                      maxit)) for index, (start, stop) in enumerate(blocks)]
+    if not tasks:
+        # Without trading windows no pool is started, and the index is only its starting 0, as in the
+        # sequential CMPI.generate_cmpi
+        return pd.Series([0.])
+
+    progress = instrumentation.progress('generate_cmpi', n_windows, 'windows')
+    results = [None] * len(tasks)
+    pending = len(tasks)
+    with mp.get_context('spawn').Pool(min(num_workers, len(tasks)), initializer=_init_worker,
+                                      initargs=(model_factory,)) as pool:
+        for index, worker, seconds, mpis in pool.imap_unordered(_window_block, tasks):
+            results[index] = mpis
+            pending -= 1
+            progress.chunk(worker, len(mpis), seconds, pending)
+    progress.done()
+
+    # De-mean the mispricing indices and cumulatively sum them in order
+    mpis = np.concatenate(results) if results else np.empty(0)
+    return pd.Series(np.concatenate([[0], np.cumsum(mpis - 0.5)]))
+
+
+def _init_backend(backend: str):
+    """
+    Creates the copula model of the CMPI backend in a worker process, once per worker.
+    """
+    global _WORKER_MODEL
+    from strategy.CMPI_strategy import CMPI
+    _WORKER_MODEL = CMPI(backend=backend).cvm
+
+
+def basket_cmpi(cvm, training_returns: pd.DataFrame, testing_returns: pd.DataFrame, family_set: list = None,
+                refit_every: int = 1, maxit: int = 50) -> pd.Series:
+    """
+    Fits the copula model of a basket on its training returns and generates its cumulative mispricing index.
+
+    :param cvm: (CVineModel) Copula model
+    :param training_returns: (pd.DataFrame) Returns of the basket in the training period, target first
+    :param testing_returns: (pd.DataFrame) Returns of the basket in the trading period
+    :param family_set: (list) Copula families of the rolling full fits, None means all families
+    :param refit_every: (int) Number of windows between full fits
+    :param maxit: (int) Maximum number of iterations of the parameter re-estimation
+    :return: (pd.Series) Cumulative mispricing index, starting at 0
+    """
+    from strategy.CMPI_strategy import CMPI
+    strategy = CMPI(cvm)
+    strategy.init_copula_model(training_returns)
+    strategy.family_set = family_set
+    return strategy.generate_cmpi(testing_returns, refit_every, maxit)
+
+
+def _basket_task(task: tuple) -> tuple:
+    """
+    Generates the CMPI of a basket with the model of the worker process.
+    :param task: (tuple) Index of the basket and the arguments of basket_cmpi without the model
+    :return: (tuple) Index of the basket, id of the worker process, seconds spent and the CMPI
+    """
+    index, args = task
+    start = time.perf_counter()
+    cmpi = basket_cmpi(_WORKER_MODEL, *args)
+    return index, os.getpid(), time.perf_counter() - start, cmpi
+
+
+def run_portfolio_calcs(backend: str, baskets: list, family_set: list = None, refit_every: int = 1,
+                        maxit: int = 50, num_workers: int = 4, instrumentation: Instrumentation = None) -> list:
+    """
+    CMPI of every basket, with the baskets scheduled across a process pool. Workers are started with the spawn
+    method and each creates the copula model of the backend once. Scripts using it need an
+    if __name__ == '__main__' guard.
+
+    :param backend: (str) CMPI backend, 'r' or 'pyvinecopulib'
+    :param baskets: (list) (training_returns, testing_returns) of every basket
+    :param family_set: (list) Copula families of the rolling full fits, None means all families
+    :param refit_every: (int) Number of windows between full fits
+    :param maxit: (int) Maximum number of iterations of the parameter re-estimation
+    :param num_workers: (int) Number of worker processes
+    :param instrumentation: (Instrumentation) Receiver of the progress events
+    :return: (list) CMPI of every basket, in the order of baskets
+    """
+    instrumentation = Instrumentation() if instrumentation is None else instrumentation
+    tasks = [(index, (training_returns, testing_returns, family_set, refit_every, maxit))
+             for index, (training_returns, testing_returns) in enumerate(baskets)]
+    if not tasks:
+        return []
+
+    progress = instrumentation.progress('portfolio', sum(len(testing) for _, testing in baskets), 'windows')
+    results = [None] * len(tasks)
+    pending = len(tasks)
+    with mp.get_context('spawn').Pool(min(num_workers, len(tasks)), initializer=_init_backend,
+                                      initargs=(backend,)) as pool:
+        for index, worker, seconds, cmpi in pool.imap_unordered(_basket_task, tasks):
+            results[index] = cmpi
+            pending -= 1
+            progress.chunk(worker, len(baskets[index][1]), seconds, pending)
+    progress.done()
+
+    return results
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import generate_prices
+from ps.partner_selection import PartnerSelection
+
+
+@pytest.fixture(scope='module')
+def prices():
+    return generate_prices(n_tickers=60, n_days=120, seed=1)
+
+
+def assert_same_selection(batch: np.ndarray, serial: np.ndarray):
+    np.testing.assert_array_equal(batch['members'], serial['members'])
+    np.testing.assert_allclose(batch['score'], serial['score'], rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('method', ['traditional', 'extended', 'geometric', 'extremal'])
+def test_batch_matches_serial(prices, method):
+    # Cohorts of 3 stocks keep the serial procedures fast, the batch engines are the same for any size.
+    # The batch selector runs first, before the serial traditional approach builds the dense correlation matrix.
+    selection = PartnerSelection(prices, cohort_size=3)
+    batch = getattr(selection, f'{method}_batch')(2, top_k=3)
+    assert_same_selection(batch, getattr(selection, method)(2, top_k=3))
+
+
+def test_traditional_batch_scores_in_float64(prices):
+    batch = PartnerSelection(prices, dtype=np.float32, cohort_size=3).traditional_batch(2, top_k=3)
+    serial = PartnerSelection(prices, cohort_size=3).traditional(2, top_k=3)
+    assert_same_selection(batch, serial)
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.run_benchmarks import StubCopulaModel
+from benchmarks.synthetic import generate_prices
+from ps.partner_selection import PartnerSelection
+from ps.pseudo_observations import PseudoObservationCache, pseudo_observations
+from ps.rolling_selection import RollingPartnerSelection
+from strategy.CMPI_strategy import CMPI
+
+
+@pytest.fixture(scope='module')
+def prices():
+    return generate_prices(n_tickers=30, n_days=241, seed=2)
+
+
+@pytest.fixture(scope='module')
+def returns(prices):
+    # Row i of the return panel is the return from price i to price i + 1
+    return prices.pct_change().dropna()
+
+
+def test_selector_and_cmpi_share_formation_window(prices, returns):
+    cache = PseudoObservationCache()
+    start, stop = 40, 160
+    selection = PartnerSelection(prices.iloc[start:stop + 1], pseudo_obs_cache=cache, window_key=(start, stop))
+    selection.extended_batch(1)  # The quantiles reuse the sort order of the ranked returns
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    quadruple = [selection.top_50_correlations.index[0]] + list(selection.top_50_correlations.iloc[0, :3])
+    training_returns = np.log1p(returns.iloc[start:stop][quadruple])  # Log returns have the same sort order
+    strategy = CMPI(StubCopulaModel(), pseudo_obs_cache=cache)
+    strategy.init_copula_model(training_returns, window_start=start)
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    np.testing.assert_array_equal(strategy.pseudo_obs(training_returns, (start, stop)).to_numpy(),
+                                  pseudo_observations(training_returns.to_numpy()))
+
+
+def test_rolling_selection_and_cmpi_share_windows(prices, returns):
+    cache = PseudoObservationCache()
+    rolling = RollingPartnerSelection(prices, window=120, step=20, n_partners=10, pseudo_obs_cache=cache)
+    rows = [window[1] for window in rolling.windows()]
+    assert cache.misses == 0 and len(rows) > 2
+
+    quadruple = list(returns.columns[:4])
+    start, stop = rows[0]
+    strategy = CMPI(StubCopulaModel(), pseudo_obs_cache=cache)
+    strategy.init_copula_model(returns.iloc[start:stop][quadruple], window_start=start)
+    cmpi = strategy.generate_cmpi(returns.iloc[stop:][quadruple])
+
+    # The training window, then every formation window that generate_cmpi fits, i.e. that ends before the last day
+    assert cache.hits == 1 + sum(window_stop < len(returns) for _, window_stop in rows)
+    reference = CMPI(StubCopulaModel())
+    reference.init_copula_model(returns.iloc[start:stop][quadruple])
+    pd.testing.assert_series_equal(cmpi, reference.generate_cmpi(returns.iloc[stop:][quadruple]))
+
+
+def test_reused_key_is_recomputed():
+    rng = np.random.default_rng(0)
+    cache = PseudoObservationCache()
+    first, second = rng.standard_normal((50, 3)), rng.standard_normal((50, 3))
+    pseudo_observations(first, cache=cache, key=(0, 50))
+    np.testing.assert_array_equal(pseudo_observations(second, cache=cache, key=(0, 50)),
+                                  pseudo_observations(second))
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_cache_is_bounded_by_bytes():
+    values = np.random.default_rng(0).standard_normal((100, 10))
+    cache = PseudoObservationCache(max_bytes=2 * values.size * np.dtype(np.intp).itemsize)
+    for start in range(3):
+        pseudo_observations(values, cache=cache, key=(start, start + 100))
+    assert len(cache._entries) == 2 and cache.nbytes <= cache.max_bytes